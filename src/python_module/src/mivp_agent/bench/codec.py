@@ -0,0 +1,74 @@
+'''
+Compares the bridge codecs by encode / decode time and bytes per state.
+
+Usage:
+  python -m mivp_agent.bench.codec --steps 2000 --vars 10 --reports 5
+
+Bytes are averaged over every step, so the stateful codecs (schema, delta) include their occasional full frames.
+'''
+import time
+import argparse
+
+from mivp_agent.codec import CODECS
+from mivp_agent.bench.states import make_states
+
+def measure(name, states):
+  '''
+  Encodes then decodes `states` in order with fresh codec instances, like one connection would.
+
+  Returns:
+    dict: Mean encode and decode time in microseconds and mean bytes per state
+  '''
+  encoder = CODECS[name]()
+  decoder = CODECS[name]()
+
+  start = time.perf_counter()
+  encoded = [encoder.encode_state(s) for s in states]
+  encode_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  decoded = [decoder.decode_state(e) for e in encoded]
+  decode_time = time.perf_counter() - start
+
+  assert decoded == states, f"Codec '{name}' did not round trip the states"
+
+  return {
+    'codec': name,
+    'encode_us': 1e6*encode_time/len(states),
+    'decode_us': 1e6*decode_time/len(states),
+    'bytes': sum(len(e) for e in encoded)/len(states),
+  }
+
+def run(steps=2000, n_vars=10, n_reports=5, codecs=None):
+  if codecs is None:
+    codecs = tuple(CODECS)
+  states = make_states(steps, n_vars=n_vars, n_reports=n_reports)
+  return [measure(name, states) for name in codecs]
+
+def print_results(results):
+  baseline = None
+  for r in results:
+    if r['codec'] == 'pickle':
+      baseline = r
+
+  print(f"{'codec':>10} {'encode us':>10} {'decode us':>10} {'bytes':>8} {'vs pickle':>10} {'saved/step':>11}")
+  for r in results:
+    ratio = ''
+    saved = ''
+    if baseline is not None:
+      ratio = f"{r['bytes']/baseline['bytes']:.2f}x"
+      saved = f"{baseline['bytes']-r['bytes']:.0f}"
+    print(f"{r['codec']:>10} {r['encode_us']:>10.2f} {r['decode_us']:>10.2f} {r['bytes']:>8.0f} {ratio:>10} {saved:>11}")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the model bridge codecs')
+  parser.add_argument('--steps', type=int, default=2000, help='Number of states to encode')
+  parser.add_argument('--vars', type=int, default=10, help='Custom MOOS vars per state')
+  parser.add_argument('--reports', type=int, default=5, help='NODE_REPORTS per state')
+  args = parser.parse_args(argv)
+
+  print(f'States: {args.steps}, custom vars: {args.vars}, node reports: {args.reports}\n')
+  print_results(run(args.steps, args.vars, args.reports))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,246 @@
+'''
+Load tests a `MissionManager` without launching a MOOS-IvP mission. A fleet of fake `BHV_Agent`s, spread over worker processes (or threads), sends states shaped like the real ones (see `mivp_agent.bench.states`) at a set helm rate and answers instructions like `BHV_Agent` does: a new state is only sent once an instruction asking for one has arrived. The manager runs a trivial policy which answers every state with the same action.
+
+Reports states served per second, the vehicles' round trip percentiles, the CPU used by the trainer, the bridge and the fleet, and the depth of the manager's queue over time. `--min-rate` and `--max-p99` turn it into a pass / fail check for bridge changes.
+
+Usage:
+  agnt bench bridge --vehicles 100 --rate 10 --seconds 10
+  python -m mivp_agent.bench.fleet --vehicles 32 --rate 0 --workers 4 --json results.json
+'''
+import os
+import sys
+import json
+import time
+import queue
+import tempfile
+import argparse
+import threading
+import multiprocessing
+
+from mivp_agent.manager import MissionManager
+from mivp_agent.bridge import ModelBridgeClient
+from mivp_agent.bench.states import make_state
+from mivp_agent.bench.roundtrip import percentile
+
+# How long a worker sleeps when none of its vehicles had anything to do
+POLL_INTERVAL = 0.0002
+
+ACTION = {
+  'speed': 2.0,
+  'course': 120.0
+}
+
+def drive(vnames, address, rate, n_vars, n_reports, stop, results):
+  '''
+  Runs the fake vehicles `vnames` in one loop until `stop` is set, then puts a dict with their round trip times (`rtts`), the number of `states` sent and the CPU seconds used (`cpu`) into `results`.
+
+  Args:
+    rate (float): Helm iterations per second of each vehicle, as fast as the manager answers if `0`
+  '''
+  period = 0.0
+  if rate > 0:
+    period = 1.0/rate
+  clients = {vname: ModelBridgeClient(address=address) for vname in vnames}
+  steps = dict.fromkeys(vnames, 0)
+  next_tick = dict.fromkeys(vnames, 0.0)
+  # Vehicles asked for a state which have not sent it yet
+  asked = set()
+  # Time each outstanding state was sent
+  sent = {}
+  rtts = []
+  cpu = time.thread_time()
+
+  while not stop.is_set():
+    busy = False
+    for vname, client in clients.items():
+      if not client.is_connected():
+        sent.pop(vname, None)
+        asked.discard(vname)
+        busy = client.connect() or busy
+        continue
+
+      instr = client.listen()
+      if instr:
+        busy = True
+        if vname in sent:
+          rtts.append(time.perf_counter() - sent.pop(vname))
+        if instr['ctrl_msg'] == 'SEND_STATE':
+          asked.add(vname)
+
+      now = time.perf_counter()
+      if vname in asked and now >= next_tick[vname]:
+        busy = True
+        asked.discard(vname)
+        state = make_state(vname, steps[vname], n_vars, n_reports)
+        steps[vname] += 1
+        sent[vname] = time.perf_counter()
+        client.send_state(state)
+        # Keep to the helm rate without bursting to catch up after a slow answer
+        next_tick[vname] = max(next_tick[vname] + period, now)
+    if not busy:
+      time.sleep(POLL_INTERVAL)
+
+  for client in clients.values():
+    client.close()
+  results.put({
+    'rtts': rtts,
+    'states': sum(steps.values()),
+    'cpu': time.thread_time() - cpu,
+  })
+
+def cpu_time(pid):
+  '''
+  Returns:
+    float: CPU seconds used so far by the process `pid` or `None` where `/proc` is not available
+  '''
+  try:
+    with open(f'/proc/{pid}/stat') as f:
+      # Fields after the command name, which may contain spaces
+      fields = f.read().rsplit(')', 1)[1].split()
+  except OSError:
+    return None
+  return (int(fields[11]) + int(fields[12]))/os.sysconf('SC_CLK_TCK')
+
+def sample_depth(mgr, interval, stop, series):
+  start = time.perf_counter()
+  while not stop.wait(interval):
+    series.append((time.perf_counter() - start, mgr.stats()['queued']))
+
+def measure(n_vehicles=32, seconds=5.0, rate=10.0, workers=4, threads=False, n_vars=10, n_reports=5, process_mode=False, shards=1, log=False, address='tcp://localhost:0', sample=0.1):
+  '''
+  Returns:
+    dict: The results, see the module description
+  '''
+  vnames = [f'agent_{i}' for i in range(n_vehicles)]
+  workers = max(1, min(workers, n_vehicles))
+  groups = [vnames[i::workers] for i in range(workers)]
+
+  if threads:
+    stop = threading.Event()
+    results = queue.Queue()
+    make_worker = lambda group: threading.Thread(target=drive, args=(group, address, rate, n_vars, n_reports, stop, results), daemon=True)
+  else:
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    results = context.Queue()
+    make_worker = lambda group: context.Process(target=drive, args=(group, address, rate, n_vars, n_reports, stop, results), daemon=True)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    with MissionManager('bench', log=log, output_dir=os.path.join(tmp, 'logs'), address=address, process_mode=process_mode, shards=shards) as mgr:
+      address = mgr.address()
+      bridge_pids = [p.pid for p in multiprocessing.active_children()]
+      fleet = [make_worker(group) for group in groups]
+      for worker in fleet:
+        worker.start()
+      mgr.wait_for(vnames)
+
+      series = []
+      sampling = threading.Event()
+      sampler = threading.Thread(target=sample_depth, args=(mgr, sample, sampling, series), daemon=True)
+
+      # The trivial policy
+      served = 0
+      cpu_trainer = cpu_time(os.getpid())
+      cpu_bridge = [cpu_time(pid) for pid in bridge_pids]
+      sampler.start()
+      start = time.perf_counter()
+      while time.perf_counter() - start < seconds:
+        for msg in mgr.get_messages(timeout=0.1):
+          msg.act(ACTION)
+          served += 1
+      total = time.perf_counter() - start
+      sampling.set()
+      sampler.join()
+      if cpu_trainer is not None:
+        cpu_trainer = cpu_time(os.getpid()) - cpu_trainer
+        cpu_bridge = sum(cpu_time(pid) - cpu for pid, cpu in zip(bridge_pids, cpu_bridge))
+
+      stats = mgr.stats()
+      stop.set()
+      fleet_results = [results.get() for _ in fleet]
+      for worker in fleet:
+        worker.join()
+
+  rtts = sorted(rtt for r in fleet_results for rtt in r['rtts'])
+  cpu = None
+  if cpu_trainer is not None:
+    cpu = {
+      # With threads the fleet runs in the trainer process
+      'trainer': 100*cpu_trainer/total,
+      'bridge': 100*cpu_bridge/total,
+    }
+  return {
+    'vehicles': n_vehicles,
+    'rate': rate,
+    'process_mode': process_mode,
+    'shards': shards,
+    'seconds': total,
+    'states_per_sec': served/total,
+    'p50_ms': 1e3*percentile(rtts, 0.5) if len(rtts) != 0 else None,
+    'p99_ms': 1e3*percentile(rtts, 0.99) if len(rtts) != 0 else None,
+    'cpu_percent': cpu,
+    # Over the whole life of each worker, percent of one core
+    'fleet_cpu_percent': [100*r['cpu']/total for r in fleet_results],
+    'queue_depth': series,
+    'peak': stats['peak'],
+  }
+
+def print_results(r):
+  print(f"Vehicles: {r['vehicles']}, helm rate: {r['rate'] or 'unlimited'}, process_mode: {r['process_mode']}, shards: {r['shards']}\n")
+  print(f"States/s:   {r['states_per_sec']:.0f}")
+  if r['p50_ms'] is not None:
+    print(f"Round trip: p50 {r['p50_ms']:.2f} ms, p99 {r['p99_ms']:.2f} ms")
+  if r['cpu_percent'] is not None:
+    print(f"CPU:        trainer {r['cpu_percent']['trainer']:.0f}%, bridge processes {r['cpu_percent']['bridge']:.0f}%, fleet workers {sum(r['fleet_cpu_percent']):.0f}%")
+  depths = [depth for _, depth in r['queue_depth']]
+  if len(depths) != 0:
+    print(f"Queue:      mean {sum(depths)/len(depths):.1f}, max {max(depths)}, peak {r['peak']}")
+    # About ten samples across the run
+    step = max(1, len(r['queue_depth'])//10)
+    print('  ' + ' '.join(f'{t:.1f}s:{depth}' for t, depth in r['queue_depth'][::step]))
+
+def add_arguments(parser):
+  parser.add_argument('--vehicles', type=int, default=32, help='Number of fake vehicles')
+  parser.add_argument('--rate', type=float, default=10.0, help='Helm iterations per second of each vehicle, 0 for as fast as possible')
+  parser.add_argument('--seconds', type=float, default=5.0, help='Duration of the measurement')
+  parser.add_argument('--workers', type=int, default=4, help='Processes (or threads) to spread the vehicles over')
+  parser.add_argument('--threads', action='store_true', help='Run the fleet in threads of the trainer process')
+  parser.add_argument('--vars', type=int, default=10, help='Custom MOOS vars per state')
+  parser.add_argument('--reports', type=int, default=5, help='NODE_REPORTS per state')
+  parser.add_argument('--process-mode', action='store_true', help='Run the bridge in a child process, see MissionManager(process_mode=True)')
+  parser.add_argument('--shards', type=int, default=1, help='Number of bridge shards')
+  parser.add_argument('--log', action='store_true', help='Log transitions to a temporary directory')
+  parser.add_argument('--address', default='tcp://localhost:0', help='Address for the manager to listen on')
+  parser.add_argument('--json', default=None, help='Also write the results to this file')
+  parser.add_argument('--min-rate', type=float, default=None, help='Fail if fewer states per second are served')
+  parser.add_argument('--max-p99', type=float, default=None, help='Fail if the p99 round trip is longer, in milliseconds')
+
+def run(args):
+  '''
+  Runs the benchmark for parsed `args` (see `add_arguments()`).
+
+  Returns:
+    int: `1` if a `--min-rate` or `--max-p99` gate failed, `0` otherwise
+  '''
+  r = measure(args.vehicles, args.seconds, args.rate, args.workers, args.threads, args.vars, args.reports, args.process_mode, args.shards, args.log, args.address)
+  print_results(r)
+  if args.json is not None:
+    with open(args.json, 'w') as f:
+      json.dump(r, f, indent=2)
+
+  failed = []
+  if args.min_rate is not None and r['states_per_sec'] < args.min_rate:
+    failed.append(f"{r['states_per_sec']:.0f} states/s is below {args.min_rate:.0f}")
+  if args.max_p99 is not None and (r['p99_ms'] is None or r['p99_ms'] > args.max_p99):
+    failed.append(f"p99 round trip of {r['p99_ms'] or 0:.2f} ms is above {args.max_p99} ms")
+  for reason in failed:
+    print(f'FAILED: {reason}', file=sys.stderr)
+  return 1 if len(failed) != 0 else 0
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Load test a MissionManager with a fleet of fake BHV_Agents')
+  add_arguments(parser)
+  sys.exit(run(parser.parse_args(argv)))
+
+if __name__ == '__main__':
+  main()
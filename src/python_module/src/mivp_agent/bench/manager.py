@@ -0,0 +1,129 @@
+'''
+Measures how many states a `MissionManager` serves while the model loop is CPU bound, with the bridge in a thread (the default) and in a child process (`process_mode=True`), and with `--shards` also spread over that many threads or processes. Simulated vehicles run in their own processes and answer every instruction with a new state like `BHV_Agent`.
+
+Usage:
+  python -m mivp_agent.bench.manager --vehicles 8 --seconds 5 --work 200
+  python -m mivp_agent.bench.manager --vehicles 128 --work 0 --shards 4
+'''
+import os
+import time
+import argparse
+import tempfile
+from multiprocessing import Process, Event, Queue
+
+from mivp_agent import shm
+from mivp_agent.manager import MissionManager
+from mivp_agent.bridge import ModelBridgeClient
+from mivp_agent.bench.states import make_state
+from mivp_agent.bench.roundtrip import percentile
+
+POLL_INTERVAL = 0.0002
+
+ACTION = {
+  'speed': 2.0,
+  'course': 120.0
+}
+
+def vehicle(vname, address, n_vars, n_reports, stop, results):
+  # Sends a state, waits for the instruction, repeat
+  states = [make_state(vname, i, n_vars, n_reports) for i in range(100)]
+  times = []
+  with ModelBridgeClient(address=address) as client:
+    while not client.connect():
+      if stop.is_set():
+        results.put(times)
+        return
+      time.sleep(0.01)
+
+    step = 0
+    while not stop.is_set():
+      sent = time.perf_counter()
+      client.send_state(states[step % len(states)])
+      step += 1
+      while not client.listen():
+        if stop.is_set():
+          break
+        # Sleep rather than spin to leave the CPUs to the manager
+        time.sleep(POLL_INTERVAL)
+      else:
+        times.append(time.perf_counter() - sent)
+  results.put(times)
+
+def burn(us):
+  # Python heavy work holding the GIL, like feature extraction in a model
+  end = time.perf_counter() + us*1e-6
+  x = 0
+  while time.perf_counter() < end:
+    x += 1
+  return x
+
+def measure(process_mode, n_vehicles=8, seconds=5.0, work_us=200, n_vars=10, n_reports=5, log=True, address='tcp://localhost:57723', shards=1):
+  '''
+  Returns:
+    dict: States served per second and the vehicles' round trip percentiles in microseconds
+  '''
+  stop = Event()
+  results = Queue()
+  vehicles = [
+    Process(target=vehicle, args=(f'agent_{i}', address, n_vars, n_reports, stop, results), daemon=True)
+    for i in range(n_vehicles)
+  ]
+
+  with tempfile.TemporaryDirectory() as tmp:
+    with MissionManager('bench', log=log, output_dir=os.path.join(tmp, 'logs'), address=address, process_mode=process_mode, shards=shards) as mgr:
+      for v in vehicles:
+        v.start()
+      mgr.wait_for([f'agent_{i}' for i in range(n_vehicles)])
+
+      served = 0
+      start = time.perf_counter()
+      while time.perf_counter() - start < seconds:
+        msg = mgr.get_message()
+        burn(work_us)
+        msg.act(ACTION)
+        served += 1
+      total = time.perf_counter() - start
+
+      stop.set()
+      times = []
+      for _ in vehicles:
+        times.extend(results.get())
+      for v in vehicles:
+        v.join()
+
+  times = sorted(times)
+  return {
+    'process_mode': process_mode,
+    'shards': shards,
+    'per_sec': served/total,
+    'p50_us': 1e6*percentile(times, 0.5),
+    'p99_us': 1e6*percentile(times, 0.99),
+  }
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark MissionManager throughput with a CPU bound model, with and without process_mode')
+  parser.add_argument('--vehicles', type=int, default=8, help='Number of simulated vehicles')
+  parser.add_argument('--seconds', type=float, default=5.0, help='Duration of each run')
+  parser.add_argument('--work', type=int, default=200, help='Microseconds of Python work per message in the model loop')
+  parser.add_argument('--vars', type=int, default=10, help='Custom MOOS vars per state')
+  parser.add_argument('--reports', type=int, default=5, help='NODE_REPORTS per state')
+  parser.add_argument('--no-log', action='store_true', help='Disable transition logging')
+  parser.add_argument('--shards', type=int, default=1, help='Also run with the bridge spread over this many shards')
+  args = parser.parse_args(argv)
+
+  shard_counts = [1]
+  if args.shards > 1:
+    shard_counts.append(args.shards)
+  # process_mode needs shared memory
+  modes = (False, True) if shm.SUPPORTED else (False, )
+  runs = [(process_mode, shards) for shards in shard_counts for process_mode in modes]
+
+  print(f'Vehicles: {args.vehicles}, model work: {args.work} us/state, logging: {not args.no_log}\n')
+  print(f"{'bridge':>8} {'shards':>6} {'states/s':>9} {'p50 us':>8} {'p99 us':>8}")
+  for process_mode, shards in runs:
+    r = measure(process_mode, args.vehicles, args.seconds, args.work, args.vars, args.reports, not args.no_log, shards=shards)
+    bridge = 'process' if process_mode else 'thread'
+    print(f"{bridge:>8} {shards:>6} {r['per_sec']:>9.0f} {r['p50_us']:>8.1f} {r['p99_us']:>8.1f}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,107 @@
+'''
+Measures the state to instruction round trip over the bridge for each transport (TCP loopback, unix socket and shared memory). A server in another process answers every state with an instruction, the way `MissionManager` does with an immediate response. Using a process keeps the GIL out of the measurement.
+
+Usage:
+  python -m mivp_agent.bench.roundtrip --steps 5000 --vars 10 --reports 5
+'''
+import os
+import time
+import argparse
+import tempfile
+from multiprocessing import Process, Event
+
+from mivp_agent import shm
+from mivp_agent.bridge import ModelBridgeServer, ModelBridgeClient
+from mivp_agent.bench.states import make_states
+
+INSTR = {
+  'speed': 2.0,
+  'course': 120.0,
+  'posts': {},
+  'ctrl_msg': 'SEND_STATE'
+}
+
+def percentile(sorted_values, p):
+  return sorted_values[min(len(sorted_values)-1, int(p*len(sorted_values)))]
+
+def answer(address, stop):
+  with ModelBridgeServer(address=address) as server:
+    while not stop.is_set():
+      _, readable = server.select(timeout=0.1)
+      server.accept_all()
+      for addr in readable:
+        for _ in server.listen_all(addr):
+          server.send_instr(addr, INSTR)
+
+def measure(address, states, codecs=None):
+  '''
+  Sends `states` one at a time from a client to a server at `address`, waiting for the instruction in between.
+
+  Returns:
+    dict: Round trip percentiles in microseconds and round trips per second
+  '''
+  stop = Event()
+  server = Process(target=answer, args=(address, stop), daemon=True)
+  server.start()
+
+  with ModelBridgeClient(address=address, codecs=codecs) as client:
+    while not client.connect():
+      time.sleep(0.01)
+
+    times = []
+    start = time.perf_counter()
+    for state in states:
+      sent = time.perf_counter()
+      client.send_state(state)
+      while not client.listen():
+        time.sleep(0)
+      times.append(time.perf_counter() - sent)
+    total = time.perf_counter() - start
+
+  stop.set()
+  server.join()
+
+  # The first round trips include the codec handshake
+  times = sorted(times[10:])
+  return {
+    'address': address,
+    'p50_us': 1e6*percentile(times, 0.5),
+    'p99_us': 1e6*percentile(times, 0.99),
+    'per_sec': len(states)/total,
+  }
+
+def run(steps=5000, n_vars=10, n_reports=5, port=57722, codecs=None):
+  states = make_states(steps, n_vars=n_vars, n_reports=n_reports)
+  with tempfile.TemporaryDirectory() as tmp:
+    addresses = [
+      f'tcp://localhost:{port}',
+      f"unix://{os.path.join(tmp, 'mivp.sock')}",
+    ]
+    if shm.SUPPORTED:
+      addresses.append(f"shm://{os.path.join(tmp, 'mivp_shm.sock')}")
+    return [measure(address, states, codecs) for address in addresses]
+
+def print_results(results):
+  print(f"{'transport':>10} {'p50 us':>8} {'p99 us':>8} {'trips/s':>9}")
+  for r in results:
+    transport = r['address'].split('://')[0]
+    print(f"{transport:>10} {r['p50_us']:>8.1f} {r['p99_us']:>8.1f} {r['per_sec']:>9.0f}")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark bridge round trips over TCP loopback, unix sockets and shared memory')
+  parser.add_argument('--steps', type=int, default=5000, help='Number of round trips per transport')
+  parser.add_argument('--vars', type=int, default=10, help='Custom MOOS vars per state')
+  parser.add_argument('--reports', type=int, default=5, help='NODE_REPORTS per state')
+  parser.add_argument('--port', type=int, default=57722, help='Port for the TCP server')
+  parser.add_argument('--codecs', default=None, help='Comma separated codecs for the client to offer')
+  args = parser.parse_args(argv)
+
+  codecs = None
+  if args.codecs is not None:
+    codecs = args.codecs.split(',')
+
+  print(f'Round trips: {args.steps}, custom vars: {args.vars}, node reports: {args.reports}\n')
+  print_results(run(args.steps, args.vars, args.reports, args.port, codecs))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,52 @@
+from mivp_agent.const import KEY_ID, KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE
+
+# Steps between the episode reports posted by the fake pEpisodeManager
+EPISODE_LENGTH = 300
+
+def make_state(vname='agent_11', step=0, n_vars=10, n_reports=5):
+  '''
+  Builds a state dictionary shaped like the ones `BHV_Agent` sends: the nav fields, `NODE_REPORTS` for `n_reports` other vehicles, the `pEpisodeManager` vars, the flag / tag vars used by the aquaticus examples and `n_vars` custom vars. Consecutive steps change the nav fields and half of the custom vars, like a vehicle moving through a mostly static world.
+
+  Args:
+    vname (str): The vehicle name
+    step (int): The helm iteration the state is for
+    n_vars (int): Number of custom MOOS vars to include
+    n_reports (int): Number of other vehicles in `NODE_REPORTS`
+  '''
+  t = 1000.0 + step*0.25
+  state = {
+    KEY_ID: vname,
+    'MOOS_TIME': t,
+    'NAV_X': 50.0 + (step % 400)*0.5,
+    'NAV_Y': -40.0 + (step % 300)*0.25,
+    'NAV_HEADING': float(step % 360),
+    'NODE_REPORTS': {},
+    KEY_EPISODE_MGR_REPORT: None,
+    KEY_EPISODE_MGR_STATE: 'RUNNING',
+    'TAGGED': False,
+    'HAS_FLAG': step % EPISODE_LENGTH > EPISODE_LENGTH // 2,
+    'ONFIELD': True,
+  }
+
+  episode = step // EPISODE_LENGTH
+  if episode > 0:
+    state[KEY_EPISODE_MGR_REPORT] = f'NUM={episode-1},DURATION=75.0,SUCCESS=false,WILL_PAUSE=false'
+
+  for i in range(n_reports):
+    state['NODE_REPORTS'][f'drone_{21+i}'] = {
+      'NAV_X': 100.0 - (step % 200)*0.5 + i,
+      'NAV_Y': -20.0 + i*10,
+      'NAV_HEADING': float((180 + step) % 360),
+      'MOOS_TIME': t
+    }
+
+  for i in range(n_vars):
+    if i % 2 == 0:
+      state[f'CUSTOM_VAR_{i}'] = step*0.1 + i
+    else:
+      state[f'CUSTOM_VAR_{i}'] = f'mode_{i}'
+
+  return state
+
+def make_states(steps, vname='agent_11', n_vars=10, n_reports=5):
+  return [make_state(vname, i, n_vars, n_reports) for i in range(steps)]
@@ -1,65 +1,221 @@
+import os
+import stat
+import array
 import socket
-import pickle
+import platform
+import select
+import selectors
 import struct
 import sys
+import time
 import traceback
+from collections import deque
+from urllib.parse import urlsplit
 
 from mivp_agent.util.validate import validateInstruction, validateState
 from mivp_agent.util.parse import parse_report
 from mivp_agent.const import KEY_EPISODE_MGR_REPORT
+from mivp_agent import codec
+from mivp_agent import shm
+from mivp_agent.util import trace
+from mivp_agent.codec import CODECS, CODEC_TAGS, DEFAULT_CODECS, TAG_CONTROL, CodecError
 
 HEADER_SIZE=4
+# The header and the codec tag
+FRAME_OVERHEAD=HEADER_SIZE+1
 MAX_BUFFER_SIZE=8192
+# Largest frame a FrameReader accepts, a longer header closes the connection before any memory is set aside for it
+MAX_FRAME_SIZE=16*1024*1024
+DEFAULT_PORT=57721
 
-def recv_full(connection):
-  messages = []
-  current_len = None
-  last_read = None
-  total_read = None
-  # Create byte string for storing the header in
-  tmp_data = b''
-
-  tmp_data = connection.recv(MAX_BUFFER_SIZE)
-  last_read = len(tmp_data)
-  total_read = last_read
-
-  # If buffer read was full, call until not full
-  # Attempt to empty the recv queue
-  while last_read == MAX_BUFFER_SIZE:
-    print('WARNING: ModelBridge got max buffer size', file=sys.stderr)
-
-  # While we have data to process into messages
-  while len(tmp_data) != 0:
-    # Get more data if message is incomplete
-    if (current_len is None and len(tmp_data) < HEADER_SIZE) or (current_len is not None and len(tmp_data) < current_len): 
-      orig_timeout = connection.gettimeout()
-      connection.settimeout(None)
-      tmp_data += connection.recv(MAX_BUFFER_SIZE)
-      connection.settimeout(orig_timeout)
-      
-      last_read = len(tmp_data)
-      total_read += last_read
-
-    if current_len is None:
-      # We should be looking for a header
-      if len(tmp_data) >= HEADER_SIZE:
-        # We can construct a header (current_len)
-        current_len = struct.unpack('>i', tmp_data[:HEADER_SIZE])[0]
-        # Remove header data from our data store
-        tmp_data = tmp_data[HEADER_SIZE:]
-    
-    # Not else b/c previous clause might have constructed it
-    if current_len is not None:
-      # We should be looking for a message
-      if len(tmp_data) >= current_len:
-        # We can construct a packed
-        messages.append(tmp_data[:current_len])
-
-        # Remove the packet just constructed from out data store
-        tmp_data = tmp_data[current_len:]
-        current_len = None # Signal we are looking for another header
-
-  return messages
+SCHEME_TCP='tcp'
+SCHEME_UNIX='unix'
+SCHEME_SHM='shm'
+
+# Longest a server sleeps while shm clients are connected, see ModelBridgeServer.select()
+SHM_MAX_SLEEP=0.01
+# Longest, from connecting, that a client's send_state() waits for the server to choose a codec
+HANDSHAKE_TIMEOUT=1.0
+
+def parse_address(address):
+  '''
+  Args:
+    address (str): Either `tcp://host:port`, `unix:///path/to/socket` or `shm:///path/to/socket`. A socket path without the leading `/` is relative to the working directory. With `shm://` the unix socket at the path only sets up the connection, frames are passed through shared memory.
+  Returns:
+    tuple: The socket family and the address to bind or connect to
+  '''
+  parts = urlsplit(address)
+  if parts.scheme == SCHEME_SHM and not shm.SUPPORTED:
+    raise ValueError(f"'{SCHEME_SHM}://' needs an x86-64 CPU (see mivp_agent.shm), use '{SCHEME_UNIX}://' on this {platform.machine()} machine")
+  if parts.scheme in (SCHEME_UNIX, SCHEME_SHM):
+    path = parts.netloc + parts.path
+    if path == '':
+      raise ValueError(f"Unix address '{address}' has no socket path")
+    return socket.AF_UNIX, path
+  if parts.scheme == SCHEME_TCP:
+    if parts.hostname is None:
+      raise ValueError(f"TCP address '{address}' has no host")
+    port = parts.port
+    if port is None:
+      port = DEFAULT_PORT
+    family = socket.AF_INET6 if ':' in parts.hostname else socket.AF_INET
+    return family, (parts.hostname, port)
+  raise ValueError(f"Unknown scheme in address '{address}', use '{SCHEME_TCP}://', '{SCHEME_UNIX}://' or '{SCHEME_SHM}://'")
+
+# Lets clients created without an address (like the one in BHV_Agent) find a
+# manager which was given one, or which let the OS pick its port
+ENV_ADDRESS='MIVP_AGENT_ADDRESS'
+ENV_ADDRESS_FILE='MIVP_AGENT_ADDRESS_FILE'
+
+def env_address():
+  '''
+  Returns:
+    str: The address in the `MIVP_AGENT_ADDRESS` environment variable, otherwise the one in the file named by `MIVP_AGENT_ADDRESS_FILE` (see `write_address()`), or `None` if there is neither
+  '''
+  address = os.environ.get(ENV_ADDRESS, '').strip()
+  if address != '':
+    return address
+  path = os.environ.get(ENV_ADDRESS_FILE, '').strip()
+  if path == '':
+    return None
+  return read_address(path)
+
+def read_address(path):
+  '''
+  Returns:
+    str: The address written to `path` by `write_address()` or `None` if there is none
+  '''
+  try:
+    with open(path) as f:
+      address = f.read().strip()
+  except FileNotFoundError:
+    return None
+  if address == '':
+    return None
+  return address
+
+def write_address(path, address):
+  # Replaced in one step so readers never see half an address
+  tmp = f'{path}.{os.getpid()}.tmp'
+  with open(tmp, 'w') as f:
+    f.write(f'{address}\n')
+  os.replace(tmp, path)
+
+def tcp_address(hostname, port):
+  if ':' in hostname:
+    hostname = f'[{hostname}]'
+  return f'{SCHEME_TCP}://{hostname}:{port}'
+
+def shard_address(address, index):
+  '''
+  Args:
+    address (str): The address of a sharded `MissionManager`, see `parse_address()`
+    index (int): Number of the shard counting from 1
+  Returns:
+    str: The address of the shard, `index` ports above a TCP address (unless the port is `0` which lets the OS pick) or the socket path with `.<index>` appended
+  '''
+  family, bind_addr = parse_address(address)
+  scheme = urlsplit(address).scheme
+  if family == socket.AF_UNIX:
+    return f'{scheme}://{bind_addr}.{index}'
+  host, port = bind_addr
+  if port != 0:
+    port += index
+  return tcp_address(host, port)
+
+class FrameReader:
+  '''
+  Reads length prefixed frames from a non-blocking socket into a persistent receive buffer. Partial frames are kept between calls to `read()` and the buffer is only compacted or grown when it runs out of room, so each byte is copied out of the buffer once.
+  '''
+  def __init__(self, size=MAX_BUFFER_SIZE, max_frame=MAX_FRAME_SIZE):
+    self._buffer = bytearray(size)
+    self._max_frame = max_frame
+    self._view = memoryview(self._buffer)
+    self._start = 0 # First byte which has not been parsed into a frame
+    self._end = 0 # One past the last byte received
+
+    # Set once the peer has hung up
+    self.closed = False
+
+  def read(self, connection):
+    '''
+    Reads all data currently available on the connection.
+
+    Args:
+      connection (socket): A non-blocking socket
+    Returns:
+      list: The complete frames received as `bytes` objects. This list can be empty if only part of a frame is available.
+    '''
+    frames = []
+    while not self.closed:
+      if self._end == len(self._buffer):
+        self._make_room()
+
+      try:
+        read = connection.recv_into(self._view[self._end:])
+      except BlockingIOError:
+        break
+      except ConnectionError:
+        read = 0
+
+      if read == 0:
+        self.closed = True
+        break
+
+      self._end += read
+      self._parse(frames)
+
+      # A short read means the socket has been drained
+      if self._end != len(self._buffer):
+        break
+
+    return frames
+
+  def _parse(self, frames):
+    while self._end - self._start >= HEADER_SIZE:
+      length = struct.unpack_from('>i', self._buffer, self._start)[0]
+      if length < 0:
+        # Not something send_full() would produce, stop trusting this stream
+        self.closed = True
+        break
+      if length > self._max_frame:
+        print(f'WARNING: Closing connection sending a frame of {length} bytes, more than the limit of {self._max_frame}', file=sys.stderr)
+        self.closed = True
+        break
+
+      frame_start = self._start + HEADER_SIZE
+      frame_end = frame_start + length
+      if frame_end > self._end:
+        break
+
+      frames.append(bytes(self._view[frame_start:frame_end]))
+      self._start = frame_end
+
+    # Rewind for free when everything has been consumed
+    if self._start == self._end:
+      self._start = 0
+      self._end = 0
+
+  def _make_room(self):
+    unparsed = self._end - self._start
+
+    # Make sure the buffer can hold all of the next frame if the header is here
+    needed = unparsed + 1
+    if unparsed >= HEADER_SIZE:
+      needed = max(needed, HEADER_SIZE + struct.unpack_from('>i', self._buffer, self._start)[0])
+
+    if needed <= len(self._buffer):
+      # Move the partial frame to the front of the buffer
+      self._view[:unparsed] = self._view[self._start:self._end]
+    else:
+      buffer = bytearray(max(needed, 2*len(self._buffer)))
+      buffer[:unparsed] = self._view[self._start:self._end]
+      self._view.release()
+      self._buffer = buffer
+      self._view = memoryview(self._buffer)
+
+    self._start = 0
+    self._end = unparsed
 
 
 def send_full(connection, data):
@@ -71,137 +227,839 @@ def send_full(connection, data):
   result = connection.sendall(packed_size+data)
   assert result is None
 
+def send_fds(sock, buffers, fds):
+  '''
+  Sends `buffers` along with the file descriptors `fds` over a unix socket, like `socket.send_fds()` which needs Python 3.9.
+  '''
+  return sock.sendmsg(buffers, [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+def recv_fds(sock, bufsize, maxfds):
+  '''
+  Receives up to `bufsize` bytes and `maxfds` file descriptors from a unix socket, like `socket.recv_fds()` which needs Python 3.9.
+
+  Returns:
+    tuple: The data, the list of file descriptors, the message flags and the address
+  '''
+  fds = array.array('i')
+  msg, ancdata, flags, addr = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds*fds.itemsize))
+  for level, kind, data in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+  return msg, list(fds), flags, addr
+
+def send_frame(connection, tag, data):
+  '''
+  Same as `send_full()` with the one byte codec `tag` at the start of the frame.
+  '''
+  header = struct.pack('>iB', len(data)+1, tag)
+  result = connection.sendall(header+data)
+  assert result is None
+
+def remove_socket_file(path):
+  try:
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+  except FileNotFoundError:
+    pass
+
+class BridgeConnection:
+  '''
+  Holds everything one end of the bridge needs for a single socket: the frame reader, any frames read but not yet handed out and the codecs used in each direction.
+  '''
+  def __init__(self, sock, codecs):
+    self.sock = sock
+    self.reader = FrameReader()
+    self.backlog = deque()
+
+    # Codecs which we are willing to decode, in order of preference
+    self.codecs = codecs
+    # Until the handshake completes send with our most preferred codec
+    self.codec = CODECS[codecs[0]]()
+    self._decoders = {}
+    # Servers hold instructions here until the client's offer arrives
+    self.held = None
+
+  def use(self, name):
+    if name not in self.codecs:
+      raise CodecError(f"Peer chose codec '{name}' which was not offered")
+    if self.codec.name != name:
+      self.codec = CODECS[name]()
+
+  def decoder(self, tag):
+    decoder = self._decoders.get(tag)
+    if decoder is None:
+      if tag not in CODEC_TAGS or CODEC_TAGS[tag].name not in self.codecs:
+        raise CodecError(f'Received frame with unaccepted codec tag {tag}')
+      decoder = CODEC_TAGS[tag]()
+      self._decoders[tag] = decoder
+    return decoder
+
+  def ready(self):
+    '''
+    Returns:
+      bool: `True` if there are frames to handle which will not make the socket readable
+    '''
+    return len(self.backlog) != 0
+
+  def send(self, data):
+    send_frame(self.sock, self.codec.tag, data)
+
+  def send_control(self, data):
+    send_frame(self.sock, TAG_CONTROL, data)
+
+  def read(self):
+    '''
+    Returns:
+      list: `(tag, body)` tuples for every frame received, `body` is a memoryview
+    '''
+    frames = []
+    for frame in self.reader.read(self.sock):
+      if len(frame) == 0:
+        continue
+      frames.append((frame[0], memoryview(frame)[1:]))
+    return frames
+
+  def close(self):
+    self.sock.close()
+
+# Sent by shm clients along with the shared memory file: magic, slots and slot size
+SHM_SETUP = struct.Struct('>4sII')
+SHM_MAGIC = b'MVSH'
+
+class ShmConnection(BridgeConnection):
+  '''
+  A `BridgeConnection` which passes frames through a pair of `mivp_agent.shm.ShmRing`s. The unix socket stays open to hand over the shared memory, to wake a sleeping server with empty frames and to notice when the peer hangs up.
+
+  Clients create the shared memory when connecting. Servers attach to it once the setup message arrives and keep anything sent before that.
+  '''
+  def __init__(self, sock, codecs, is_client):
+    super().__init__(sock, codecs)
+    self._rings = None
+    self._unsent = []
+
+    if is_client:
+      slots, slot_size = shm.DEFAULT_SLOTS, shm.DEFAULT_SLOT_SIZE
+      fd = shm.create_file(2*shm.ring_size(slots, slot_size))
+      try:
+        send_fds(sock, [SHM_SETUP.pack(SHM_MAGIC, slots, slot_size)], [fd])
+        self._rings = shm.ShmRings(fd, slots, slot_size, is_client=True)
+      finally:
+        os.close(fd)
+
+  def _attach(self):
+    try:
+      msg, fds, _, _ = recv_fds(self.sock, SHM_SETUP.size, 1)
+    except BlockingIOError:
+      return
+    except ConnectionError:
+      msg, fds = b'', []
+
+    try:
+      if len(msg) == 0:
+        self.reader.closed = True
+        return
+      if len(msg) != SHM_SETUP.size or len(fds) != 1:
+        raise CodecError('Malformed shared memory setup')
+      magic, slots, slot_size = SHM_SETUP.unpack(msg)
+      if magic != SHM_MAGIC:
+        raise CodecError('Malformed shared memory setup')
+      self._rings = shm.ShmRings(fds[0], slots, slot_size, is_client=False)
+    finally:
+      for fd in fds:
+        os.close(fd)
+
+    for tag, data in self._unsent:
+      self._push(tag, data)
+    self._unsent = []
+
+  def _push(self, tag, data):
+    if self._rings is None:
+      self._unsent.append((tag, data))
+      return
+    try:
+      wake = self._rings.tx.push(tag, data)
+    except ConnectionError:
+      # A peer which lets the ring fill up is stuck, hang up instead of waiting on it
+      try:
+        self.sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      raise
+    if wake:
+      # Ring the doorbell, a full socket means the peer has plenty of those
+      try:
+        send_full(self.sock, b'')
+      except BlockingIOError:
+        pass
+
+  def send(self, data):
+    self._push(self.codec.tag, data)
+
+  def send_control(self, data):
+    self._push(TAG_CONTROL, data)
+
+  def ready(self):
+    '''
+    Returns:
+      bool: `True` if frames are ready, otherwise the peer will wake our socket after its next frame
+    '''
+    if len(self.backlog) != 0:
+      return True
+    if self._rings is None:
+      return False
+    return self._rings.rx.wait()
+
+  def read(self):
+    if self._rings is None:
+      self._attach()
+      if self._rings is None:
+        return []
+
+    frames = self._rings.rx.pop_all()
+    if len(frames) == 0:
+      # Clear out doorbells and check for a hang up only when idle
+      self.reader.read(self.sock)
+      frames = self._rings.rx.pop_all()
+    return [(tag, memoryview(data)) for tag, data in frames]
+
+  def close(self):
+    super().close()
+    if self._rings is not None:
+      self._rings.close()
+      self._rings = None
+
 class ModelBridgeServer:
-  def __init__(self, hostname="localhost", port=57721, max_listen=None):
-    self.host = hostname
-    self.port = port
-
-    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Line below reuses the socket address if previous socket closed but improperly
-    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    self._socket.bind((self.host, self.port))
+  def __init__(self, hostname="localhost", port=DEFAULT_PORT, max_listen=None, codecs=DEFAULT_CODECS, address=None, tracer=None):
+    '''
+    With port `0` the OS picks a free port, the `port` and `address` attributes hold the one picked.
+
+    Args:
+      codecs (tuple): Names of the codecs (see `mivp_agent.codec`) clients may use, in order of preference. Leave out `'pickle'` to refuse pickled data from the network.
+      address (str): Listen on this address instead of `hostname` and `port`, see `parse_address()`. Use `unix:///path/to/socket` when the vehicles run on the same machine.
+      tracer (Tracer): Records spans of accepting clients, reading from them, decoding states and sending instructions, see `mivp_agent.util.trace`
+    '''
+    if address is None:
+      address = tcp_address(hostname, port)
+    self.address = address
+    self._family, self._bind_addr = parse_address(address)
+    self._shm = urlsplit(address).scheme == SCHEME_SHM
+    self.host = None
+    self.port = None
+    if self._family != socket.AF_UNIX:
+      self.host, self.port = self._bind_addr
+    self._codecs = codec.check_codecs(codecs)
+    self._tracer = tracer
+
+    self._socket = socket.socket(self._family, socket.SOCK_STREAM)
+    if self._family == socket.AF_UNIX:
+      # A server which was not closed properly leaves its socket file behind
+      remove_socket_file(self._bind_addr)
+    else:
+      # Line below reuses the socket address if previous socket closed but improperly
+      self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind(self._bind_addr)
     self._socket.settimeout(0.0) # We will handle the errors from this
+    if self.port == 0:
+      # Picked by the OS, let others know where to find us
+      self.port = self._socket.getsockname()[1]
+      self.address = tcp_address(self.host, self.port)
 
+    # Large backlog so a fleet of vehicles connecting at once is not refused
     if max_listen is None:
-      max_listen = 0
+      max_listen = socket.SOMAXCONN
 
     self._socket.listen(max_listen)
     self._clients = {}
+    # Frame bytes, headers included, received from and sent to all clients
+    self.bytes_received = 0
+    self.bytes_sent = 0
+    # Sockets passed to hand_off() which accept() has taken
+    self.handoffs = 0
+    # Unix socket clients have no address of their own, these number them
+    self._unix_count = 0
+
+    # The selector lets select() sleep until a socket has something for us
+    self._selector = selectors.DefaultSelector()
+    self._selector.register(self._socket, selectors.EVENT_READ, None)
+
+    # Other threads write to this pair through wakeup() to interrupt select()
+    self._wake_r, self._wake_w = socket.socketpair()
+    self._wake_r.setblocking(False)
+    self._wake_w.setblocking(False)
+    # Set from the first wakeup() until select() drains the pair, later calls skip the syscall
+    self._wake_pending = False
+    self._selector.register(self._wake_r, selectors.EVENT_READ, self._wake_r)
+    self._wake_socks = {self._wake_r}
+
+    # Accepted sockets passed to us by hand_off(), from this or another process
+    self._handoff_r, self._handoff_w = socket.socketpair()
+    self._handoff_socks = set()
+    self.add_handoff(self._handoff_r)
+    self._handed = deque()
+    # Connections moved here by adopt(), as (addr, connection)
+    self._adopted = deque()
+    # Addresses of the clients disconnected since the last hung_up_all()
+    self._hung_up = []
 
   def __enter__(self):
     return self
 
   def accept(self):
-    # Accept any connection
+    # Take connections handed off to us first, then any new connection
+    while len(self._handed) != 0:
+      conn = self._handed.popleft()
+      self.handoffs += 1
+      try:
+        addr = conn.getpeername()
+      except OSError:
+        # Hung up before we got to it
+        conn.close()
+        continue
+      return self._add_client(conn, addr)
+
     try:
       conn, addr = self._socket.accept()
-      assert addr not in self._clients
-
-      conn.settimeout(0.0)
-      self._clients[addr] = conn
     except BlockingIOError:
-      return None 
+      return None
+    return self._add_client(conn, addr)
+
+  def _add_client(self, conn, addr):
+    if self._tracer is not None:
+      start = trace.now()
+    conn.settimeout(0.0)
+    if conn.family == socket.AF_UNIX:
+      addr = (self._bind_addr, self._unix_count)
+      self._unix_count += 1
+    else:
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    assert addr not in self._clients
 
+    if self._shm:
+      self._clients[addr] = ShmConnection(conn, self._codecs, is_client=False)
+    else:
+      self._clients[addr] = BridgeConnection(conn, self._codecs)
+    self._selector.register(conn, selectors.EVENT_READ, addr)
+    self._clients[addr].held = []
+    if self._tracer is not None:
+      self._tracer.complete('accept', start, trace.CAT_BRIDGE, {'addr': str(addr)})
     return addr
 
+  def client_count(self):
+    '''
+    Returns:
+      int: The number of clients currently connected
+    '''
+    return len(self._clients)
+
+  def accept_all(self):
+    '''
+    Accepts every connection currently pending on the listening socket or passed to `hand_off()`.
+
+    Returns:
+      list: The addresses of the newly connected clients (can be empty)
+    '''
+    addrs = []
+    addr = self.accept()
+    while addr is not None:
+      addrs.append(addr)
+      addr = self.accept()
+    return addrs
+
+  def accept_sockets(self):
+    '''
+    Accepts every connection currently pending on the listening socket without taking them on as clients, so they can be passed to other servers with `hand_off()`.
+
+    Returns:
+      list: The accepted sockets (can be empty)
+    '''
+    socks = []
+    while True:
+      try:
+        sock, _ = self._socket.accept()
+      except BlockingIOError:
+        return socks
+      socks.append(sock)
+
+  def hand_off(self, sock):
+    '''
+    Passes a socket accepted elsewhere, for example by another server's `accept_sockets()`, to this server where `accept_all()` returns it like a new connection. Closes `sock`, the server gets its own copy. Safe to call from any thread.
+    '''
+    try:
+      send_fds(self._handoff_w, [b'\x00'], [sock.fileno()])
+    finally:
+      sock.close()
+
+  def add_handoff(self, sock):
+    '''
+    Lets another process pass accepted sockets to `accept_all()` by sending their file descriptors over its end of the connected unix socket `sock`, as `hand_off()` does within a process.
+    '''
+    sock.setblocking(False)
+    self._selector.register(sock, selectors.EVENT_READ, sock)
+    self._handoff_socks.add(sock)
+
+  def _receive_handoffs(self, sock):
+    while True:
+      try:
+        msg, fds, _, _ = recv_fds(sock, MAX_BUFFER_SIZE, 64)
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError:
+        msg, fds = b'', []
+      for fd in fds:
+        self._handed.append(socket.socket(fileno=fd))
+      if len(msg) == 0:
+        # The other process is gone
+        self._selector.unregister(sock)
+        self._handoff_socks.discard(sock)
+        return
+
+  def detach(self, addr):
+    '''
+    Removes the client at `addr` without closing its connection, so it can be given to another server in this process with `adopt()`.
+
+    Returns:
+      obj: The client's connection
+    '''
+    if addr not in self._clients:
+      raise RuntimeError('Address not in client list')
+    conn = self._clients.pop(addr)
+    self._selector.unregister(conn.sock)
+    return conn
+
+  def adopt(self, addr, conn):
+    '''
+    Takes on a connection removed from another server with `detach()`, keeping its codecs and the states in its backlog. Unlike new connections it is not returned by `accept_all()`, `select()` reports it ready once it has states. Safe to call from any thread.
+    '''
+    self._adopted.append((addr, conn))
+    self.wakeup()
+
+  def _take_adopted(self):
+    while len(self._adopted) != 0:
+      addr, conn = self._adopted.popleft()
+      assert addr not in self._clients
+      self._clients[addr] = conn
+      self._selector.register(conn.sock, selectors.EVENT_READ, addr)
+
+  def select(self, timeout=None):
+    '''
+    Blocks until a new connection is pending, a client has sent data, `wakeup()` is called, or the timeout expires.
+
+    Args:
+      timeout (float): Maximum time in seconds to block for, `None` blocks indefinitely
+    Returns:
+      tuple: A bool which is `True` if `accept_all()` has connections to accept and a list of client addresses which are ready for `listen()`
+    '''
+    self._take_adopted()
+    if len(self._clients) == 0:
+      return self._select(timeout)[:2]
+
+    # States already read (by send_instr() or listen()) and frames in shared
+    # memory do not make a socket readable. Shm clients only ring our socket
+    # if they see that we are asleep, which they can miss, so their rings are
+    # checked again at least every SHM_MAX_SLEEP seconds.
+    deadline = None
+    if timeout is not None:
+      deadline = time.monotonic() + timeout
+    while True:
+      ready = [addr for addr, conn in self._clients.items() if conn.ready()]
+      sleep = timeout
+      if len(ready) != 0:
+        sleep = 0
+      elif self._shm:
+        sleep = SHM_MAX_SLEEP
+        if deadline is not None:
+          sleep = max(0, min(sleep, deadline - time.monotonic()))
+
+      accept_ready, readable, woken = self._select(sleep)
+      for addr in readable:
+        if addr not in ready:
+          ready.append(addr)
+      if not self._shm or accept_ready or woken or len(ready) != 0:
+        return accept_ready, ready
+      if deadline is not None and time.monotonic() >= deadline:
+        return False, []
+
+  def _select(self, timeout):
+    accept_ready = False
+    woken = False
+    readable = []
+    for key, _ in self._selector.select(timeout):
+      if key.data is None:
+        accept_ready = True
+      elif key.data in self._wake_socks:
+        self._drain_wakeup(key.data)
+        woken = True
+      elif key.data in self._handoff_socks:
+        self._receive_handoffs(key.data)
+      else:
+        readable.append(key.data)
+    if len(self._handed) != 0:
+      accept_ready = True
+    return accept_ready, readable, woken
+
+  def wakeup(self):
+    '''
+    Interrupts a call to `select()` blocking in another thread. Safe to call from any thread.
+    '''
+    if self._wake_pending:
+      return
+    self._wake_pending = True
+    try:
+      self._wake_w.send(b'\x00')
+    except (BlockingIOError, OSError):
+      # Either a wakeup is already pending or the server is closed
+      pass
+
+  def add_wakeup(self, sock):
+    '''
+    Lets another process interrupt `select()` by writing to its end of the connected socket `sock`, like `wakeup()` does within a process. Whatever is written is discarded.
+    '''
+    sock.setblocking(False)
+    self._selector.register(sock, selectors.EVENT_READ, sock)
+    self._wake_socks.add(sock)
+
+  def _drain_wakeup(self, sock):
+    try:
+      while sock.recv(MAX_BUFFER_SIZE):
+        pass
+      if sock is not self._wake_r:
+        # Closed by the other process, stop watching it
+        self._selector.unregister(sock)
+        self._wake_socks.discard(sock)
+    except (BlockingIOError, OSError):
+      pass
+    # Only cleared after draining, anything a skipped wakeup() was for is
+    # handled by our caller after select() returns
+    if sock is self._wake_r:
+      self._wake_pending = False
+
   def send_instr(self, addr, instr):
     if addr not in self._clients:
       raise RuntimeError('Address not in client list')
 
     validateInstruction(instr)
-    send_full(self._clients[addr], pickle.dumps(instr))
+    conn = self._clients[addr]
+    if conn.held is not None:
+      # The client may not be able to decode our first choice of codec, look
+      # for its offer. States read meanwhile wait in the backlog for listen().
+      # Hang ups are left for listen() so those states are not lost.
+      conn.backlog.extend(self._read_states(addr, hang_up=False))
+      if addr not in self._clients:
+        return False
+    if conn.held is not None:
+      conn.held.append(instr)
+      return True
+    if self._tracer is not None:
+      start = trace.now()
+    try:
+      data = conn.codec.encode_instr(instr)
+      conn.send(data)
+      self.bytes_sent += len(data) + FRAME_OVERHEAD
+    except ConnectionError:
+      # The socket stays readable, listen() hangs up after reading what the client sent before closing
+      return False
+    if self._tracer is not None:
+      self._tracer.complete('send', start, trace.CAT_BRIDGE, {'addr': str(addr)})
     return True
 
   def listen(self, addr):
+    '''
+    Returns:
+      dict: The oldest state received from the client at `addr` or `None` if there is not one. Any other states received are kept for the following calls.
+    '''
     if addr not in self._clients:
       raise RuntimeError('Address not in client list')
 
-    try:
-      msgs = recv_full(self._clients[addr])
-    except BlockingIOError:
-      return None 
+    backlog = self._clients[addr].backlog
+    if len(backlog) == 0:
+      backlog.extend(self._read_states(addr))
+    if len(backlog) == 0:
+      return None
+
+    return backlog.popleft()
 
-    assert len(msgs) == 1, 'State should only come one at a time'
-    state = pickle.loads(msgs[0])
+  def listen_all(self, addr):
+    '''
+    Returns:
+      list: Every state received from the client at `addr` in the order they were sent. Can be empty.
+    '''
+    if addr not in self._clients:
+      raise RuntimeError('Address not in client list')
+
+    backlog = self._clients[addr].backlog
+    states = list(backlog)
+    backlog.clear()
+    states.extend(self._read_states(addr))
+    return states
+
+  def codec(self, addr):
+    '''
+    Returns:
+      str: The name of the codec used with the client at `addr`
+    '''
+    if addr not in self._clients:
+      raise RuntimeError('Address not in client list')
+    return self._clients[addr].codec.name
+
+  def _read_states(self, addr, hang_up=True):
+    conn = self._clients[addr]
+    tracer = self._tracer
+    if tracer is not None:
+      start = trace.now()
+    frames = conn.read()
+    if tracer is not None:
+      tracer.complete('recv', start, trace.CAT_BRIDGE, {'addr': str(addr), 'frames': len(frames)})
+
+    # Hang up after reading so states sent right before closing are kept
+    if hang_up and conn.reader.closed:
+      self.disconnect(addr)
+
+    states = []
+    for tag, data in frames:
+      self.bytes_received += len(data) + FRAME_OVERHEAD
+      try:
+        if tag == TAG_CONTROL:
+          self._handle_control(conn, data)
+          continue
+        if tracer is not None:
+          start = trace.now()
+        state = conn.decoder(tag).decode_state(data)
+        if tracer is not None:
+          tracer.complete('decode', start, trace.CAT_BRIDGE, {'bytes': len(data)})
+      except Exception as e:
+        # Anything could arrive from the network, drop clients we can't understand
+        print(f'WARNING: ModelBridgeServer dropping client {addr}: {e}', file=sys.stderr)
+        if addr in self._clients:
+          self.disconnect(addr)
+        break
 
-    if state[KEY_EPISODE_MGR_REPORT] is not None:
-      state[KEY_EPISODE_MGR_REPORT] = parse_report(state[KEY_EPISODE_MGR_REPORT])
+      if state[KEY_EPISODE_MGR_REPORT] is not None:
+        state[KEY_EPISODE_MGR_REPORT] = parse_report(state[KEY_EPISODE_MGR_REPORT])
 
-    return state
+      states.append(state)
+    return states
+
+  def _handle_control(self, conn, data):
+    msg = codec.parse_control(data)
+    if msg['type'] != 'hello':
+      raise CodecError(f"Unexpected control message '{msg['type']}'")
+
+    name = codec.negotiate(msg['codecs'], self._codecs)
+    if name is None:
+      raise CodecError(f"No codec in common with client offer {msg['codecs']}")
+
+    conn.use(name)
+    held, conn.held = conn.held, None
+    try:
+      conn.send_control(codec.choice(name))
+      for instr in held or ():
+        data = conn.codec.encode_instr(instr)
+        conn.send(data)
+        self.bytes_sent += len(data) + FRAME_OVERHEAD
+    except ConnectionError:
+      # Client already hung up, still decode anything it sent before that
+      pass
+
+  def disconnect(self, addr):
+    conn = self._clients.pop(addr)
+    self._selector.unregister(conn.sock)
+    conn.close()
+    self._hung_up.append(addr)
+
+  def hung_up_all(self):
+    '''
+    Returns:
+      list: The addresses of the clients disconnected since the last call (can be empty)
+    '''
+    addrs, self._hung_up = self._hung_up, []
+    return addrs
 
   def close_clients(self):
-    for client in self._clients:
-      self._clients[client].close()
+    for addr in list(self._clients):
+      self.disconnect(addr)
 
   def close(self):
     self.close_clients()
     if self._socket is not None:
+      self._selector.close()
       self._socket.close()
+      self._wake_r.close()
+      self._wake_w.close()
+      self._handoff_r.close()
+      self._handoff_w.close()
+      for conn in self._handed:
+        conn.close()
+      for _, conn in self._adopted:
+        conn.close()
+      self._socket = None
+      if self._family == socket.AF_UNIX:
+        remove_socket_file(self._bind_addr)
   
   def __exit__(self, exc_type, exc_value, traceback):
     self.close()
 
 class ModelBridgeClient:
-  def __init__(self, hostname="localhost", port=57721):
-    self.host = hostname
-    self.port = port
+  def __init__(self, hostname=None, port=None, codecs=None, address=None):
+    '''
+    Args:
+      hostname (str): Host to connect to, `localhost` if `None`
+      port (int): Port to connect to, `DEFAULT_PORT` if `None`
+      codecs (tuple): Names of the codecs (see `mivp_agent.codec`) to offer the server, in order of preference. Defaults to the `MIVP_AGENT_CODECS` environment variable, see `mivp_agent.codec.env_codecs()`.
+      address (str): Connect to this address instead of `hostname` and `port`, see `parse_address()`. When none of `address`, `hostname` and `port` are given the address comes from the environment (see `env_address()`). One read from `MIVP_AGENT_ADDRESS_FILE` is read again before each `connect()` so the client can start before the manager writes it.
+    '''
+    # Set when the address comes from a file which the manager may not have written yet
+    self._address_file = None
+    if address is None and hostname is None and port is None:
+      address = env_address()
+      if os.environ.get(ENV_ADDRESS, '').strip() == '':
+        self._address_file = os.environ.get(ENV_ADDRESS_FILE, '').strip() or None
+    if address is None:
+      if hostname is None:
+        hostname = 'localhost'
+      if port is None:
+        port = DEFAULT_PORT
+      address = tcp_address(hostname, port)
+    self._set_address(address)
+
+    if codecs is None:
+      codecs = codec.env_codecs()
+    self._codecs = codec.check_codecs(codecs)
 
-    self._socket = None
+    self._conn = None
+    self._choice_deadline = None
   
+  def _set_address(self, address):
+    self.address = address
+    self._family, self._server_addr = parse_address(address)
+    self._shm = urlsplit(address).scheme == SCHEME_SHM
+    self.host = None
+    self.port = None
+    if self._family != socket.AF_UNIX:
+      self.host, self.port = self._server_addr
+
   def __enter__(self):
     return self
 
   def is_connected(self):
-    return self._socket is not None
+    return self._conn is not None
 
   def connect(self):
-    if self._socket is not None:
+    if self._conn is not None:
       raise RuntimeError("Clients should not be connect more than once")
 
-    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if self._address_file is not None:
+      address = read_address(self._address_file)
+      if address is not None and address != self.address:
+        self._set_address(address)
+
+    sock = socket.socket(self._family, socket.SOCK_STREAM)
 
     # Attempt connection with timeout
     try:
       # Not 0.0 timeout cause connect is strang with that
-      self._socket.settimeout(0.001)
-      self._socket.connect((self.host, self.port))
-      self._socket.settimeout(0.0)
-    except (socket.timeout, ConnectionRefusedError) as e:
+      sock.settimeout(0.001)
+      sock.connect(self._server_addr)
+      sock.settimeout(0.0)
+      if self._family != socket.AF_UNIX:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (socket.timeout, ConnectionRefusedError, FileNotFoundError) as e:
       # Clean up socket
-      self._socket.close()
-      self._socket = None
+      sock.close()
       # Signal failure in event of timeout
       return False
+
+    # Offer our codecs. The server may not accept our first choice, states
+    # are held until its answer arrives.
+    if self._shm:
+      self._conn = ShmConnection(sock, self._codecs, is_client=True)
+    else:
+      self._conn = BridgeConnection(sock, self._codecs)
+    self._conn.held = []
+    self._choice_deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    self._conn.send_control(codec.hello(self._codecs))
+
     # Return status
     return True
+
+  def codec(self):
+    '''
+    Returns:
+      str: The name of the codec used to send states or `None` if not connected
+    '''
+    if self._conn is None:
+      return None
+    return self._conn.codec.name
   
   def send_state(self, msg):
-    if self._socket is None:
+    '''
+    Sends `msg` to the server. The server may not accept the codec this client prefers, so until it has chosen one this waits for its answer, for at most `HANDSHAKE_TIMEOUT` seconds after connecting. States sent after that without an answer are held, to be sent by a later `send_state()` or `listen()` once it comes.
+
+    Returns:
+      bool: `False` if not connected
+    '''
+    if self._conn is None:
       return False
 
     validateState(msg)
-    send_full(self._socket, pickle.dumps(msg))
+    if self._conn.held is not None:
+      self._wait_choice()
+    if self._conn.held is not None:
+      self._conn.held.append(msg)
+      return True
+    self._conn.send(self._conn.codec.encode_state(msg))
     return True
 
+  def _wait_choice(self):
+    # Waits for the server's choice of codec until the handshake deadline, instructions read meanwhile wait in the backlog
+    while True:
+      self._read()
+      remaining = self._choice_deadline - time.monotonic()
+      if self._conn.held is None or self._conn.reader.closed or remaining <= 0:
+        return
+      if self._shm:
+        # Frames in shared memory do not make the socket readable
+        remaining = min(remaining, SHM_MAX_SLEEP)
+      select.select([self._conn.sock], [], [], remaining)
+
+  def _read(self):
+    conn = self._conn
+    for tag, data in conn.read():
+      if tag == TAG_CONTROL:
+        msg = codec.parse_control(data)
+        if msg['type'] == 'choice':
+          conn.use(msg['codec'])
+          held, conn.held = conn.held, None
+          for state in held or ():
+            conn.send(conn.codec.encode_state(state))
+        continue
+      conn.backlog.append(conn.decoder(tag).decode_instr(data))
+
   def listen(self):
-    if self._socket is None:
+    '''
+    Returns:
+      dict: The oldest instruction received from the server or `False` if there is not one. Also sends any states held until the server chose a codec.
+    '''
+    if self._conn is None:
       return False
 
-    try:
-      msgs = recv_full(self._socket)
-    except BlockingIOError:
+    backlog = self._conn.backlog
+    if len(backlog) == 0:
+      self._read()
+      if self._conn.reader.closed:
+        self.close()
+
+    if len(backlog) == 0:
       return False
-    
-    assert len(msgs) == 1, 'Instructions should only come one at a time'
-    instr = pickle.loads(msgs[0])
 
+    instr = backlog.popleft()
     validateInstruction(instr)
 
     return instr
   
   def close(self):
-    if self._socket is not None:
-      self._socket.close()
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
   
   def __exit__(self, exc_type, exc_value, traceback):
-    self.close()
\ No newline at end of file
+    self.close()
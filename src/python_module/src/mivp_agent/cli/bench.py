@@ -0,0 +1,17 @@
+import sys
+
+from mivp_agent.bench import fleet
+
+class Bench:
+  def __init__(self, parser):
+    self.parser = parser
+    subparsers = self.parser.add_subparsers()
+
+    bridge = subparsers.add_parser('bridge', help='Load test a MissionManager with a fleet of fake BHV_Agents')
+    fleet.add_arguments(bridge)
+    bridge.set_defaults(func=self.bridge)
+
+    self.parser.set_defaults(func=lambda args: self.parser.print_help())
+
+  def bridge(self, args):
+    sys.exit(fleet.run(args))
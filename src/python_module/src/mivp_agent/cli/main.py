@@ -2,6 +2,7 @@ import argparse
 
 from .info import Info
 from .log import Log
+from .bench import Bench
 from .inspect.inspector import Inspector
 
 parser = argparse.ArgumentParser()
@@ -10,6 +11,7 @@ subparsers = parser.add_subparsers()
 Info(subparsers.add_parser('info'))
 Log(subparsers.add_parser('log'))
 Inspector(subparsers.add_parser('inspect'))
+Bench(subparsers.add_parser('bench'))
 
 def main():
   args = parser.parse_args()
@@ -0,0 +1,755 @@
+import os
+import json
+import pickle
+import struct
+
+from mivp_agent.const import KEY_ID
+
+'''
+Codecs translate the state and instruction dictionaries which cross the model bridge to and from bytes. Every frame on the wire starts with the one byte tag of the codec which encoded it, so a peer can always decode a frame even while the codec used by the connection is still being negotiated.
+
+Tag `TAG_CONTROL` is reserved for the handshake (see `hello()` and `choice()`).
+'''
+
+TAG_CONTROL = 0
+
+class CodecError(Exception):
+  pass
+
+class Codec:
+  '''
+  Base class for bridge codecs. A new instance is created for every connection, so subclasses are free to keep per-connection state.
+  '''
+  name = None
+  tag = None
+
+  def encode_state(self, state):
+    raise NotImplementedError()
+
+  def decode_state(self, data):
+    raise NotImplementedError()
+
+  def encode_instr(self, instr):
+    raise NotImplementedError()
+
+  def decode_instr(self, data):
+    raise NotImplementedError()
+
+class PickleCodec(Codec):
+  '''
+  The original bridge encoding. Only accept this from trusted peers, unpickling can execute arbitrary code.
+  '''
+  name = 'pickle'
+  tag = 1
+
+  def encode_state(self, state):
+    return pickle.dumps(state)
+
+  def decode_state(self, data):
+    return pickle.loads(data)
+
+  def encode_instr(self, instr):
+    return pickle.dumps(instr)
+
+  def decode_instr(self, data):
+    return pickle.loads(data)
+
+# Kinds of nested values used by BinaryCodec
+KIND_MAP = b'm'
+KIND_TABLE = b't'
+KIND_JSON = b'j'
+
+STATE_HEADER = struct.Struct('>ddddH')
+INSTR_HEADER = struct.Struct('>ddH')
+# Counts of floats, ints, strs, trues, falses, nones, nested values and the key blob length
+BLOCK_HEADER = struct.Struct('>HHHHHHHI')
+TABLE_HEADER = struct.Struct('>HHI')
+LEN = struct.Struct('>I')
+
+STATE_FIXED_KEYS = ('MOOS_TIME', 'NAV_X', 'NAV_Y', 'NAV_HEADING')
+SEP = '\x00'
+
+def join_strs(strs):
+  blob = SEP.join(strs)
+  if blob.count(SEP) != max(len(strs)-1, 0):
+    raise CodecError('Strings containing NUL can not be encoded')
+  return blob.encode()
+
+def split_strs(data, count):
+  if count == 0:
+    return []
+  return str(data, 'utf-8').split(SEP)
+
+class BinaryCodec(Codec):
+  '''
+  A compact struct packed encoding. States start with a fixed header holding `MOOS_TIME`, `NAV_X`, `NAV_Y`, `NAV_HEADING` and the vehicle name. Every other entry goes into a block which groups values by type: keys are sent as one NUL separated string, numbers are packed with a single struct call per type and booleans / `None` only cost their key. Maps of equally shaped float maps (like `NODE_REPORTS`) are sent as a table with the column names written once.
+
+  Instructions start with `speed`, `course` and `ctrl_msg` followed by a block for the posts.
+  '''
+  name = 'binary'
+  tag = 2
+
+  def encode_state(self, state):
+    vname = state[KEY_ID].encode()
+    parts = [STATE_HEADER.pack(
+      state['MOOS_TIME'],
+      state['NAV_X'],
+      state['NAV_Y'],
+      state['NAV_HEADING'],
+      len(vname)
+    ), vname]
+
+    entries = [(k, v) for k, v in state.items() if k != KEY_ID and k not in STATE_FIXED_KEYS]
+    self._pack_block(entries, parts)
+    return b''.join(parts)
+
+  def decode_state(self, data):
+    data = memoryview(data)
+    MOOS_TIME, NAV_X, NAV_Y, NAV_HEADING, vname_len = STATE_HEADER.unpack_from(data)
+    offset = STATE_HEADER.size
+
+    state = {
+      KEY_ID: str(data[offset:offset+vname_len], 'utf-8'),
+      'MOOS_TIME': MOOS_TIME,
+      'NAV_X': NAV_X,
+      'NAV_Y': NAV_Y,
+      'NAV_HEADING': NAV_HEADING
+    }
+    offset += vname_len
+
+    offset = self._unpack_block(data, offset, state)
+    if offset != len(data):
+      raise CodecError('Trailing bytes after state')
+    return state
+
+  def encode_instr(self, instr):
+    ctrl_msg = instr['ctrl_msg'].encode()
+    parts = [INSTR_HEADER.pack(
+      instr['speed'],
+      instr['course'],
+      len(ctrl_msg)
+    ), ctrl_msg]
+
+    self._pack_block(instr['posts'].items(), parts)
+    return b''.join(parts)
+
+  def decode_instr(self, data):
+    data = memoryview(data)
+    speed, course, ctrl_len = INSTR_HEADER.unpack_from(data)
+    offset = INSTR_HEADER.size
+
+    instr = {
+      'speed': speed,
+      'course': course,
+      'posts': {},
+      'ctrl_msg': str(data[offset:offset+ctrl_len], 'utf-8')
+    }
+    offset += ctrl_len
+
+    offset = self._unpack_block(data, offset, instr['posts'])
+    if offset != len(data):
+      raise CodecError('Trailing bytes after instruction')
+    return instr
+
+  def _pack_block(self, entries, parts):
+    floats, ints, strs, trues, falses, nones, nested = {}, {}, {}, [], [], [], {}
+    for key, value in entries:
+      cls = type(value)
+      if cls is float:
+        floats[key] = value
+      elif cls is str:
+        strs[key] = value
+      elif value is True:
+        trues.append(key)
+      elif value is False:
+        falses.append(key)
+      elif value is None:
+        nones.append(key)
+      elif cls is int:
+        ints[key] = value
+      elif isinstance(value, float):
+        floats[key] = float(value)
+      elif isinstance(value, (dict, list, tuple)):
+        nested[key] = value
+      else:
+        raise CodecError(f'Unable to encode value of type {cls}')
+
+    keys = join_strs([*floats, *ints, *strs, *trues, *falses, *nones, *nested])
+    parts.append(BLOCK_HEADER.pack(
+      len(floats), len(ints), len(strs), len(trues), len(falses), len(nones), len(nested), len(keys)
+    ))
+    parts.append(keys)
+    if floats:
+      parts.append(struct.pack(f'>{len(floats)}d', *floats.values()))
+    if ints:
+      parts.append(struct.pack(f'>{len(ints)}q', *ints.values()))
+    if strs:
+      blob = join_strs(strs.values())
+      parts.append(LEN.pack(len(blob)))
+      parts.append(blob)
+    for value in nested.values():
+      self._pack_nested(value, parts)
+
+  def _pack_nested(self, value, parts):
+    if isinstance(value, dict):
+      columns = self._table_columns(value)
+      if columns is not None:
+        self._pack_table(value, columns, parts)
+      else:
+        parts.append(KIND_MAP)
+        self._pack_block(value.items(), parts)
+    else:
+      blob = json.dumps(value).encode()
+      parts.append(KIND_JSON)
+      parts.append(LEN.pack(len(blob)))
+      parts.append(blob)
+
+  @staticmethod
+  def _table_columns(value):
+    # Tables are maps of maps which all have the same keys and only floats
+    columns = None
+    for row in value.values():
+      if type(row) is not dict:
+        return None
+      if columns is None:
+        columns = tuple(row)
+      elif tuple(row) != columns:
+        return None
+      for cell in row.values():
+        if type(cell) is not float:
+          return None
+    return columns
+
+  def _pack_table(self, value, columns, parts):
+    names = join_strs([*columns, *value])
+    cells = [cell for row in value.values() for cell in row.values()]
+    parts.append(KIND_TABLE)
+    parts.append(TABLE_HEADER.pack(len(value), len(columns), len(names)))
+    parts.append(names)
+    parts.append(struct.pack(f'>{len(cells)}d', *cells))
+
+  def _unpack_block(self, data, offset, out):
+    n_float, n_int, n_str, n_true, n_false, n_none, n_nested, keys_len = BLOCK_HEADER.unpack_from(data, offset)
+    offset += BLOCK_HEADER.size
+
+    total = n_float + n_int + n_str + n_true + n_false + n_none + n_nested
+    keys = split_strs(data[offset:offset+keys_len], total)
+    offset += keys_len
+    if len(keys) != total:
+      raise CodecError('Key count does not match block header')
+
+    idx = 0
+    if n_float:
+      out.update(zip(keys[idx:idx+n_float], struct.unpack_from(f'>{n_float}d', data, offset)))
+      offset += 8*n_float
+      idx += n_float
+    if n_int:
+      out.update(zip(keys[idx:idx+n_int], struct.unpack_from(f'>{n_int}q', data, offset)))
+      offset += 8*n_int
+      idx += n_int
+    if n_str:
+      blob_len = LEN.unpack_from(data, offset)[0]
+      offset += LEN.size
+      strs = split_strs(data[offset:offset+blob_len], n_str)
+      offset += blob_len
+      out.update(zip(keys[idx:idx+n_str], strs))
+      idx += n_str
+    for count, value in ((n_true, True), (n_false, False), (n_none, None)):
+      if count:
+        out.update(dict.fromkeys(keys[idx:idx+count], value))
+        idx += count
+    for key in keys[idx:]:
+      out[key], offset = self._unpack_nested(data, offset)
+
+    return offset
+
+  def _unpack_nested(self, data, offset):
+    kind = data[offset:offset+1]
+    offset += 1
+    if kind == KIND_TABLE:
+      n_rows, n_cols, names_len = TABLE_HEADER.unpack_from(data, offset)
+      offset += TABLE_HEADER.size
+      names = split_strs(data[offset:offset+names_len], n_rows + n_cols)
+      offset += names_len
+      cells = struct.unpack_from(f'>{n_rows*n_cols}d', data, offset)
+      offset += 8*n_rows*n_cols
+
+      columns = names[:n_cols]
+      value = {}
+      for i, row in enumerate(names[n_cols:]):
+        value[row] = dict(zip(columns, cells[i*n_cols:(i+1)*n_cols]))
+      return value, offset
+    if kind == KIND_MAP:
+      value = {}
+      offset = self._unpack_block(data, offset, value)
+      return value, offset
+    if kind == KIND_JSON:
+      blob_len = LEN.unpack_from(data, offset)[0]
+      offset += LEN.size
+      return json.loads(bytes(data[offset:offset+blob_len])), offset+blob_len
+    raise CodecError(f'Unknown nested value kind {bytes(kind)}')
+
+# Schema entry codes used by SchemaCodec
+CODE_FLOAT = 'd'
+CODE_INT = 'q'
+CODE_BOOL = '?'
+CODE_STR = 's'
+CODE_NONE = 'N'
+CODE_CONST = 'c'
+CODE_TABLE = 't'
+CODE_NESTED = 'x'
+CODE_TYPES = {CODE_FLOAT: float, CODE_INT: int, CODE_BOOL: bool}
+
+FRAME_SCHEMA = b'S'
+FRAME_VALUES = b'V'
+SCHEMA_HEADER = struct.Struct('>HI')
+VALUES_HEADER = struct.Struct('>H')
+
+MISSING = object()
+
+class StateSchema:
+  '''
+  The keys and value types of a state, shared by both ends of a connection so that frames only have to carry the values. Numbers and booleans (including every `NODE_REPORTS` cell) are packed by one precompiled struct, strings are sent as one NUL separated blob and `None` values and the vehicle name are part of the schema itself.
+  '''
+  def __init__(self, entries):
+    # Entries are [key, code] or [key, code, extra]
+    self.entries = entries
+
+    self.flat_keys = []
+    self.flat_types = []
+    self.str_keys = []
+    self.nones = {}
+    self.consts = {}
+    self.tables = []
+    self.nested_keys = []
+    fmt = '>'
+    cells = 0
+    for entry in entries:
+      key, code = entry[0], entry[1]
+      if code in (CODE_FLOAT, CODE_INT, CODE_BOOL):
+        self.flat_keys.append(key)
+        self.flat_types.append(CODE_TYPES[code])
+        fmt += code
+      elif code == CODE_STR:
+        self.str_keys.append(key)
+      elif code == CODE_NONE:
+        self.nones[key] = None
+      elif code == CODE_CONST:
+        self.consts[key] = entry[2]
+      elif code == CODE_TABLE:
+        columns, rows = entry[2]
+        self.tables.append((key, tuple(columns), tuple(rows)))
+        cells += len(columns)*len(rows)
+      elif code == CODE_NESTED:
+        self.nested_keys.append(key)
+      else:
+        raise CodecError(f"Unknown schema code '{code}'")
+    self.struct = struct.Struct(fmt + 'd'*cells)
+    # Struct code of every number in gather() order
+    self.codes = fmt[1:] + 'd'*cells
+
+  @classmethod
+  def from_state(cls, state, consts):
+    entries = []
+    for key, value in state.items():
+      vcls = type(value)
+      if key in consts:
+        entries.append([key, CODE_CONST, value])
+      elif vcls is float:
+        entries.append([key, CODE_FLOAT])
+      elif vcls is bool:
+        entries.append([key, CODE_BOOL])
+      elif vcls is int and -2**63 <= value < 2**63:
+        entries.append([key, CODE_INT])
+      elif vcls is str:
+        entries.append([key, CODE_STR])
+      elif value is None:
+        entries.append([key, CODE_NONE])
+      elif vcls is dict and len(value) != 0 and BinaryCodec._table_columns(value) is not None:
+        entries.append([key, CODE_TABLE, [list(next(iter(value.values()))), list(value)]])
+      else:
+        entries.append([key, CODE_NESTED])
+    return cls(entries)
+
+  def gather(self, state):
+    '''
+    Returns:
+      tuple: The numbers, strings and nested values of `state` in schema order or `None` if `state` does not fit this schema
+    '''
+    if len(state) != len(self.entries):
+      return None
+
+    numbers = []
+    strs = []
+    # The struct would coerce a changed type, so check those exactly
+    for key, vtype in zip(self.flat_keys, self.flat_types):
+      value = state.get(key, MISSING)
+      if type(value) is not vtype:
+        return None
+      if vtype is int and not -2**63 <= value < 2**63:
+        return None
+      numbers.append(value)
+    for key in self.str_keys:
+      value = state.get(key, MISSING)
+      if type(value) is not str:
+        return None
+      strs.append(value)
+    for key in self.nones:
+      if state.get(key, MISSING) is not None:
+        return None
+    for key, value in self.consts.items():
+      if state.get(key, MISSING) != value:
+        return None
+    for key, columns, rows in self.tables:
+      table = state.get(key, MISSING)
+      if type(table) is not dict or tuple(table) != rows:
+        return None
+      for row in table.values():
+        if type(row) is not dict or tuple(row) != columns:
+          return None
+        for cell in row.values():
+          if type(cell) is not float:
+            return None
+          numbers.append(cell)
+    nested = []
+    for key in self.nested_keys:
+      value = state.get(key, MISSING)
+      if value is MISSING:
+        return None
+      nested.append(value)
+    return numbers, strs, nested
+
+  def build(self, numbers, strs, nested):
+    '''
+    The reverse of `gather()`.
+
+    Returns:
+      dict: A new state holding the values in schema order
+    '''
+    state = dict(zip(self.flat_keys, numbers))
+    if self.consts:
+      state.update(self.consts)
+    if self.nones:
+      state.update(self.nones)
+    if strs:
+      state.update(zip(self.str_keys, strs))
+
+    idx = len(self.flat_keys)
+    for key, columns, rows in self.tables:
+      n = len(columns)
+      table = {}
+      for row in rows:
+        table[row] = dict(zip(columns, numbers[idx:idx+n]))
+        idx += n
+      state[key] = table
+
+    if nested:
+      state.update(zip(self.nested_keys, nested))
+    return state
+
+class SchemaCodec(BinaryCodec):
+  '''
+  Sends the schema of a state (see `StateSchema`) once and then only the values of the following states. A new schema is sent whenever the keys or value types change. Schemas are kept per connection, so a reconnecting client starts again with a schema.
+
+  Instructions are encoded the same way as `BinaryCodec`.
+  '''
+  name = 'schema'
+  tag = 3
+
+  def __init__(self):
+    self._enc_schema = None
+    self._enc_revision = 0
+    self._dec_schema = None
+    self._dec_revision = None
+
+  def encode_state(self, state):
+    return self._encode_full(self._gather(state), state)
+
+  def _gather(self, state):
+    if self._enc_schema is None:
+      return None
+    return self._enc_schema.gather(state)
+
+  def _encode_full(self, gathered, state):
+    '''
+    Encodes every value of `state`, preceded by a new schema if `gathered` is `None`.
+
+    Returns:
+      bytes: The encoded frame
+    '''
+    parts = []
+    if gathered is None:
+      self._enc_schema = StateSchema.from_state(state, (KEY_ID, ))
+      self._enc_revision = (self._enc_revision + 1) % 2**16
+      gathered = self._enc_schema.gather(state)
+
+      schema = json.dumps(self._enc_schema.entries).encode()
+      parts.append(FRAME_SCHEMA)
+      parts.append(SCHEMA_HEADER.pack(self._enc_revision, len(schema)))
+      parts.append(schema)
+    else:
+      parts.append(FRAME_VALUES)
+      parts.append(VALUES_HEADER.pack(self._enc_revision))
+
+    numbers, strs, nested = gathered
+    parts.append(self._enc_schema.struct.pack(*numbers))
+    if strs:
+      self._pack_strs(strs, parts)
+    for value in nested:
+      self._pack_nested(value, parts)
+    self._encoded(gathered)
+    return b''.join(parts)
+
+  def _encoded(self, gathered):
+    # Hook for subclasses which need the values that were sent
+    pass
+
+  @staticmethod
+  def _pack_strs(strs, parts):
+    blob = join_strs(strs)
+    parts.append(LEN.pack(len(blob)))
+    parts.append(blob)
+
+  @staticmethod
+  def _unpack_strs(data, offset, count):
+    blob_len = LEN.unpack_from(data, offset)[0]
+    offset += LEN.size
+    return split_strs(data[offset:offset+blob_len], count), offset+blob_len
+
+  def decode_state(self, data):
+    data = memoryview(data)
+    kind = data[0:1]
+    offset = 1
+    if kind == FRAME_SCHEMA or kind == FRAME_VALUES:
+      values, offset = self._decode_full(data, offset, kind)
+    else:
+      values, offset = self._decode_kind(data, offset, kind)
+
+    if offset != len(data):
+      raise CodecError('Trailing bytes after state')
+    return self._dec_schema.build(*values)
+
+  def _decode_kind(self, data, offset, kind):
+    # Hook for subclasses which add frame kinds
+    raise CodecError(f'Unknown schema frame kind {bytes(kind)}')
+
+  def _decode_full(self, data, offset, kind):
+    '''
+    Returns:
+      tuple: The numbers, strings and nested values of the state and the offset after them
+    '''
+    if kind == FRAME_SCHEMA:
+      revision, schema_len = SCHEMA_HEADER.unpack_from(data, offset)
+      offset += SCHEMA_HEADER.size
+      try:
+        entries = json.loads(bytes(data[offset:offset+schema_len]))
+      except ValueError:
+        raise CodecError('Malformed schema')
+      offset += schema_len
+      self._dec_schema = StateSchema(entries)
+      self._dec_revision = revision
+    else:
+      offset = self._check_revision(data, offset)
+
+    schema = self._dec_schema
+    numbers = schema.struct.unpack_from(data, offset)
+    offset += schema.struct.size
+
+    strs = []
+    if schema.str_keys:
+      strs, offset = self._unpack_strs(data, offset, len(schema.str_keys))
+
+    nested = []
+    for _ in schema.nested_keys:
+      value, offset = self._unpack_nested(data, offset)
+      nested.append(value)
+
+    return (numbers, strs, nested), offset
+
+  def _check_revision(self, data, offset):
+    revision = VALUES_HEADER.unpack_from(data, offset)[0]
+    if self._dec_schema is None or revision != self._dec_revision:
+      raise CodecError(f'Values for unknown schema revision {revision}')
+    return offset + VALUES_HEADER.size
+
+FRAME_DELTA = b'D'
+DELTA_KEYFRAME_INTERVAL = 100
+
+def changed_indices(new, old):
+  return [i for i, a, b in zip(range(len(new)), new, old) if a != b]
+
+def pack_mask(indices, count):
+  mask = 0
+  for i in indices:
+    mask |= 1 << i
+  return mask.to_bytes((count+7)//8, 'big')
+
+def unpack_mask(data, offset, count):
+  '''
+  Returns:
+    tuple: The indices set in the mask, in ascending order, and the offset after the mask
+  '''
+  size = (count+7)//8
+  mask = int.from_bytes(data[offset:offset+size], 'big')
+  if mask >> count:
+    raise CodecError('Delta mask is out of range')
+  indices = []
+  while mask:
+    low = mask & -mask
+    indices.append(low.bit_length()-1)
+    mask ^= low
+  return indices, offset+size
+
+class DeltaCodec(SchemaCodec):
+  '''
+  Extends `SchemaCodec` by only sending the numbers and strings which changed since the previous state, marked by a bitmask. Nested values are always sent in full. A full keyframe is sent every `keyframe_interval` states and whenever the schema changes.
+
+  The bridge runs over a stream socket, so the previous state sent is always the last one the peer decoded. A reconnect creates new codecs on both ends which begin with a keyframe.
+  '''
+  name = 'delta'
+  tag = 4
+
+  def __init__(self, keyframe_interval=DELTA_KEYFRAME_INTERVAL):
+    super().__init__()
+    self.keyframe_interval = keyframe_interval
+    self._enc_last = None
+    self._enc_count = 0
+    self._dec_last = None
+
+  def encode_state(self, state):
+    gathered = self._gather(state)
+    if gathered is None or self._enc_count >= self.keyframe_interval:
+      return self._encode_full(gathered, state)
+    self._enc_count += 1
+
+    numbers, strs, nested = gathered
+    last_numbers, last_strs, _ = self._enc_last
+    schema = self._enc_schema
+    changed = changed_indices(numbers, last_numbers)
+    changed_strs = changed_indices(strs, last_strs)
+
+    parts = [FRAME_DELTA, VALUES_HEADER.pack(self._enc_revision)]
+    parts.append(pack_mask(changed, len(numbers)))
+    if changed:
+      fmt = '>' + ''.join([schema.codes[i] for i in changed])
+      parts.append(struct.pack(fmt, *[numbers[i] for i in changed]))
+    if strs:
+      parts.append(pack_mask(changed_strs, len(strs)))
+      if changed_strs:
+        self._pack_strs([strs[i] for i in changed_strs], parts)
+    for value in nested:
+      self._pack_nested(value, parts)
+
+    self._enc_last = gathered
+    return b''.join(parts)
+
+  def _encoded(self, gathered):
+    self._enc_last = gathered
+    self._enc_count = 0
+
+  def _decode_full(self, data, offset, kind):
+    values, offset = super()._decode_full(data, offset, kind)
+    self._dec_last = values
+    return values, offset
+
+  def _decode_kind(self, data, offset, kind):
+    if kind != FRAME_DELTA:
+      return super()._decode_kind(data, offset, kind)
+    offset = self._check_revision(data, offset)
+
+    schema = self._dec_schema
+    numbers, strs, _ = self._dec_last
+    count = len(schema.codes)
+
+    changed, offset = unpack_mask(data, offset, count)
+    if changed:
+      numbers = list(numbers)
+      fmt = '>' + ''.join([schema.codes[i] for i in changed])
+      for i, value in zip(changed, struct.unpack_from(fmt, data, offset)):
+        numbers[i] = value
+      offset += struct.calcsize(fmt)
+
+    if schema.str_keys:
+      changed, offset = unpack_mask(data, offset, len(schema.str_keys))
+      if changed:
+        strs = list(strs)
+        values, offset = self._unpack_strs(data, offset, len(changed))
+        if len(values) != len(changed):
+          raise CodecError('Delta string count does not match its mask')
+        for i, value in zip(changed, values):
+          strs[i] = value
+
+    nested = []
+    for _ in schema.nested_keys:
+      value, offset = self._unpack_nested(data, offset)
+      nested.append(value)
+
+    values = (numbers, strs, nested)
+    self._dec_last = values
+    return values, offset
+
+CODECS = {
+  SchemaCodec.name: SchemaCodec,
+  DeltaCodec.name: DeltaCodec,
+  BinaryCodec.name: BinaryCodec,
+  PickleCodec.name: PickleCodec,
+}
+CODEC_TAGS = {c.tag: c for c in CODECS.values()}
+
+# In order of preference, pickle is kept as the fallback. Schema comes first as
+# the compact codec with the least CPU cost in Python. Delta encoding is opt in,
+# a client has to put it ahead of schema (see `env_codecs()`).
+DEFAULT_CODECS = (SchemaCodec.name, DeltaCodec.name, BinaryCodec.name, PickleCodec.name)
+
+# Lets clients created without arguments (like the one in BHV_Agent) pick codecs
+ENV_CODECS = 'MIVP_AGENT_CODECS'
+
+def env_codecs():
+  '''
+  Returns:
+    tuple: The comma separated codec names in the `MIVP_AGENT_CODECS` environment variable or `DEFAULT_CODECS` if it is not set
+  '''
+  value = os.environ.get(ENV_CODECS, '').strip()
+  if value == '':
+    return DEFAULT_CODECS
+  return check_codecs([name.strip() for name in value.split(',')])
+
+def check_codecs(names):
+  assert len(names) != 0, 'At least one codec must be specified'
+  for name in names:
+    if name not in CODECS:
+      raise ValueError(f"Unknown codec '{name}', options are {tuple(CODECS)}")
+  return tuple(names)
+
+def hello(names):
+  '''
+  Returns:
+    bytes: The control message a client sends to offer codecs in order of preference
+  '''
+  return json.dumps({'type': 'hello', 'codecs': list(names)}).encode()
+
+def choice(name):
+  '''
+  Returns:
+    bytes: The control message a server sends to tell a client which codec was chosen
+  '''
+  return json.dumps({'type': 'choice', 'codec': name}).encode()
+
+def parse_control(data):
+  try:
+    msg = json.loads(bytes(data))
+  except ValueError:
+    raise CodecError('Malformed control message')
+  if not isinstance(msg, dict) or 'type' not in msg:
+    raise CodecError('Malformed control message')
+  return msg
+
+def negotiate(offered, accepted):
+  '''
+  Returns:
+    str: The first codec in `offered` which is also in `accepted` or `None` if there are none in common
+  '''
+  for name in offered:
+    if name in accepted:
+      return name
+  return None
@@ -0,0 +1,134 @@
+import numpy as np
+
+from mivp_agent.messages import MessageBatch
+
+class VecMissionEnv:
+    '''
+    A gym style vectorized environment which steps a fixed set of vehicles in lockstep on top of a [`MissionManager`][mivp_agent.manager.MissionManager]. Every call to [`step()`][mivp_agent.env.VecMissionEnv.step] waits until each vehicle has sent a new state, so one batched forward pass can be run over all of them.
+
+    Episodes are reset by each vehicle's `pEpisodeManager`. When a vehicle reports a new episode number its row of `dones` is `True` and its row of the observation is already the first state of the next episode. A vehicle which pauses between episodes is started again without showing up in the observations.
+
+    Args:
+      mgr (MissionManager): A started manager
+      vnames (iterable): The vehicles to step, for example the keys of a `VEHICLE_PAIRING` dict. Rows of the observations and actions are in this order.
+      observe (list or callable): State keys to stack into the observation (see [`MessageBatch.stack()`][mivp_agent.messages.MessageBatch.stack]) or a function from a [`MissionMessage`][mivp_agent.messages.MissionMessage] to a 1D array
+      act (callable): Function from one row of the action array to an action dict for [`MissionMessage.act()`][mivp_agent.messages.MissionMessage.act]. By default each row is `[speed, course]`.
+      reward (callable): Function `reward(msg, done)` returning the reward for the new message `msg`, the rewards are all `0` if `None`
+      timeout (float): Seconds to wait for a new state before raising `TimeoutError`, forever if `None`
+
+    Example:
+      ```
+      with MissionManager('trainer') as mgr:
+        env = VecMissionEnv(mgr, VEHICLE_PAIRING, ['NAV_X', 'NAV_Y', 'NAV_HEADING'])
+        obs = env.reset()
+        while True:
+          obs, rewards, dones, infos = env.step(model.predict(obs))
+      ```
+    '''
+
+    def __init__(self, mgr, vnames, observe, act=None, reward=None, timeout=None):
+        self.vnames = list(vnames)
+        self.num_envs = len(self.vnames)
+        assert self.num_envs > 0, 'At least one vehicle is needed'
+        assert len(set(self.vnames)) == self.num_envs, 'Vehicle names must be unique'
+
+        self._mgr = mgr
+        self._observe = observe
+        self._act = act
+        self._reward = reward
+        self._timeout = timeout
+
+        self._rows = {vname: i for i, vname in enumerate(self.vnames)}
+        # The message of each vehicle waiting for an action
+        self._pending = [None]*self.num_envs
+        # Last episode number seen from each vehicle's pEpisodeManager
+        self._episode_nums = {}
+
+    def reset(self):
+        '''
+        Waits for every vehicle to send a state, starting the episodes of paused vehicles.
+
+        Returns:
+          np.ndarray: The observation with one row per vehicle
+        '''
+        if any(msg is not None for msg in self._pending):
+            # Called again, keep the vehicles going with a fresh state
+            for msg in self._pending:
+                if msg is not None:
+                    msg.request_new()
+            self._pending = [None]*self.num_envs
+
+        self._gather()
+        return self._observations()
+
+    def step(self, actions):
+        '''
+        Sends one action to each vehicle then waits for all of their next states.
+
+        Args:
+          actions (array_like): One row per vehicle, `[speed, course]` unless an `act` function was given
+
+        Returns:
+          tuple: `(obs, rewards, dones, infos)` where `obs` is the stacked observation, `rewards` and `dones` are arrays with one entry per vehicle and `infos` is a list of dicts holding the `vname` and, when an episode ended, the `episode_report` of each vehicle.
+        '''
+        assert all(msg is not None for msg in self._pending), 'reset() must be called before step()'
+        assert len(actions) == self.num_envs, f'Expected {self.num_envs} actions, got {len(actions)}'
+
+        if self._act is None:
+            actions = np.asarray(actions, dtype=np.float64).reshape(self.num_envs, 2)
+            MessageBatch(self._pending).act(actions[:, 0], actions[:, 1])
+        else:
+            for msg, action in zip(self._pending, actions):
+                msg.act(self._act(action))
+        self._pending = [None]*self.num_envs
+
+        dones = self._gather()
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        infos = []
+        for i, msg in enumerate(self._pending):
+            if self._reward is not None:
+                rewards[i] = self._reward(msg, dones[i])
+            info = {'vname': msg.vname}
+            if dones[i]:
+                info['episode_report'] = msg.episode_report
+            infos.append(info)
+        return self._observations(), rewards, dones, infos
+
+    def _gather(self):
+        # Collects one running state from each vehicle, returns which vehicles finished an episode on the way
+        dones = np.zeros(self.num_envs, dtype=bool)
+        missing = self.num_envs
+        while missing > 0:
+            # Messages of other vehicles stay queued for whoever serves them
+            batch = self._mgr.get_messages(timeout=self._timeout, vnames=self.vnames)
+            if len(batch) == 0:
+                waiting = [vname for vname, msg in zip(self.vnames, self._pending) if msg is None]
+                raise TimeoutError(f'No state from {waiting} within {self._timeout} seconds')
+
+            for msg in batch:
+                row = self._rows[msg.vname]
+
+                if msg.episode_report is not None:
+                    num = msg.episode_report['NUM']
+                    if msg.vname in self._episode_nums and self._episode_nums[msg.vname] != num:
+                        dones[row] = True
+                    self._episode_nums[msg.vname] = num
+                elif msg.vname not in self._episode_nums:
+                    self._episode_nums[msg.vname] = None
+
+                if msg.episode_state == 'PAUSED':
+                    msg.start()
+                    continue
+
+                if self._pending[row] is None:
+                    missing -= 1
+                else:
+                    # Only expected if the vehicle was answered outside of the env
+                    self._pending[row].request_new()
+                self._pending[row] = msg
+        return dones
+
+    def _observations(self):
+        if callable(self._observe):
+            return np.stack([np.asarray(self._observe(msg), dtype=np.float32) for msg in self._pending])
+        return MessageBatch(self._pending).stack(self._observe)
@@ -0,0 +1,303 @@
+import time
+import heapq
+import itertools
+from collections import deque, OrderedDict
+from threading import Lock, Condition
+
+DELIVERY_FIFO = 'fifo'
+DELIVERY_LATEST = 'latest'
+DELIVERY_MODES = (DELIVERY_FIFO, DELIVERY_LATEST)
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE)
+
+SCHEDULE_OLDEST = 'oldest'
+SCHEDULE_ROUND_ROBIN = 'round_robin'
+SCHEDULES = (SCHEDULE_OLDEST, SCHEDULE_ROUND_ROBIN)
+
+# Fields of a queue entry
+ENTRY_SEQ = 0
+ENTRY_TIME = 1
+ENTRY_MSG = 2
+
+class Inbox:
+    '''
+    Holds the [`MissionMessage`][mivp_agent.messages.MissionMessage]s waiting to be handed out by `MissionManager.get_message()`, in one queue per vehicle.
+
+    With `delivery='fifo'` every message is kept. With `delivery='latest'` each vehicle has a one message mailbox: a newer message replaces the vehicle's undelivered one but keeps its place in line, so the user always sees the freshest state and at most one message per vehicle is held.
+
+    The `schedule` decides which vehicle's message is handed out next. `'oldest'` hands out the message which has waited the longest, so messages come out in arrival order. `'round_robin'` takes turns between the vehicles with messages waiting, so a vehicle with a fast helm loop can not crowd out the others.
+
+    With `max_depth` set no more than that many messages are held. When a message arrives at a full inbox the `overflow` policy decides what happens:
+
+      - `'block'`: `put()` waits until a message is taken
+      - `'drop_oldest'`: the oldest message of the same vehicle is dropped, or the oldest message of all if the vehicle has none
+      - `'coalesce'`: the new message replaces the oldest message of the same vehicle in its place in line, or the oldest message of all is dropped if the vehicle has none
+
+    Args:
+      delivery (str): `'fifo'` or `'latest'`
+      max_depth (int): The most messages to hold, unbounded if `None`
+      overflow (str): The policy for a full inbox
+      high_water (int): Depth at which `on_high_water` is called, defaults to `max_depth`
+      on_high_water (callable): Called with the depth each time it rises to `high_water`, from the thread calling `put()`
+      schedule (str): `'oldest'` or `'round_robin'`
+    '''
+
+    def __init__(self, delivery=DELIVERY_FIFO, max_depth=None, overflow=OVERFLOW_BLOCK, high_water=None, on_high_water=None, schedule=SCHEDULE_OLDEST):
+        if delivery not in DELIVERY_MODES:
+            raise ValueError(f"Unknown delivery mode '{delivery}', options are {DELIVERY_MODES}")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', options are {OVERFLOW_POLICIES}")
+        if schedule not in SCHEDULES:
+            raise ValueError(f"Unknown schedule '{schedule}', options are {SCHEDULES}")
+        if max_depth is not None and max_depth < 1:
+            raise ValueError(f'max_depth must be at least 1, got {max_depth}')
+        self.delivery = delivery
+        self.schedule = schedule
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.high_water = high_water
+        if self.high_water is None:
+            self.high_water = max_depth
+        self._on_high_water = on_high_water
+        self._above_high_water = False
+
+        self._lock = Lock()
+        self._not_full = Condition(self._lock)
+        self._closed = False
+        # Threads waiting in get(), as [vnames or None, Condition] so a new message only wakes a thread which wants it
+        self._waiters = []
+
+        # Queues of [sequence number, arrival time, message] entries for vehicles with messages waiting, in round robin order
+        self._queues = OrderedDict()
+        self._count = 0
+        self._seq = itertools.count()
+        # Heap of (sequence number, vname) for the head of each queue, entries whose queue head has since changed are skipped
+        self._heads = []
+
+        # Messages replaced before they were delivered
+        self.coalesced = 0
+        # Messages dropped because the inbox was full
+        self.dropped = 0
+        # Times put() had to wait for room
+        self.blocked = 0
+        # Most messages held at once
+        self.peak = 0
+
+    def put(self, msg):
+        '''
+        Returns:
+          obj: The message `msg` replaced or dropped to make room, which still needs a response, or `None`
+        '''
+        old = None
+        with self._lock:
+            queue = self._queues.get(msg.vname)
+            if self.delivery == DELIVERY_LATEST and queue is not None:
+                old = self._replace(queue, msg)
+                self.coalesced += 1
+            elif self._is_full():
+                old = self._overflow(msg)
+            else:
+                self._add(msg)
+
+            depth = self._count
+            self.peak = max(self.peak, depth)
+            crossed = self._check_high_water(depth)
+            self._wake(msg.vname)
+
+        if crossed:
+            self._on_high_water(depth)
+        return old
+
+    def _is_full(self):
+        return self.max_depth is not None and self._count >= self.max_depth
+
+    def _add(self, msg):
+        queue = self._queues.get(msg.vname)
+        entry = [next(self._seq), time.monotonic(), msg]
+        if queue is None:
+            queue = self._queues[msg.vname] = deque()
+            self._push_head(entry[ENTRY_SEQ], msg.vname)
+        queue.append(entry)
+        self._count += 1
+
+    def _replace(self, queue, msg):
+        # Swaps the vehicle's oldest message for msg keeping its place in line
+        old = queue[0][ENTRY_MSG]
+        queue[0][ENTRY_MSG] = msg
+        return old
+
+    def _overflow(self, msg):
+        # Called holding the lock with a full inbox, returns the message pushed out
+        if self.overflow == OVERFLOW_BLOCK:
+            self.blocked += 1
+            self._not_full.wait_for(lambda: self._closed or not self._is_full())
+            if self._closed:
+                return msg
+            self._add(msg)
+            return None
+
+        self.dropped += 1
+        queue = self._queues.get(msg.vname)
+        if queue is not None and self.overflow == OVERFLOW_COALESCE:
+            return self._replace(queue, msg)
+        if queue is None:
+            queue = self._oldest_queue()
+        old = self._pop(queue)
+        self._add(msg)
+        return old
+
+    def _check_high_water(self, depth):
+        # Returns True once each time the depth rises to the high water mark
+        if self.high_water is None or self._on_high_water is None:
+            return False
+        if depth < self.high_water:
+            self._above_high_water = False
+            return False
+        if self._above_high_water:
+            return False
+        self._above_high_water = True
+        return True
+
+    def _wake(self, vname):
+        for i, (vnames, cond) in enumerate(self._waiters):
+            if vnames is None or vname in vnames:
+                del self._waiters[i]
+                cond.notify()
+                return
+
+    def _wait(self, vnames, timeout):
+        # Called holding the lock, returns False if no message for vnames arrived before the timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not self._available(vnames):
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+            waiter = [vnames, Condition(self._lock)]
+            self._waiters.append(waiter)
+            waiter[1].wait(remaining)
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return True
+
+    def _available(self, vnames):
+        if vnames is None:
+            return self._count != 0
+        return any(vname in self._queues for vname in vnames)
+
+    def get(self, block=True, timeout=None, vnames=None):
+        '''
+        Args:
+          vnames (iterable): Only take a message from one of these vehicles, any vehicle if `None`
+
+        Returns:
+          obj: The next message or `None` if there was none before the timeout or when not blocking
+        '''
+        if vnames is not None:
+            vnames = frozenset(vnames)
+        with self._lock:
+            if not block:
+                timeout = 0
+            if not self._wait(vnames, timeout):
+                return None
+            msg = self._next(vnames)
+            self._taken()
+            return msg
+
+    def get_many(self, max_n=None, timeout=None, vnames=None):
+        '''
+        Waits up to `timeout` seconds (forever if `None`) for a first message then takes every message available.
+
+        Args:
+          max_n (int): Most messages to take, all if `None`
+          vnames (iterable): Only take messages from these vehicles, any vehicle if `None`
+        Returns:
+          list: The messages in delivery order, empty if the timeout expired
+        '''
+        if vnames is not None:
+            vnames = frozenset(vnames)
+        with self._lock:
+            if not self._wait(vnames, timeout):
+                return []
+            msgs = []
+            while (max_n is None or len(msgs) < max_n) and self._available(vnames):
+                msgs.append(self._next(vnames))
+            self._taken()
+            return msgs
+
+    def _next(self, vnames):
+        # Pops the next message following the schedule from vehicles which have one
+        if self.schedule == SCHEDULE_OLDEST:
+            if vnames is None:
+                return self._pop(self._oldest_queue())
+            queues = [self._queues[vname] for vname in vnames if vname in self._queues]
+            return self._pop(min(queues, key=lambda queue: queue[0][ENTRY_SEQ]))
+
+        for vname, queue in self._queues.items():
+            if vnames is None or vname in vnames:
+                msg = self._pop(queue)
+                if vname in self._queues:
+                    # Back of the line for its next turn
+                    self._queues.move_to_end(vname)
+                return msg
+
+    def _push_head(self, seq, vname):
+        if self.schedule != SCHEDULE_OLDEST:
+            return
+        if len(self._heads) > 2*len(self._queues) + 64:
+            # Filtered gets leave stale heads behind, rebuild from the queues
+            self._heads = [(queue[0][ENTRY_SEQ], v) for v, queue in self._queues.items() if len(queue) != 0]
+            heapq.heapify(self._heads)
+        heapq.heappush(self._heads, (seq, vname))
+
+    def _oldest_queue(self):
+        if self.schedule != SCHEDULE_OLDEST:
+            return min(self._queues.values(), key=lambda queue: queue[0][ENTRY_SEQ])
+
+        heads = self._heads
+        while True:
+            seq, vname = heads[0]
+            queue = self._queues.get(vname)
+            if queue is not None and queue[0][ENTRY_SEQ] == seq:
+                return queue
+            heapq.heappop(heads)
+
+    def _pop(self, queue):
+        msg = queue.popleft()[ENTRY_MSG]
+        if len(queue) == 0:
+            del self._queues[msg.vname]
+        else:
+            self._push_head(queue[0][ENTRY_SEQ], msg.vname)
+        self._count -= 1
+        return msg
+
+    def _taken(self):
+        if self.high_water is not None and self._count < self.high_water:
+            self._above_high_water = False
+        self._not_full.notify_all()
+
+    def ages(self):
+        '''
+        Returns:
+          dict: For each vehicle with messages waiting, the seconds its oldest message has waited
+        '''
+        now = time.monotonic()
+        with self._lock:
+            return {vname: now - queue[0][ENTRY_TIME] for vname, queue in self._queues.items()}
+
+    def close(self):
+        '''
+        Wakes a `put()` blocked on a full inbox, from then on messages which do not fit are returned by `put()` instead of waiting.
+        '''
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+
+    def __len__(self):
+        return self._count
@@ -91,7 +91,9 @@ class LogMetadata:
         if os.path.isdir(session_path):
           for log_dir in os.listdir(session_path):
             path = os.path.join(session_path, log_dir)
-            logs.append(ProtoLogger(path, Transition, mode='r'))
+            # Skip files written next to the logs, like the manager's speed report
+            if os.path.isdir(path):
+              logs.append(ProtoLogger(path, Transition, mode='r'))
     
     return logs
 
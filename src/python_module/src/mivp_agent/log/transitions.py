@@ -0,0 +1,69 @@
+import os
+from threading import Lock
+
+from mivp_agent.proto.proto_logger import ProtoLogger
+from mivp_agent.proto.mivp_agent_pb2 import Transition
+from mivp_agent.proto import translate
+
+class TransitionLog:
+  '''
+  Writes the `Transition`s of each vehicle to `log_<vname>` files in `path`, as `MissionManager` logs them. Safe to share between the threads of a sharded `MissionManager`. `tracer` is passed on to each `ProtoLogger`.
+
+  The `bytes_written`, `flushes` and `flush_seconds` attributes total those of the `ProtoLogger`s.
+  '''
+  def __init__(self, path, tracer=None):
+    self._path = path
+    self._tracer = tracer
+    self._lock = Lock()
+    self._logs = {}
+    self._last_state = {}
+    self._last_act = {}
+    self.bytes_written = 0
+    self.flushes = 0
+    self.flush_seconds = 0.0
+
+  def record(self, vname, state, action, is_transition):
+    '''
+    Records the response `action` to `state`. Only states marked as transitions are written, each with the previous transition's state and action.
+    '''
+    with self._lock:
+      self._record(vname, state, action, is_transition)
+
+  def _record(self, vname, state, action, is_transition):
+    # Check if this is a new vehicle
+    if vname not in self._logs:
+      path = os.path.join(self._path, f"log_{vname}")
+      self._logs[vname] = ProtoLogger(path, Transition, mode='w', tracer=self._tracer)
+
+    if not is_transition:
+      return
+
+    # Write a transition if this is not the first state ever
+    if vname in self._last_state:
+      t = Transition()
+      t.s1.CopyFrom(translate.state_from_dict(self._last_state[vname]))
+      t.a.CopyFrom(translate.action_from_dict(self._last_act[vname]))
+      t.s2.CopyFrom(translate.state_from_dict(state))
+
+      logger = self._logs[vname]
+      self._count(logger, lambda: logger.write(t))
+
+    # Update the storage for next transition
+    self._last_state[vname] = state
+    self._last_act[vname] = action
+
+  def _count(self, logger, write):
+    # Calls write() and adds anything it flushed to the totals
+    flushes = logger.flushes
+    bytes_written = logger.bytes_written
+    flush_seconds = logger.flush_seconds
+    write()
+    self.flushes += logger.flushes - flushes
+    self.bytes_written += logger.bytes_written - bytes_written
+    self.flush_seconds += logger.flush_seconds - flush_seconds
+
+  def close(self):
+    with self._lock:
+      for vname in self._logs:
+        logger = self._logs[vname]
+        self._count(logger, logger.close)
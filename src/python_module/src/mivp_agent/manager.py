@@ -1,19 +1,105 @@
 # General
 import os
 import time
-from queue import Queue, Empty
+import zlib
+import heapq
+import itertools
+from queue import Queue
 from threading import Thread, Lock
 
 # For core
 from mivp_agent.const import KEY_ID, DATA_DIRECTORY
-from mivp_agent.messages import MissionMessage, INSTR_SEND_STATE, INSTR_RESET_FAILURE, INSTR_RESET_SUCCESS
-from mivp_agent.bridge import ModelBridgeServer
+from mivp_agent.messages import MissionMessage, MessageBatch, action_instr, INSTR_SEND_STATE, INSTR_RESET_FAILURE, INSTR_RESET_SUCCESS
+from mivp_agent.bridge import ModelBridgeServer, shard_address, tcp_address, write_address, read_address, DEFAULT_PORT, ENV_ADDRESS
+from mivp_agent.server_process import ServerProcess
+from mivp_agent import shm
+from mivp_agent.metrics import MetricsServer
+from mivp_agent.inbox import Inbox, DELIVERY_FIFO, OVERFLOW_BLOCK, SCHEDULE_OLDEST
+from mivp_agent.util.histogram import Histogram, FINE_LATENCY_BOUNDS
+from mivp_agent.util import trace
+from mivp_agent.util.trace import Tracer
+from mivp_agent.util.speed import SpeedMonitor
 
 # For logging
 from mivp_agent.log.directory import LogDirectory
-from mivp_agent.proto.proto_logger import ProtoLogger
-from mivp_agent.proto.mivp_agent_pb2 import Transition
-from mivp_agent.proto import translate
+from mivp_agent.log.transitions import TransitionLog
+
+SUPERSEDED_REQUEST_NEW = 'request_new'
+SUPERSEDED_REPEAT = 'repeat'
+SUPERSEDED_POLICIES = (SUPERSEDED_REQUEST_NEW, SUPERSEDED_REPEAT)
+
+FALLBACK_LAST_ACTION = 'last_action'
+FALLBACK_ZERO_SPEED = 'zero_speed'
+FALLBACKS = (FALLBACK_LAST_ACTION, FALLBACK_ZERO_SPEED)
+
+LATE_DROP = 'drop'
+LATE_NEXT = 'next'
+LATE_POLICIES = (LATE_DROP, LATE_NEXT)
+
+SHARD_LEAST_LOADED = 'least_loaded'
+SHARD_HASH = 'hash'
+SHARD_ASSIGNMENTS = (SHARD_LEAST_LOADED, SHARD_HASH)
+
+# Per vehicle latency histograms kept with timing on
+TIMING_QUEUE = 'queue'
+TIMING_THINK = 'think'
+TIMING_ROUND_TRIP = 'round_trip'
+TIMINGS = (TIMING_QUEUE, TIMING_THINK, TIMING_ROUND_TRIP)
+
+# Written to the session's log directory on close
+SPEED_FILE = 'speed.json'
+
+class _Shard:
+    '''
+    One server of a `MissionManager` and what its thread needs besides it.
+    '''
+    def __init__(self, server, transitions, tracer):
+        self.server = server
+        self.transitions = transitions
+        self.tracer = tracer
+        self.thread = None
+        # Messages which have been responded to, waiting for the shard's thread to send them
+        self.ready = Queue()
+        # (vname, success) of the vehicles to reset
+        self.resets = Queue()
+        # Latest address of each vehicle served by this shard
+        self.addresses = {}
+        # Vname at each address which is still connected
+        self.connected = {}
+
+        # Connections handed to the shard by the router
+        self.routed = 0
+        self.connections = 0
+        self.states = 0
+        self.repeated = 0
+        self.deadline_missed = 0
+        self.late = 0
+
+    def on_response(self, msg):
+        # Called from the user's thread once a message has been responded to
+        if self.tracer is not None and msg._trace_start is not None:
+            self.tracer.complete('handle', msg._trace_start, trace.CAT_USER, {'vname': msg.vname})
+        self.ready.put(msg)
+        self.server.wakeup()
+
+    def load(self):
+        # Open connections and those handed off by the router but not yet accepted
+        return self.server.client_count() + self.routed - self.server.handoffs
+
+    def stats(self):
+        return {
+            'address': self.server.address,
+            'connections': self.connections,
+            'vehicles': len(self.addresses),
+            'open_connections': self.server.client_count(),
+            'connected_vehicles': len(self.connected),
+            'states': self.states,
+            'bytes_received': self.server.bytes_received,
+            'bytes_sent': self.server.bytes_sent,
+            'repeated': self.repeated,
+            'deadline_missed': self.deadline_missed,
+            'late': self.late,
+        }
 
 class MissionManager:
     '''
@@ -31,7 +117,7 @@ class MissionManager:
       ```
     '''
 
-    def __init__(self, task, log=True, immediate_transition=True, log_whitelist=None, id_suffix=None, output_dir=None):
+    def __init__(self, task, log=True, immediate_transition=True, log_whitelist=None, id_suffix=None, output_dir=None, address=None, delivery=DELIVERY_FIFO, superseded=SUPERSEDED_REQUEST_NEW, action_repeat=1, response_deadline=None, fallback=FALLBACK_LAST_ACTION, late_response=LATE_DROP, max_queue=None, overflow=OVERFLOW_BLOCK, high_water=None, on_high_water=None, schedule=SCHEDULE_OLDEST, process_mode=False, shards=1, shard_assign=SHARD_LEAST_LOADED, hostname=None, port=None, address_file=None, export_address=False, timing=True, trace=None, metrics_port=None):
         '''
         The initializer for MissionManager
 
@@ -47,21 +133,121 @@ class MissionManager:
             id_suffix (str): Will be appended to the generated session id.
 
             output_dir (str): Path to a place to store files.
+
+            address (str): Address for the [`ModelBridgeServer`][mivp_agent.bridge.ModelBridgeServer] to listen on, such as `unix:///tmp/mivp.sock` when the vehicles run on the same machine. The default is `tcp://localhost:57721`. With port `0`, as in `tcp://localhost:0`, the OS picks a free port so several managers can run side by side, see [`address()`][mivp_agent.manager.MissionManager.address].
+
+            delivery (str): With the default `'fifo'` every message is handed out by `get_message()` in arrival order. With `'latest'` a newer message from a vehicle replaces its message which has not been handed out yet (see [`Inbox`][mivp_agent.inbox.Inbox]), so a slow model always acts on fresh states.
+
+            superseded (str): How messages replaced in `'latest'` delivery are answered. `'request_new'` asks for a new state and `'repeat'` repeats the speed and course last sent to the vehicle.
+
+            action_repeat (int): The default `repeat` of [`MissionMessage.act()`][mivp_agent.messages.MissionMessage.act]. With `action_repeat=k` each action is also sent in answer to the next `k-1` states of the vehicle without them being returned by `get_message()`, for policies which only decide every `k` helm iterations.
+
+            response_deadline (float or dict): Seconds after a state arrives by which it must be responded to, either for every vehicle or as a dict from vname to seconds. When a deadline passes the manager sends the `fallback` in place of the response so a slow model does not freeze the vehicle. `None` waits forever.
+
+            fallback (str or callable): What to send when a deadline is missed. `'last_action'` repeats the speed and course last sent to the vehicle, `'zero_speed'` stops it on its last course and a callable is given the [`MissionMessage`][mivp_agent.messages.MissionMessage] and returns an action like those given to `act()`.
+
+            late_response (str): What to do with a response given after the fallback was sent. `'drop'` ignores it and `'next'` sends it in answer to the vehicle's next state, unless that state has been handed out by `get_message()` already.
+
+            max_queue (int): The most messages to hold for `get_message()`, unbounded if `None`.
+
+            overflow (str): What to do with a new message when `max_queue` messages are held. `'block'` stops reading from the vehicles until a message is taken, `'drop_oldest'` drops the vehicle's oldest message and `'coalesce'` replaces it with the new one in its place in line (see [`Inbox`][mivp_agent.inbox.Inbox]). Dropped messages are answered following `superseded`.
+
+            high_water (int): Queue depth at which `on_high_water` is called, defaults to `max_queue`.
+
+            on_high_water (callable): Called with the queue depth, from the manager's thread, each time the depth rises to `high_water`.
+
+            schedule (str): Which vehicle `get_message()` serves next. `'oldest'` returns the message which has waited the longest and `'round_robin'` takes turns between the vehicles with messages waiting, so a vehicle with a fast helm loop can not crowd out the others.
+
+            process_mode (bool): Run the [`ModelBridgeServer`][mivp_agent.bridge.ModelBridgeServer], the decoding of states and the writing of logs in a child process (see [`ServerProcess`][mivp_agent.server_process.ServerProcess]) so they do not compete with the model for the GIL. The messages and responses pass through shared memory and the API does not change. Only available on x86-64 CPUs.
+
+            shards (int): Number of servers, each with its own thread (or child process with `process_mode`), to spread the vehicles over. With more than one shard the vehicles still connect to `address`, from which connections are routed to the shards, while shard `i` listens on [`shard_address(address, i)`][mivp_agent.bridge.shard_address] for vehicles to connect to it directly. The messages of all shards are handed out by the same `get_message()`.
+
+            shard_assign (str): How connections are spread over the shards. `'least_loaded'` routes each to the shard with the fewest open connections. `'hash'` moves each vehicle, once its first state arrives, to the shard picked by a hash of its vname so the same vehicle always lands on the same shard. `'hash'` can not be used with `process_mode` as connections can not move between processes.
+
+            hostname (str): Host to listen on when no `address` is given, `localhost` by default.
+
+            port (int): Port to listen on when no `address` is given, `0` lets the OS pick one.
+
+            address_file (str): File to write the address the vehicles connect to once the manager has started, and to remove when it closes. Vehicles whose `MIVP_AGENT_ADDRESS_FILE` environment variable names the file connect to it, see [`env_address()`][mivp_agent.bridge.env_address].
+
+            export_address (bool): Set the `MIVP_AGENT_ADDRESS` environment variable to the address once the manager has started, so simulations launched from this process afterwards connect to it.
+
+            timing (bool): Stamp each message with the time it passes each stage (see [`MissionMessage.timestamps`][mivp_agent.messages.MissionMessage]) and keep per vehicle latency histograms and the speed of each vehicle's simulation for [`stats()`][mivp_agent.manager.MissionManager.stats]. This costs a few microseconds per message, with `False` nothing is measured.
+
+            trace (bool or str): Record spans of each stage a message goes through, from accepting the vehicle, reading and decoding its states and queueing them to the user handling them, the response being sent and the transition being buffered and flushed to gzip. The most recent events are kept in a ring and written as Chrome Trace Event JSON, to open in `chrome://tracing` or https://ui.perfetto.dev, by [`dump_trace()`][mivp_agent.manager.MissionManager.dump_trace] or to the file `trace` names when the manager closes. With `process_mode` each child process writes its spans to `<trace>.shard<i>` when it closes, which needs `trace` to be a file. Off with `None`, which costs nothing.
+
+            metrics_port (int): Serve the manager's stats to Prometheus on this port of localhost while it runs, see [`MetricsServer`][mivp_agent.metrics.MetricsServer] and [`metrics_url()`][mivp_agent.manager.MissionManager.metrics_url]. `0` lets the OS pick a free port.
         '''
-        self._msg_queue = Queue()
+        if superseded not in SUPERSEDED_POLICIES:
+            raise ValueError(f"Unknown superseded policy '{superseded}', options are {SUPERSEDED_POLICIES}")
+        self._superseded = superseded
+        if not isinstance(action_repeat, int) or action_repeat < 1:
+            raise ValueError(f'action_repeat must be an int of at least 1, got {action_repeat}')
+        self._action_repeat = action_repeat
+
+        if fallback not in FALLBACKS and not callable(fallback):
+            raise ValueError(f"Unknown fallback '{fallback}', options are {FALLBACKS} or a callable")
+        if late_response not in LATE_POLICIES:
+            raise ValueError(f"Unknown late response policy '{late_response}', options are {LATE_POLICIES}")
+        self._response_deadline = response_deadline
+        self._fallback = fallback
+        self._late_response = late_response
+        self._msg_queue = Inbox(delivery, max_queue, overflow, high_water, on_high_water, schedule)
+
+        if not isinstance(shards, int) or shards < 1:
+            raise ValueError(f'shards must be an int of at least 1, got {shards}')
+        if shard_assign not in SHARD_ASSIGNMENTS:
+            raise ValueError(f"Unknown shard assignment '{shard_assign}', options are {SHARD_ASSIGNMENTS}")
+        if shard_assign == SHARD_HASH and process_mode:
+            raise ValueError(f"Shard assignment '{SHARD_HASH}' needs process_mode=False")
+        if process_mode and not shm.SUPPORTED:
+            raise ValueError('process_mode passes messages through shared memory, which needs an x86-64 CPU (see mivp_agent.shm)')
+        self._n_shards = shards
+        self._shard_assign = shard_assign
+
+        self._timing = timing
+        self._trace_path = None
+        if isinstance(trace, str):
+            self._trace_path = trace
+        self._tracer = None
+        if trace:
+            self._tracer = Tracer()
+        self._speed = None
+        if timing:
+            self._speed = SpeedMonitor()
+        self._metrics_port = metrics_port
+        self._metrics = None
+        # Histograms of each vehicle by TIMINGS name
+        self._timings = {}
+        # (time, states, bytes received, bytes sent) at the last call to stats()
+        self._last_stats = None
 
         self._vnames = []
         self._vname_lock = Lock()
         self._vehicle_count = 0
+        # Shard serving each vehicle
+        self._vehicle_shards = {}
         self._episode_manager_states = {}
         self._ems_lock = Lock()
         self._episode_manager_nums = {}
         self._emn_lock = Lock()
 
-        # Dict to hold queues of vnames to reset
-        self._vresets = Queue()
-
-        self._thread = None
+        if address is None and (hostname is not None or port is not None):
+            if hostname is None:
+                hostname = 'localhost'
+            if port is None:
+                port = DEFAULT_PORT
+            address = tcp_address(hostname, port)
+        elif address is not None:
+            assert hostname is None and port is None, 'Give either address or hostname and port'
+        self._address = address
+        self._address_file = address_file
+        self._export_address = export_address
+        self._process_mode = process_mode
+        self._shards = []
+        # Listens on address and passes the connections to the shards when there are several
+        self._router = None
+        self._router_thread = None
         self._stop_signal = False
         
         if output_dir is None:
@@ -89,10 +275,7 @@ class MissionManager:
         self._imm_transition = immediate_transition
         if self._log:
             self._log_whitelist = log_whitelist
-            # Create data structs needed to log data from each vehicle
-            self._logs = {}
-            self._last_state = {}
-            self._last_act = {}
+            self._transitions = TransitionLog(self._log_path, tracer=self._tracer)
 
             # Go ahead and create the log path
             os.makedirs(self._log_path)
@@ -127,49 +310,177 @@ class MissionManager:
 
     def start(self):
         '''
-        It is **not recommended** to use this method directly. Instead, consider using this class with the python context manager. This method starts a thread to read from the `ModelBridgeServer`.
+        It is **not recommended** to use this method directly. Instead, consider using this class with the python context manager. This method starts a thread to read from each `ModelBridgeServer`.
 
         Returns:
           bool: False if thread has already been started, True otherwise
         '''
-        if self._thread is not None:
+        if len(self._shards) != 0:
             return False
 
-        self._thread = Thread(target=self._server_thread, daemon=True)
-        self._thread.start()
+        if self._metrics_port is not None:
+            self._metrics = MetricsServer(self, self._metrics_port)
+
+        # Bind here so the servers exist before any other thread can wake them
+        addresses = [self._address]
+        if self._n_shards > 1:
+            self._router = ModelBridgeServer(address=self._address, tracer=self._tracer)
+            addresses = [shard_address(self._router.address, i) for i in range(1, self._n_shards + 1)]
+
+        for i, address in enumerate(addresses):
+            transitions = None
+            if self._process_mode:
+                log_path = None
+                if self._log:
+                    log_path = self._log_path
+                trace_path = None
+                if self._trace_path is not None:
+                    trace_path = f'{self._trace_path}.shard{i}'
+                server = ServerProcess(address, log_path, trace_path)
+                # The child process writes the logs
+                transitions = server
+            else:
+                server = ModelBridgeServer(address=address, tracer=self._tracer)
+                if self._log:
+                    transitions = self._transitions
+            self._shards.append(_Shard(server, transitions, self._tracer))
+
+        # Named for the threads of traces
+        for i, shard in enumerate(self._shards):
+            shard.thread = Thread(target=self._server_thread, args=(shard, ), name=f'mivp-shard-{i}', daemon=True)
+            shard.thread.start()
+        if self._router is not None:
+            self._router_thread = Thread(target=self._route, name='mivp-router', daemon=True)
+            self._router_thread.start()
+
+        self._last_stats = (time.monotonic(), 0, 0, 0)
+        if self._metrics is not None:
+            self._metrics.start()
+        if self._address_file is not None:
+            write_address(self._address_file, self.address())
+        if self._export_address:
+            os.environ[ENV_ADDRESS] = self.address()
 
         return True
 
-    def _server_thread(self):
-        live_msg_list = []
-        address_map = {}
-        with ModelBridgeServer() as server:
+    def address(self):
+        '''
+        Returns:
+          str: The address vehicles connect to, with the port the OS picked if started with port `0`. `None` before the manager is started.
+        '''
+        if self._router is not None:
+            return self._router.address
+        if len(self._shards) != 0:
+            return self._shards[0].server.address
+        return None
+
+    def metrics_url(self):
+        '''
+        Returns:
+          str: The URL Prometheus scrapes, with the port the OS picked if `metrics_port` was `0`. `None` without `metrics_port` or before the manager is started.
+        '''
+        if self._metrics is None:
+            return None
+        return self._metrics.url()
+
+    def _route(self):
+        # Passes each new connection to a shard
+        with self._router as router:
+            while not self._stop_signal:
+                accept_ready, _ = router.select()
+                if not accept_ready:
+                    continue
+                for sock in router.accept_sockets():
+                    shard = min(self._shards, key=lambda shard: shard.load())
+                    shard.routed += 1
+                    shard.server.hand_off(sock)
+
+    def _server_thread(self, shard):
+        last_response = {}
+        # Message the repeated action was given for, the action and the number of repeats left for each vname
+        repeating = {}
+        # Heap of (deadline, sequence number, message) for messages waiting for a response
+        deadlines = []
+        sequence = itertools.count()
+        with shard.server as server:
             while not self._stop_signal:
+                # Messages already responded to need no timer
+                while len(deadlines) != 0 and deadlines[0][2]._response is not None:
+                    heapq.heappop(deadlines)
+                timeout = None
+                if len(deadlines) != 0:
+                    timeout = max(0, deadlines[0][0] - time.monotonic())
+
+                # Sleep until a socket is readable, a response is ready or a deadline passes
+                accept_ready, readable = server.select(timeout)
+
+                # Send responses in the order they were given
+                while not shard.ready.empty():
+                    m = shard.ready.get()
+                    if m._late is not None:
+                        shard.late += 1
+                        if self._late_response == LATE_NEXT:
+                            repeating[m.vname] = (m, m._late, m._repeat)
+                        continue
+
+                    self._send_response(shard, m, last_response)
+                    if m._superseded:
+                        # Not an action the user chose for the vehicle, leave its repeat alone
+                        continue
+                    if m._repeat > 1:
+                        repeating[m.vname] = (m, m._response, m._repeat - 1)
+                    else:
+                        repeating.pop(m.vname, None)
+
+                # Answer the messages whose deadline passed
+                now = time.monotonic()
+                while len(deadlines) != 0 and deadlines[0][0] <= now:
+                    m = heapq.heappop(deadlines)[2]
+                    if m._set_fallback(self._fallback_instr(m, last_response.get(m.vname))):
+                        shard.deadline_missed += 1
+                        self._send_response(shard, m, last_response)
+
                 # Accept new clients
-                addr = server.accept()
-                if addr is not None:
-                    print(f'Got new connection: {addr}')
-                    server.send_instr(addr, INSTR_SEND_STATE)
+                if accept_ready:
+                    for addr in server.accept_all():
+                        print(f'Got new connection: {addr}')
+                        shard.connections += 1
+                        server.send_instr(addr, INSTR_SEND_STATE)
 
                 # Listen for messages from vehicles
-                for addr in server._clients:
-                    msg = server.listen(addr)
-
-                    if msg is not None:
-                        with self._vname_lock:
-                            if msg[KEY_ID] not in self._vnames:
-                                print(f'Got new vehicle: {msg[KEY_ID]}')
-                                vname = msg[KEY_ID]
-                                address_map[vname] = addr
-                                self._vnames.append(vname)
-                                self._vehicle_count += 1
-
-                        assert address_map[msg[KEY_ID]] == addr, "Vehicle changed vname. This violates routing / logging assumptions made by MissionManager"
+                for addr in readable:
+                    states = server.listen_all(addr)
+                    if len(states) != 0 and self._move_home(shard, addr, states):
+                        continue
+                    shard.states += len(states)
+                    received = time.monotonic()
+
+                    for msg in states:
+                        if addr not in shard.connected:
+                            vname = msg[KEY_ID]
+                            with self._vname_lock:
+                                if vname not in self._vnames:
+                                    print(f'Got new vehicle: {vname}')
+                                    self._vnames.append(vname)
+                                    self._vehicle_count += 1
+                                else:
+                                    # Possibly through another shard
+                                    print(f'Vehicle reconnected: {vname}')
+                                shard.addresses[vname] = addr
+                                shard.connected[addr] = vname
+                                self._vehicle_shards[vname] = shard
+
+                        assert shard.addresses.get(msg[KEY_ID]) == addr, "Vehicle changed vname. This violates routing / logging assumptions made by MissionManager"
+                        if self._speed is not None:
+                            self._speed.on_state(msg[KEY_ID], msg['MOOS_TIME'], received)
 
                         m = MissionMessage(
                           addr,
                           msg,
-                          is_transition=self._imm_transition
+                          is_transition=self._imm_transition,
+                          on_response=shard.on_response,
+                          action_repeat=self._action_repeat,
+                          timestamps={'received': received} if self._timing else None
                         )
 
                         with self._ems_lock:
@@ -180,38 +491,139 @@ class MissionManager:
                             else:
                                 self._episode_manager_nums[m.vname] = m.episode_report['NUM']
 
-                        live_msg_list.append(m)
-                        self._msg_queue.put(m)
-
-                # Send responses to vehicle message if there are any
-                for i, m in enumerate(live_msg_list):
-                    with m._rsp_lock:
-                        if m._response is None:
+                        if m.vname in repeating and self._repeat_action(shard, m, repeating, last_response):
                             continue
 
-                        # If we got there is response send and remove from list
-                        live_msg_list.remove(m)
-                        server.send_instr(m._addr, m._response)
-
-                        # Do logging
-                        self._do_logging(m)
+                        deadline = self._response_deadline
+                        if isinstance(deadline, dict):
+                            deadline = deadline.get(m.vname)
+                        if deadline is not None:
+                            heapq.heappush(deadlines, (time.monotonic() + deadline, next(sequence), m))
+
+                        if self._timing:
+                            m.timestamps['queued'] = time.monotonic()
+                        if shard.tracer is not None:
+                            start = trace.now()
+                        old = self._msg_queue.put(m)
+                        if shard.tracer is not None:
+                            shard.tracer.complete('enqueue', start, trace.CAT_MANAGER, {'vname': m.vname})
+                        if old is not None:
+                            self._answer_superseded(old, last_response.get(old.vname))
+
+                for addr in server.hung_up_all():
+                    vname = shard.connected.pop(addr, None)
+                    if vname is not None and shard.addresses[vname] == addr:
+                        # A repeat is not carried over to a new connection
+                        repeating.pop(vname, None)
 
                 # Handle reseting of vehicles
-                while not self._vresets.empty():
-                    vname, success = self._vresets.get()
-
-                    if vname not in address_map:
-                        raise RuntimeError(
-                            f'Received reset for unknown vehicle: {vname}')
+                while not shard.resets.empty():
+                    vname, success = shard.resets.get()
 
                     instr = INSTR_RESET_FAILURE
                     if success:
                         instr = INSTR_RESET_SUCCESS
 
-                    server.send_instr(address_map[vname], instr)
+                    try:
+                        server.send_instr(shard.addresses[vname], instr)
+                    except RuntimeError:
+                        # The vehicle hung up after asking to be reset
+                        pass
+
+    def _move_home(self, shard, addr, states):
+        # With 'hash' assignment moves a new connection to the shard of its vehicle's vname, returns True if it was moved
+        if self._shard_assign != SHARD_HASH:
+            return False
+        if addr in shard.connected:
+            return False
+        vname = states[0][KEY_ID]
+        home = self._shards[zlib.crc32(vname.encode()) % len(self._shards)]
+        if home is shard:
+            return False
+
+        conn = shard.server.detach(addr)
+        # The home shard reads the states again from the connection's backlog
+        conn.backlog.extendleft(reversed(states))
+        shard.connections -= 1
+        home.connections += 1
+        home.server.adopt(addr, conn)
+        return True
+
+    def _send_response(self, shard, msg, last_response):
+        if shard.tracer is not None:
+            start = trace.now()
+        try:
+            shard.server.send_instr(msg._addr, msg._response)
+        except RuntimeError:
+            # The vehicle hung up before the response was given
+            return
+        sent = time.monotonic()
+        last_response[msg.vname] = msg._response
+        if self._speed is not None:
+            self._speed.on_response(msg.vname, sent)
+        if msg.timestamps is not None:
+            msg.timestamps['sent'] = sent
+            self._record_timing(msg)
+        self._do_logging(shard, msg)
+        if shard.tracer is not None:
+            shard.tracer.complete('respond', start, trace.CAT_MANAGER, {'vname': msg.vname})
+
+    def _record_timing(self, msg):
+        t = msg.timestamps
+        timings = self._timings.get(msg.vname)
+        if timings is None:
+            timings = self._timings[msg.vname] = {name: Histogram(FINE_LATENCY_BOUNDS) for name in TIMINGS}
+
+        # Repeated actions and answers given by the manager skip the user
+        if 'dequeued' in t:
+            timings[TIMING_QUEUE].add(t['dequeued'] - t['queued'])
+            if 'acted' in t:
+                timings[TIMING_THINK].add(t['acted'] - t['dequeued'])
+        timings[TIMING_ROUND_TRIP].add(t['sent'] - t['received'])
+
+    def _repeat_action(self, shard, msg, repeating, last_response):
+        # Answers msg with the action being repeated for its vehicle, returns False if the user should see it instead
+        first, instr, left = repeating.pop(msg.vname)
+        if msg.episode_state != first.episode_state or msg.episode_report != first.episode_report:
+            # Let the user handle the episode changing
+            return False
+
+        msg._response = instr
+        self._send_response(shard, msg, last_response)
+        if left > 1:
+            repeating[msg.vname] = (first, instr, left - 1)
+        shard.repeated += 1
+        return True
+
+    def _fallback_instr(self, msg, last_response):
+        if callable(self._fallback):
+            return action_instr(self._fallback(msg))
+        if self._fallback == FALLBACK_LAST_ACTION and last_response is not None:
+            return action_instr({
+                'speed': last_response['speed'],
+                'course': last_response['course']
+            })
+
+        course = 0.0
+        if last_response is not None:
+            course = last_response['course']
+        return action_instr({'speed': 0.0, 'course': course})
+
+    def _answer_superseded(self, msg, last_response):
+        if msg._response is not None:
+            # Already answered, nothing owed to the vehicle
+            return
+        msg._superseded = True
+        if self._superseded == SUPERSEDED_REPEAT and last_response is not None:
+            msg.act({
+                'speed': last_response['speed'],
+                'course': last_response['course']
+            }, repeat=1)
+        else:
+            msg.request_new()
 
     # This message should only be called on msgs which have actions
-    def _do_logging(self, msg):
+    def _do_logging(self, shard, msg):
         if not self._log:
             return
         
@@ -220,24 +632,7 @@ class MissionManager:
             if msg.vname not in self._log_whitelist:
                 return
 
-        # Check if this is a new vehicle
-        if msg.vname not in self._logs:
-            path = os.path.join(self._log_path, f"log_{msg.vname}")
-            self._logs[msg.vname] = ProtoLogger(path, Transition, mode='w')
-
-        if msg._is_transition:
-            # Write a transition if this is not the first state ever
-            if msg.vname in self._last_state:
-                t = Transition()
-                t.s1.CopyFrom(translate.state_from_dict(self._last_state[msg.vname]))
-                t.a.CopyFrom(translate.action_from_dict(self._last_act[msg.vname]))
-                t.s2.CopyFrom(translate.state_from_dict(msg.state))
-
-                self._logs[msg.vname].write(t)
-
-            # Update the storage for next transition
-            self._last_state[msg.vname] = msg.state
-            self._last_act[msg.vname] = msg._response
+        shard.transitions.record(msg.vname, msg.state, msg._response, msg._is_transition)
 
     def are_present(self, vnames):
         '''
@@ -265,7 +660,7 @@ class MissionManager:
         while not self.are_present(vnames):
             time.sleep(sleep)
 
-    def get_message(self, block=True):
+    def get_message(self, block=True, vname=None, vnames=None):
         '''
         Used as the primary method for receiving data from `BHV_Agent`.
 
@@ -273,6 +668,8 @@ class MissionManager:
 
         Args:
           block (bool): A boolean specifying if the method will wait until a message present or return immediately
+          vname (str): Only return a message from this vehicle
+          vnames (iterable): Only return a message from one of these vehicles, for example to run one controller thread per team
 
         Returns:
           obj: A instance of [`MissionMessage()`][mivp_agent.manager.MissionMessage] or `None` depending on the blocking behavior
@@ -294,10 +691,129 @@ class MissionManager:
             })
           ```
         '''
-        try:
-            return self._msg_queue.get(block=block)
-        except Empty:
-            return None
+        if vname is not None:
+            assert vnames is None, 'Only one of vname and vnames can be given'
+            vnames = (vname, )
+        msg = self._msg_queue.get(block=block, vnames=vnames)
+        if msg is not None and msg.timestamps is not None:
+            msg.timestamps['dequeued'] = time.monotonic()
+        if msg is not None and self._tracer is not None:
+            msg._trace_start = trace.now()
+        return msg
+
+    def get_messages(self, max_n=None, timeout=None, vnames=None):
+        '''
+        Used to receive every message available at once, so a model can run one batched forward pass over them instead of one pass per vehicle.
+
+        **NOTE:** Like with [`get_message()`][mivp_agent.manager.MissionManager.get_message] every message **MUST** be responded to, [`MessageBatch.act()`][mivp_agent.messages.MessageBatch.act] does so for the whole batch.
+
+        Args:
+          max_n (int): The most messages to return, no limit if `None`
+          timeout (float): Seconds to wait for the first message. `None` waits until one arrives and `0` does not wait.
+          vnames (iterable): Only return messages from these vehicles
+
+        Returns:
+          obj: A [`MessageBatch`][mivp_agent.messages.MessageBatch], empty if the timeout expired
+
+        Example:
+          ```
+            batch = mgr.get_messages()
+
+            obs = batch.stack(['NAV_X', 'NAV_Y', 'NAV_HEADING'])
+            speeds, courses = model.predict(obs)
+
+            batch.act(speeds, courses)
+          ```
+        '''
+        msgs = self._msg_queue.get_many(max_n, timeout, vnames)
+        if self._timing:
+            now = time.monotonic()
+            for msg in msgs:
+                msg.timestamps['dequeued'] = now
+        if self._tracer is not None:
+            start = trace.now()
+            for msg in msgs:
+                msg._trace_start = start
+        return MessageBatch(msgs)
+
+    def stats(self):
+        '''
+        Returns:
+          dict: Delivery counters with the following keys
+
+            - `queued`: Messages waiting for `get_message()`
+            - `peak`: The most messages queued at once
+            - `coalesced`: Messages replaced by a newer one before being handed out
+            - `dropped`: Messages dropped because `max_queue` was reached
+            - `blocked`: Times reading from the vehicles waited for room in the queue
+            - `repeated`: States answered by repeating an action
+            - `deadline_missed`: Fallbacks sent because the `response_deadline` passed
+            - `late`: Responses given after their fallback
+            - `queue_ages`: For each vehicle with messages queued, the seconds its oldest message has waited
+            - `shards`: A dict for each shard with its `address`, the `connections` and `vehicles` it served, the `open_connections` and `connected_vehicles` it serves now, the `states` and `bytes_received` from them, the `bytes_sent` to them and its own `repeated`, `deadline_missed` and `late` counts
+            - `states`, `bytes_received`, `bytes_sent`: Totals since the manager started, bytes include the frame headers
+            - `states_per_sec`, `bytes_received_per_sec`, `bytes_sent_per_sec`: Rates since the last call to `stats()`, or since the manager started
+            - `timing`: With `timing` on, for each vehicle histograms (see [`Histogram.to_dict()`][mivp_agent.util.histogram.Histogram.to_dict]) in seconds of the `queue` dwell from a message being queued to the user taking it, the `think` time from the user taking it to the response and the `round_trip` from the manager reading it to sending the response
+            - `speed`: With `timing` on, for each vehicle the effective time warp of its simulation and the share of its helm period spent waiting for the model, with a `model_bound` flag when the model is what slows the simulation down, see [`SpeedMonitor`][mivp_agent.util.speed.SpeedMonitor]. Also written to `speed.json` in the session's log directory on close.
+            - `log`: With `log` on, the compressed `bytes_written` to the transition logs, the number of `flushes` of their buffers to gzip files and the `flush_seconds` spent on them
+        '''
+        stats, self._last_stats = self._stats(self._last_stats)
+        return stats
+
+    def _stats(self, last):
+        # Returns the stats with rates since last, along with the values to pass as last next time
+        shards = [shard.stats() for shard in self._shards]
+        totals = (
+            sum(shard['states'] for shard in shards),
+            sum(shard['bytes_received'] for shard in shards),
+            sum(shard['bytes_sent'] for shard in shards),
+        )
+        rates = (0.0, 0.0, 0.0)
+        now = time.monotonic()
+        if last is not None:
+            elapsed = now - last[0]
+            if elapsed > 0:
+                rates = tuple((total - before)/elapsed for total, before in zip(totals, last[1:]))
+            last = (now, ) + totals
+
+        timing = None
+        if self._timing:
+            timing = {
+                vname: {name: h.to_dict() for name, h in timings.items()}
+                for vname, timings in list(self._timings.items())
+            }
+        log = None
+        if self._log:
+            # The shards share a log unless each child process writes its own
+            logs = [self._transitions]
+            if self._process_mode:
+                logs = [shard.transitions for shard in self._shards]
+            log = {
+                'bytes_written': sum(l.bytes_written for l in logs),
+                'flushes': sum(l.flushes for l in logs),
+                'flush_seconds': sum(l.flush_seconds for l in logs),
+            }
+        return {
+            'queued': len(self._msg_queue),
+            'peak': self._msg_queue.peak,
+            'coalesced': self._msg_queue.coalesced,
+            'dropped': self._msg_queue.dropped,
+            'blocked': self._msg_queue.blocked,
+            'repeated': sum(shard['repeated'] for shard in shards),
+            'deadline_missed': sum(shard['deadline_missed'] for shard in shards),
+            'late': sum(shard['late'] for shard in shards),
+            'queue_ages': self._msg_queue.ages(),
+            'shards': shards,
+            'states': totals[0],
+            'bytes_received': totals[1],
+            'bytes_sent': totals[2],
+            'states_per_sec': rates[0],
+            'bytes_received_per_sec': rates[1],
+            'bytes_sent_per_sec': rates[2],
+            'timing': timing,
+            'speed': None if self._speed is None else self._speed.stats(),
+            'log': log,
+        }, last
 
     def get_vehicle_count(self):
         '''
@@ -330,15 +846,49 @@ class MissionManager:
 
     def reset_vehicle(self, vname, success=False):
         # Untested
-        self._vresets.append((vname, success))
+        with self._vname_lock:
+            shard = self._vehicle_shards.get(vname)
+        if shard is None:
+            raise RuntimeError(f'Received reset for unknown vehicle: {vname}')
+        shard.resets.put((vname, success))
+        shard.server.wakeup()
 
     def close(self):
-        if self._thread is not None:
+        if self._metrics is not None:
+            self._metrics.close()
+        if len(self._shards) != 0:
             self._stop_signal = True
-            self._thread.join()
-        if self._log:
-            for vehicle in self._logs:
-                self._logs[vehicle].close()
+            self._msg_queue.close()
+            if self._router is not None:
+                self._router.wakeup()
+                self._router_thread.join()
+            for shard in self._shards:
+                shard.server.wakeup()
+                shard.thread.join()
+
+            # Don't point new vehicles at a closed manager
+            address = self.address()
+            if self._address_file is not None and read_address(self._address_file) == address:
+                os.remove(self._address_file)
+            if self._export_address and os.environ.get(ENV_ADDRESS) == address:
+                del os.environ[ENV_ADDRESS]
+        if self._log and not self._process_mode:
+            self._transitions.close()
+        if self._log and self._speed is not None:
+            self._speed.save(os.path.join(self._log_path, SPEED_FILE))
+        if self._trace_path is not None:
+            self._tracer.dump(self._trace_path)
+
+    def dump_trace(self, path):
+        '''
+        Writes the spans recorded so far to `path` as Chrome Trace Event JSON, see the `trace` argument of [`MissionManager`][mivp_agent.manager.MissionManager]. Recording carries on.
+
+        Raises:
+          RuntimeError: If the manager was created without `trace`
+        '''
+        if self._tracer is None:
+            raise RuntimeError('Tracing is off, create the manager with trace')
+        self._tracer.dump(path)
 
 
     def __exit__(self, exc_type, exc_value, traceback):
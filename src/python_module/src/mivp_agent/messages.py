@@ -1,5 +1,8 @@
+import time
 from threading import Lock
 
+import numpy as np
+
 from mivp_agent.const import KEY_ID
 from mivp_agent.const import KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE
 from mivp_agent.util.validate import validateAction
@@ -52,11 +55,23 @@ INSTR_RESET_FAILURE = {
     'ctrl_msg': 'SEND_STATE'
 }
 
+def action_instr(action):
+    '''
+    Builds the instruction sent to `BHV_Agent` for an action given to [`MissionMessage.act()`][mivp_agent.messages.MissionMessage.act].
+    '''
+    # Copy so we don't run into threading errors if client reuses the action dict
+    instr = action.copy()
+    if 'posts' not in action:
+        instr['posts'] = {}
+    validateAction(instr)
+    instr['ctrl_msg'] = 'SEND_STATE'
+    return instr
+
 class MissionMessage:
     '''
     This class is used to parse incoming messages into attributes (see below) and provide a simple interface for responding to each message.
 
-    **IMPORTANT NOTE:** Messages **MUST** be responded by one of the following methods to as `BHV_Agent` will not send another update until it has a response to the last.
+    **IMPORTANT NOTE:** Messages **MUST** be responded by one of the following methods to as `BHV_Agent` will not send another update until it has a response to the last. Unless the manager has a `response_deadline`, after which it sends a fallback response itself.
 
       - [`act(action)`][mivp_agent.manager.MissionMessage.act] **<---- Most common**
       - [`request_new()`][mivp_agent.manager.MissionMessage.request_new]
@@ -69,14 +84,26 @@ class MissionMessage:
       state (dict): A dictionary containing key, value pairs of MOOS vars and their associated value at the time the message was created by `BHV_Agent`.
       episode_report (dict or None): If `pEpisodeManager` is present on the vehicle this message will contain any "report" generated by it at the end of episodes. If no `pEpisodeManager` is present, the **value will be** `None`.
       episode_state (str or None): If `pEpisodeManager` is present on the vehicle this message will be the state which that app is broadcasting. Otherwise, it will be `None`.
+      timestamps (dict or None): The `time.monotonic()` at which the message was `received` by the manager, `queued` for `get_message()`, `dequeued` by the user, `acted` on and its response `sent`, each once it has happened. `None` when the manager's `timing` is off.
 
     '''
 
-    def __init__(self, addr, msg, is_transition=True):
+    def __init__(self, addr, msg, is_transition=True, on_response=None, action_repeat=1, timestamps=None):
         # For use my MissionManager
         self._addr = addr
         self._response = None
+        self._action_repeat = action_repeat
+        self._repeat = 1
+        # Set when the manager answered with a fallback because the response deadline passed
+        self._missed = False
+        self._late = None
+        # Set when the manager answered because a newer state of the vehicle replaced it in the queue
+        self._superseded = False
         self._rsp_lock = Lock()
+        self._on_response = on_response
+        self.timestamps = timestamps
+        # trace.now() when the user took the message, set with tracing on
+        self._trace_start = None
 
         # For use by client
         self.state = msg
@@ -90,20 +117,48 @@ class MissionMessage:
         self._is_transition = is_transition
 
     def _assert_no_rsp(self):
-        assert self._response is None, 'This message has already been responded to'
+        assert self._response is None or (self._missed and self._late is None), 'This message has already been responded to'
+
+    def _set_response(self, instr):
+        if self.timestamps is not None:
+            self.timestamps['acted'] = time.monotonic()
+        with self._rsp_lock:
+            self._assert_no_rsp()
+            if self._missed:
+                # Too late, the manager has already sent a fallback
+                self._late = instr
+            else:
+                self._response = instr
+
+        # Let the manager know there is a response to send
+        if self._on_response is not None:
+            self._on_response(self)
+
+    def _set_fallback(self, instr):
+        # Used by the manager once the response deadline has passed, returns False if the message was answered in time
+        with self._rsp_lock:
+            if self._response is not None:
+                return False
+            self._response = instr
+            self._missed = True
+            return True
 
     def mark_transition(self):
         with self._rsp_lock:
+            if self._missed:
+                # Already logged with the fallback response
+                return
             assert self._response is None, "A message's state can only be marked at a transition before a response to that message has been set."
 
             self._is_transition = True
 
-    def act(self, action):
+    def act(self, action, repeat=None):
         '''
         This is used to send an action for the `BHV_Agent` to execute.
 
         Args:
           action (dict): An action to send (see below)
+          repeat (int): The number of states, counting this one, to answer with the action. The `MissionManager` answers the next `repeat-1` states of the vehicle by itself and they are logged but never returned by `get_message()`. Repeating stops early when the state of the vehicle's `pEpisodeManager` changes. Defaults to the manager's `action_repeat`.
 
         Example:
           Actions submitted through `MissionMessage` are python dictionaries with the following **required** fields.
@@ -126,15 +181,14 @@ class MissionMessage:
           ``` 
         '''
         self._assert_no_rsp()
-        # Copy so we don't run into threading errors if client reuses the action dict
-        instr = action.copy()
-        if 'posts' not in action:
-            instr['posts'] = {}
-        validateAction(instr)
-        instr['ctrl_msg'] = 'SEND_STATE'
+        instr = action_instr(action)
 
-        with self._rsp_lock:
-            self._response = instr
+        if repeat is None:
+            repeat = self._action_repeat
+        assert isinstance(repeat, int) and repeat >= 1, 'repeat must be an int of at least 1'
+        self._repeat = repeat
+
+        self._set_response(instr)
 
     def start(self):
         '''
@@ -151,8 +205,7 @@ class MissionMessage:
         ```
         '''
         self._assert_no_rsp()
-        with self._rsp_lock:
-            self._response = INSTR_START
+        self._set_response(INSTR_START)
 
     def pause(self):
         '''
@@ -169,8 +222,7 @@ class MissionMessage:
         ```
         '''
         self._assert_no_rsp()
-        with self._rsp_lock:
-            self._response = INSTR_PAUSE
+        self._set_response(INSTR_PAUSE)
 
     def stop(self):
         '''
@@ -188,8 +240,7 @@ class MissionMessage:
         '''
         self._assert_no_rsp()
 
-        with self._rsp_lock:
-            self._response = INSTR_STOP
+        self._set_response(INSTR_STOP)
 
     def request_new(self):
         '''
@@ -197,5 +248,67 @@ class MissionMessage:
         '''
         self._assert_no_rsp()
 
-        with self._rsp_lock:
-            self._response = INSTR_SEND_STATE
+        self._set_response(INSTR_SEND_STATE)
+
+
+class MessageBatch:
+    '''
+    A group of [`MissionMessage`][mivp_agent.manager.MissionMessage]s returned by [`get_messages()`][mivp_agent.manager.MissionManager.get_messages], so a model can run once over the states of many vehicles. Each message in the batch still needs a response, which [`act()`][mivp_agent.messages.MessageBatch.act] gives to all of them at once.
+
+    Attributes:
+      msgs (list): The messages in the batch, rows of the arrays below are in the same order.
+      vnames (list): The vname of each message.
+    '''
+
+    def __init__(self, msgs):
+        self.msgs = list(msgs)
+        self.vnames = [msg.vname for msg in self.msgs]
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def __iter__(self):
+        return iter(self.msgs)
+
+    def __getitem__(self, i):
+        return self.msgs[i]
+
+    def stack(self, keys, dtype=np.float32):
+        '''
+        Stacks state values into one array.
+
+        Args:
+          keys (list): The state keys to use as columns, for example `['NAV_X', 'NAV_Y', 'NAV_HEADING']`
+          dtype (type): The numpy type of the array
+
+        Returns:
+          np.ndarray: Shape `(len(batch), len(keys))`. Booleans become `0` or `1` and `None` becomes `nan`.
+        '''
+        rows = [
+            [np.nan if msg.state[key] is None else msg.state[key] for key in keys]
+            for msg in self.msgs
+        ]
+        return np.array(rows, dtype=dtype).reshape(len(self.msgs), len(keys))
+
+    def act(self, speeds, courses, posts=None, repeat=None):
+        '''
+        Responds to every message in the batch, see [`MissionMessage.act()`][mivp_agent.manager.MissionMessage.act].
+
+        Args:
+          speeds (array_like): One speed per message or a single speed for all of them
+          courses (array_like): One course per message or a single course for all of them
+          posts (dict or list): `None` for no posts, a dict of posts for every message or a list with a dict (or `None`) per message
+          repeat (int): Passed on to each `MissionMessage.act()`
+        '''
+        n = len(self.msgs)
+        speeds = np.broadcast_to(np.asarray(speeds, dtype=np.float64), (n, ))
+        courses = np.broadcast_to(np.asarray(courses, dtype=np.float64), (n, ))
+        if posts is None or isinstance(posts, dict):
+            posts = [posts]*n
+        assert len(posts) == n, 'posts must have one entry per message'
+
+        for msg, speed, course, post in zip(self.msgs, speeds.tolist(), courses.tolist(), posts):
+            action = {'speed': speed, 'course': course}
+            if post is not None:
+                action['posts'] = post
+            msg.act(action, repeat=repeat)
@@ -0,0 +1,172 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'mivp_agent_'
+QUANTILES = (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'))
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Family:
+    '''
+    The samples of one metric as they are written out.
+    '''
+    def __init__(self, name, type, help):
+        self.name = PREFIX + name
+        self.type = type
+        self.help = help
+        self.samples = []
+
+    def add(self, value, suffix='', **labels):
+        if value is None:
+            return
+        self.samples.append((self.name + suffix, labels, value))
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.type}')
+        for name, labels, value in self.samples:
+            if len(labels) != 0:
+                name += '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+            lines.append(f'{name} {float(value)!r}')
+
+class MetricsServer:
+    '''
+    Serves the stats of a [`MissionManager`][mivp_agent.manager.MissionManager] at `http://<hostname>:<port>/metrics` in the Prometheus text format, so headless training runs can be scraped and graphed. Started by the manager when given a `metrics_port`.
+
+    Each scrape is answered from the server's own thread with a snapshot of the manager's counters, which only takes the manager's locks for as long as a call to `stats()` does. Rates are over the time since the last scrape and do not change those returned by the manager's `stats()`.
+
+    Args:
+      mgr (MissionManager): The manager to report on
+      port (int): Port to listen on, `0` lets the OS pick one which is then held by the `port` attribute
+      hostname (str): Host to listen on, only this machine by default
+    '''
+
+    def __init__(self, mgr, port, hostname='localhost'):
+        self._mgr = mgr
+        self._last = None
+        # Scrapes may overlap, the rates need the last one to be done
+        self._lock = Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would fill the terminal
+                pass
+
+        self._httpd = ThreadingHTTPServer((hostname, port), Handler)
+        self._httpd.daemon_threads = True
+        self.hostname = hostname
+        self.port = self._httpd.server_address[1]
+        self._thread = None
+
+    def url(self):
+        return f'http://{self.hostname}:{self.port}/metrics'
+
+    def start(self):
+        self._last = (time.monotonic(), 0, 0, 0)
+        self._thread = Thread(target=self._httpd.serve_forever, name='mivp-metrics', daemon=True)
+        self._thread.start()
+
+    def render(self):
+        '''
+        Returns:
+          str: The current metrics in the Prometheus text format
+        '''
+        with self._lock:
+            stats, self._last = self._mgr._stats(self._last)
+        mgr = self._mgr
+
+        families = []
+        def family(name, type, help):
+            f = _Family(name, type, help)
+            families.append(f)
+            return f
+
+        family('vehicles', GAUGE, 'Vehicles currently connected').add(sum(shard['connected_vehicles'] for shard in stats['shards']))
+        family('connections', GAUGE, 'Open connections to the shards').add(sum(shard['open_connections'] for shard in stats['shards']))
+        family('vehicles_total', COUNTER, 'Vehicles which have connected').add(mgr.get_vehicle_count())
+        family('connections_total', COUNTER, 'Connections accepted by the shards').add(sum(shard['connections'] for shard in stats['shards']))
+        family('queue_depth', GAUGE, 'Messages waiting for the user').add(stats['queued'])
+        family('queue_peak', GAUGE, 'Most messages waiting at once').add(stats['peak'])
+        family('states_per_second', GAUGE, 'States received per second since the last scrape').add(stats['states_per_sec'])
+
+        for key, help in (
+            ('states', 'States received from the vehicles'),
+            ('bytes_received', 'Frame bytes received from the vehicles'),
+            ('bytes_sent', 'Frame bytes sent to the vehicles'),
+            ('coalesced', 'Messages replaced by a newer one before being handed out'),
+            ('dropped', 'Messages dropped because the queue was full'),
+            ('blocked', 'Times reading from the vehicles waited for room in the queue'),
+            ('repeated', 'States answered by repeating an action'),
+            ('deadline_missed', 'Fallbacks sent because the response deadline passed'),
+            ('late', 'Responses given after their fallback'),
+        ):
+            family(f'{key}_total', COUNTER, help).add(stats[key])
+
+        states = family('shard_states_total', COUNTER, 'States received by each shard')
+        for i, shard in enumerate(stats['shards']):
+            states.add(shard['states'], shard=i)
+
+        episodes = family('episode', GAUGE, "Episode number reported by each vehicle's pEpisodeManager")
+        for vname, num in mgr.episode_nums().items():
+            episodes.add(num, vname=vname)
+
+        if stats['timing'] is not None:
+            for name, help in (
+                ('queue', 'Seconds from a message being queued to the user taking it'),
+                ('think', 'Seconds from the user taking a message to responding'),
+                ('round_trip', 'Seconds from a state being read to the response being sent'),
+            ):
+                f = family(f'{name}_seconds', SUMMARY, help)
+                for vname, timings in stats['timing'].items():
+                    h = timings[name]
+                    for quantile, key in QUANTILES:
+                        f.add(h[key], quantile=quantile, vname=vname)
+                    f.add(h['count'], '_count', vname=vname)
+                    f.add((h['mean'] or 0.0)*h['count'], '_sum', vname=vname)
+
+        if stats['speed'] is not None:
+            warp = family('warp', GAUGE, 'Simulated seconds per wall clock second of each vehicle, recently')
+            share = family('model_wait_share', GAUGE, "Share of each vehicle's helm period spent waiting for the model, recently")
+            bound = family('model_bound', GAUGE, 'Whether the model rather than the simulation limits the speed of each vehicle')
+            for vname, speed in stats['speed'].items():
+                if speed is not None:
+                    warp.add(speed['recent_warp'], vname=vname)
+                    share.add(speed['recent_model_wait_share'], vname=vname)
+                    bound.add(speed['model_bound'], vname=vname)
+
+        if stats['log'] is not None:
+            family('log_bytes_written_total', COUNTER, 'Compressed bytes written to the transition logs').add(stats['log']['bytes_written'])
+            family('log_flushes_total', COUNTER, 'Transition log buffers flushed to gzip files').add(stats['log']['flushes'])
+            family('log_flush_seconds_total', COUNTER, 'Seconds spent flushing transition log buffers').add(stats['log']['flush_seconds'])
+
+        lines = []
+        for f in families:
+            f.render(lines)
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
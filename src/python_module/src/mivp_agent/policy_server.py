@@ -0,0 +1,234 @@
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import deque
+from threading import Thread
+
+from mivp_agent.util.histogram import Histogram, LATENCY_BOUNDS, SIZE_BOUNDS
+
+# Longest the threads go without checking if they should stop
+POLL_INTERVAL = 0.1
+
+RESULT_OK = 'ok'
+RESULT_ERROR = 'error'
+
+def _work(make_policy, conn):
+    # Entry point of a worker process
+    try:
+        policy = make_policy()
+        while True:
+            states = conn.recv()
+            if states is None:
+                return
+            actions = list(policy(states))
+            if len(actions) != len(states):
+                raise ValueError(f'Policy returned {len(actions)} actions for {len(states)} states')
+            conn.send((RESULT_OK, actions))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception:
+        conn.send((RESULT_ERROR, traceback.format_exc()))
+    finally:
+        conn.close()
+
+class _Policy:
+    '''
+    The worker process of one policy and the batches on their way through it.
+    '''
+    def __init__(self, name, make_policy, context):
+        self.name = name
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_work, args=(make_policy, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        # Messages with the time they were taken from the manager
+        self.pending = []
+        self.opened = None
+        # Batches sent to the worker in order, each a list of (message, time)
+        self.in_flight = deque()
+
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.batch_size = Histogram(SIZE_BOUNDS)
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        self.opened = None
+        self.in_flight.append(batch)
+        self.conn.send([msg.state for msg, _ in batch])
+
+    def stats(self):
+        return {
+            'batches': self.batch_size.count,
+            'states': self.latency.count,
+            'latency': self.latency.to_dict(),
+            'batch_size': self.batch_size.to_dict(),
+        }
+
+class PolicyServer:
+    '''
+    Serves several policies at once on top of a [`MissionManager`][mivp_agent.manager.MissionManager], for example attackers, defenders and baselines in the same mission. Each policy runs in its own worker process and is given micro-batches of the states of its vehicles, the actions it returns are sent back to the right [`MissionMessage`][mivp_agent.messages.MissionMessage].
+
+    A batch is sent to the worker once `window` seconds have passed since its first state or it holds `max_batch` states. Only the vehicles in `assign` are served. Messages from other vehicles are left for the user's own loop, which must pass their vnames to `get_message()` so it does not take messages meant for a policy.
+
+    Args:
+      mgr (MissionManager): A started manager
+      policies (dict): Name of each policy to a function which builds it, called in the worker process. The policy is called with a list of state dicts and returns a list of actions like those given to [`MissionMessage.act()`][mivp_agent.messages.MissionMessage.act], one for each state.
+      assign (dict): The name of the policy for each vname
+      window (float): Seconds to collect states for a batch
+      max_batch (int): The most states in a batch, no limit if `None`
+      start_method (str): How the workers are started, see `multiprocessing.get_context()`. With `'fork'` the policies need not be picklable, but the workers are copies of a process whose manager threads are running: only the forking thread carries on in them, so building a policy must not use the manager or anything else those threads may hold a lock on. With `'spawn'` the workers start afresh and each function in `policies` must be picklable, such as a module level function.
+
+    Example:
+      ```
+      with MissionManager('trainer') as mgr:
+        policies = {
+          'attack': lambda: Attacker.load('attacker.pt'),
+          'defend': lambda: Defender.load('defender.pt'),
+        }
+        with PolicyServer(mgr, policies, {'felix': 'attack', 'evan': 'defend'}) as server:
+          while True:
+            time.sleep(10)
+            print(server.stats())
+      ```
+    '''
+
+    def __init__(self, mgr, policies, assign, window=0.005, max_batch=None, start_method='fork'):
+        for vname, name in assign.items():
+            if name not in policies:
+                raise ValueError(f"Vehicle '{vname}' is assigned unknown policy '{name}'")
+        if max_batch is not None and max_batch < 1:
+            raise ValueError(f'max_batch must be at least 1, got {max_batch}')
+        self._mgr = mgr
+        self._make_policies = policies
+        self._assign = dict(assign)
+        self._window = window
+        self._max_batch = max_batch
+        self._start_method = start_method
+
+        self._policies = {}
+        self._threads = []
+        self._stop_signal = False
+        # (policy name, traceback) of the first worker or action to fail
+        self._error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def start(self):
+        '''
+        Starts a worker process for each policy along with the threads feeding them.
+
+        Returns:
+          bool: False if already started, True otherwise
+        '''
+        if len(self._policies) != 0:
+            return False
+
+        context = multiprocessing.get_context(self._start_method)
+        for name, make_policy in self._make_policies.items():
+            self._policies[name] = _Policy(name, make_policy, context)
+
+        self._threads = [
+            Thread(target=self._dispatch, daemon=True),
+            Thread(target=self._collect, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return True
+
+    def _dispatch(self):
+        # Takes the messages of the assigned vehicles and sends them to the workers in batches
+        vnames = list(self._assign)
+        while not self._stop_signal:
+            timeout = POLL_INTERVAL
+            opened = [p.opened for p in self._policies.values() if p.opened is not None]
+            if len(opened) != 0:
+                timeout = max(0, min(opened) + self._window - time.monotonic())
+
+            batch = self._mgr.get_messages(timeout=timeout, vnames=vnames)
+            now = time.monotonic()
+            for msg in batch:
+                policy = self._policies[self._assign[msg.vname]]
+                if policy.opened is None:
+                    policy.opened = now
+                policy.pending.append((msg, now))
+                if self._max_batch is not None and len(policy.pending) == self._max_batch:
+                    policy.flush()
+
+            for policy in self._policies.values():
+                if policy.opened is not None and now - policy.opened >= self._window:
+                    policy.flush()
+
+    def _collect(self):
+        # Answers the messages with the actions coming back from the workers
+        policies = {policy.conn: policy for policy in self._policies.values()}
+        while not self._stop_signal:
+            for conn in wait(list(policies), POLL_INTERVAL):
+                policy = policies[conn]
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    result = (RESULT_ERROR, f"Worker of policy '{policy.name}' exited")
+                if result[0] == RESULT_ERROR:
+                    if self._error is None:
+                        self._error = (policy.name, result[1])
+                    self._stop_signal = True
+                    return
+
+                batch = policy.in_flight.popleft()
+                failed = False
+                for (msg, _), action in zip(batch, result[1]):
+                    try:
+                        msg.act(action)
+                    except Exception:
+                        # Still answer the rest of the batch so its vehicles are not left waiting
+                        if self._error is None:
+                            self._error = (policy.name, traceback.format_exc())
+                        failed = True
+                if failed:
+                    self._stop_signal = True
+                    return
+                done = time.monotonic()
+                for _, taken in batch:
+                    policy.latency.add(done - taken)
+                policy.batch_size.add(len(batch))
+
+    def stats(self):
+        '''
+        Returns:
+          dict: For each policy, the number of `batches` and `states` served and histograms (see [`Histogram.to_dict()`][mivp_agent.util.histogram.Histogram.to_dict]) of the `latency` in seconds from a message being taken from the manager to its action being given and of the `batch_size`
+        '''
+        return {name: policy.stats() for name, policy in self._policies.items()}
+
+    def close(self):
+        '''
+        Stops the threads and worker processes.
+
+        Raises:
+          RuntimeError: If a policy raised an exception or returned an action which could not be sent, with its traceback
+        '''
+        self._stop_signal = True
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for policy in self._policies.values():
+            try:
+                policy.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            policy.process.join(POLL_INTERVAL*10)
+            if policy.process.is_alive():
+                policy.process.terminate()
+                policy.process.join()
+            policy.conn.close()
+
+        if self._error is not None:
+            name, tb = self._error
+            self._error = None
+            raise RuntimeError(f"Policy '{name}' failed:\n{tb}")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -6,6 +6,7 @@ import gzip
 from google.protobuf import message
 
 from mivp_agent.util import packit
+from mivp_agent.util import trace
 
 from google.protobuf.message import Message
 from google.protobuf.reflection import GeneratedProtocolMessageType
@@ -20,9 +21,9 @@ MODES_SUPPORTED = (
 
 class ProtoLogger:
   '''
-  max_msgs will not be used in MODE_READ
+  max_msgs will not be used in MODE_READ. A `mivp_agent.util.trace.Tracer` given as `tracer` records spans of serializing messages into the buffer and of writing it to gzip.
   '''
-  def __init__(self, path, type, mode='r', max_msgs=1000):
+  def __init__(self, path, type, mode='r', max_msgs=1000, tracer=None):
     assert mode in MODES_SUPPORTED, f"Unsupported mode '{mode}'"
 
     if mode == MODE_WRITE:
@@ -43,11 +44,16 @@ class ProtoLogger:
     self._path = path
     self._type = type
     self._mode = mode
+    self._tracer = tracer
 
     self._max_msgs = max_msgs
     self._msg_count = 0
 
     self._buffer = bytearray()
+    # Compressed bytes written to the .gz files, the number of files and the seconds spent writing them
+    self.bytes_written = 0
+    self.flushes = 0
+    self.flush_seconds = 0.0
 
     # Open the directory
     if self._mode == MODE_WRITE:
@@ -83,8 +89,12 @@ class ProtoLogger:
     assert isinstance(message, Message), "Message must be protobuf message"
     assert isinstance(message, self._type), "Message not of type specified by constructor"
 
+    if self._tracer is not None:
+      start = trace.now()
     self._buffer.extend(packit.pack(message.SerializeToString()))
     self._msg_count += 1
+    if self._tracer is not None:
+      self._tracer.complete('log_buffer', start, trace.CAT_LOG)
 
     if self._msg_count >= self._max_msgs:
       self._write_buffer()
@@ -94,13 +104,21 @@ class ProtoLogger:
     if self._msg_count == 0:
       return
 
+    if self._tracer is not None:
+      start = trace.now()
+      size = len(self._buffer)
+
     # Incase something goes wrong, don't crash
     try:
+      started = time.perf_counter()
       save_path = os.path.join(self._path, f'{self._time_stamp}-{self._current_idx}.gz')
 
       # Use gzip in write bytes mode
       with gzip.open(save_path, 'wb') as gz:
         gz.write(self._buffer)
+      self.bytes_written += os.path.getsize(save_path)
+      self.flushes += 1
+      self.flush_seconds += time.perf_counter() - started
 
       # Clean up
       self._current_idx += 1
@@ -109,6 +127,8 @@ class ProtoLogger:
     except Exception as e:
       print(e, file=sys.stderr)
       print("Warning: unable to write to gzip file, deffering write", file=sys.stderr)
+    if self._tracer is not None:
+      self._tracer.complete('log_flush', start, trace.CAT_LOG, {'bytes': size})
   
   def has_more(self):
     assert self._mode == MODE_READ, "Method has_more() only supported in write mode"
@@ -0,0 +1,393 @@
+import os
+import sys
+import time
+import pickle
+import socket
+import selectors
+import multiprocessing
+from collections import deque
+
+from mivp_agent import shm
+from mivp_agent.bridge import ModelBridgeServer, send_fds, SHM_MAX_SLEEP
+from mivp_agent.const import KEY_ID
+from mivp_agent.log.transitions import TransitionLog
+from mivp_agent.util.trace import Tracer
+
+'''
+Runs the `ModelBridgeServer` of a `MissionManager(process_mode=True)` in a child process, so reading from the vehicles, decoding their states and writing logs do not compete with the user's model for the GIL.
+
+The two processes exchange pickled events over a pair of `mivp_agent.shm` rings. A socket pair serves as the doorbell for a process sleeping in `select()`.
+'''
+
+SLOTS = 1024
+SLOT_SIZE = 1024
+
+START_TIMEOUT = 10.0
+
+# Events from the child
+EVENT_READY = 'ready'
+EVENT_ERROR = 'error'
+EVENT_ACCEPT = 'accept'
+EVENT_STATES = 'states'
+EVENT_COUNTS = 'counts'
+EVENT_HANG_UP = 'hang_up'
+EVENT_LOG = 'log'
+# Most events pickled into one frame, keeps frames well below the size of the ring
+MAX_EVENTS = 64
+# Seconds between attempts to push to a full ring
+FULL_SLEEP = 0.0005
+# States of each vehicle the parent remembers, so CMD_LOG can name a state the child kept instead of sending it back. The child keeps twice as many as some may still be on their way to the parent.
+KEPT_STATES = 16
+
+# Commands from the parent
+CMD_SEND = 'send'
+CMD_LOG = 'log'
+CMD_CLOSE = 'close'
+
+class _Channel:
+  '''
+  One end of the link between the processes.
+  '''
+  def __init__(self, rings, bell, peer_alive):
+    self.rings = rings
+    self.bell = bell
+    self._peer_alive = peer_alive
+    # Items taken from the peer while waiting to push
+    self._backlog = []
+
+  def push(self, item):
+    data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+    while True:
+      try:
+        wake = self.rings.tx.push(0, data)
+        break
+      except ConnectionError:
+        # Ring full, fine as long as the peer is alive to empty it
+        if not self._peer_alive():
+          raise
+        # The peer may itself be waiting for room in our ring
+        self._backlog.extend(self._pop())
+        time.sleep(FULL_SLEEP)
+    if wake:
+      try:
+        self.bell.send(b'\x00')
+      except (BlockingIOError, OSError):
+        pass
+
+  def wait(self):
+    '''
+    See `ShmRing.wait()`
+    '''
+    return len(self._backlog) != 0 or self.rings.rx.wait()
+
+  def pop_all(self):
+    items, self._backlog = self._backlog, []
+    items.extend(self._pop())
+    return items
+
+  def _pop(self):
+    return [pickle.loads(data) for _, data in self.rings.rx.pop_all()]
+
+def _take(kept, vname, state_id):
+  # Removes the state state_id of vname from kept along with any older one, which will not be logged
+  states = kept.get(vname)
+  while states:
+    i, state = states.popleft()
+    if i == state_id:
+      return state
+  return None
+
+def serve(address, fd, bell, handoff, log_path, trace_path):
+  # Entry point of the child process
+  parent = os.getppid()
+  rings = shm.ShmRings(fd, SLOTS, SLOT_SIZE, is_client=True)
+  os.close(fd)
+  channel = _Channel(rings, bell, lambda: os.getppid() == parent)
+
+  tracer = None
+  if trace_path is not None:
+    tracer = Tracer()
+  try:
+    server = ModelBridgeServer(address=address, tracer=tracer)
+  except OSError as e:
+    channel.push([(EVENT_ERROR, e)])
+    return
+  log = None
+  if log_path is not None:
+    log = TransitionLog(log_path, tracer=tracer)
+
+  channel.push([(EVENT_READY, server.address)])
+  server.add_wakeup(bell)
+  server.add_handoff(handoff)
+  sent_counts = (0, 0, 0, 0)
+  sent_log = (0, 0, 0.0)
+  # Each vehicle's latest states with their ids, for CMD_LOG to refer to
+  kept = {}
+  next_id = 0
+  try:
+    with server:
+      while os.getppid() == parent:
+        # The parent only rings the bell if it sees that we are asleep, which
+        # it can miss (see mivp_agent.shm), so the ring is checked again at
+        # least every SHM_MAX_SLEEP seconds. So is the parent.
+        timeout = SHM_MAX_SLEEP
+        if channel.wait():
+          timeout = 0
+        accept_ready, readable = server.select(timeout)
+
+        # One frame per pass instead of one per state
+        events = []
+        if accept_ready:
+          for addr in server.accept_all():
+            events.append((EVENT_ACCEPT, addr))
+        for addr in readable:
+          states = server.listen_all(addr)
+          if len(states) != 0:
+            events.append((EVENT_STATES, addr, states, next_id))
+            if log is not None:
+              for i, state in enumerate(states):
+                kept.setdefault(state[KEY_ID], deque(maxlen=2*KEPT_STATES)).append((next_id + i, state))
+            next_id += len(states)
+        for addr in server.hung_up_all():
+          events.append((EVENT_HANG_UP, addr))
+        counts = (server.bytes_received, server.bytes_sent, server.client_count(), server.handoffs)
+        if counts != sent_counts:
+          events.append((EVENT_COUNTS, ) + counts)
+          sent_counts = counts
+        if log is not None and log.flushes != sent_log[1]:
+          sent_log = (log.bytes_written, log.flushes, log.flush_seconds)
+          events.append((EVENT_LOG, ) + sent_log)
+        for i in range(0, len(events), MAX_EVENTS):
+          channel.push(events[i:i+MAX_EVENTS])
+
+        for cmd in channel.pop_all():
+          if cmd[0] == CMD_SEND:
+            try:
+              server.send_instr(cmd[1], cmd[2])
+            except RuntimeError:
+              # The vehicle hung up before the response was given
+              pass
+          elif cmd[0] == CMD_LOG:
+            _, vname, state_id, state, action, is_transition = cmd
+            if state is None:
+              state = _take(kept, vname, state_id)
+            if state is None:
+              print(f'WARNING: State {state_id} of {vname} was forgotten before it could be logged', file=sys.stderr)
+            else:
+              log.record(vname, state, action, is_transition)
+          elif cmd[0] == CMD_CLOSE:
+            return
+  finally:
+    if log is not None:
+      log.close()
+    if tracer is not None:
+      tracer.dump(trace_path)
+    rings.close()
+    bell.close()
+    handoff.close()
+
+class ServerProcess:
+  '''
+  Stands in for the `ModelBridgeServer` of a `MissionManager`, with the same `select()`, `accept_all()`, `listen_all()`, `send_instr()`, `wakeup()`, `hand_off()`, `client_count()` and `hung_up_all()` methods, while the server itself runs in a child process.
+
+  Args:
+    address (str): The address for the server to listen on, see `mivp_agent.bridge.parse_address()`
+    log_path (str): Directory where the child writes the transitions given to `record()`
+    trace_path (str): File where the child writes a trace of its server and log when closed, see `mivp_agent.util.trace`
+  '''
+  def __init__(self, address=None, log_path=None, trace_path=None):
+    fd = shm.create_file(2*shm.ring_size(SLOTS, SLOT_SIZE))
+    self._bell, child_bell = socket.socketpair()
+    self._handoff, child_handoff = socket.socketpair()
+
+    # Forked so the memory file and the socket pair are inherited
+    context = multiprocessing.get_context('fork')
+    self._process = context.Process(target=serve, args=(address, fd, child_bell, child_handoff, log_path, trace_path), daemon=True)
+    self._process.start()
+    child_bell.close()
+    child_handoff.close()
+
+    self._rings = shm.ShmRings(fd, SLOTS, SLOT_SIZE, is_client=False)
+    os.close(fd)
+    self._channel = _Channel(self._rings, self._bell, self._process.is_alive)
+
+    self._bell.setblocking(False)
+    self._wake_r, self._wake_w = socket.socketpair()
+    self._wake_r.setblocking(False)
+    self._wake_w.setblocking(False)
+    self._wake_pending = False
+    self._selector = selectors.DefaultSelector()
+    self._selector.register(self._bell, selectors.EVENT_READ)
+    self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+    self._accepted = []
+    self._states = {}
+    self._hung_up = []
+    self._closed = False
+    self._log = log_path is not None
+    # The states the child kept for each vehicle with their ids, see KEPT_STATES
+    self._kept = {}
+    # As last reported by the child
+    self.bytes_received = 0
+    self.bytes_sent = 0
+    self.handoffs = 0
+    self._client_count = 0
+    # Of the log written by the child, see `TransitionLog`
+    self.bytes_written = 0
+    self.flushes = 0
+    self.flush_seconds = 0.0
+
+    # Wait for the server to bind
+    deadline = time.monotonic() + START_TIMEOUT
+    event = None
+    while event is None:
+      if time.monotonic() > deadline or not self._process.is_alive():
+        self.close()
+        raise RuntimeError('The bridge server process failed to start')
+      events = self._events()
+      if len(events) != 0:
+        event = events[0]
+        self._handle(events[1:])
+      else:
+        time.sleep(0.001)
+    if event[0] == EVENT_ERROR:
+      self.close()
+      raise event[1]
+    self.address = event[1]
+
+  def __enter__(self):
+    return self
+
+  def _events(self):
+    return [event for batch in self._channel.pop_all() for event in batch]
+
+  def _handle(self, events):
+    for event in events:
+      if event[0] == EVENT_ACCEPT:
+        self._accepted.append(event[1])
+      elif event[0] == EVENT_STATES:
+        self._states.setdefault(event[1], []).extend(event[2])
+        if self._log:
+          for i, state in enumerate(event[2]):
+            self._kept.setdefault(state[KEY_ID], deque(maxlen=KEPT_STATES)).append((event[3] + i, state))
+      elif event[0] == EVENT_HANG_UP:
+        self._hung_up.append(event[1])
+      elif event[0] == EVENT_COUNTS:
+        self.bytes_received, self.bytes_sent, self._client_count, self.handoffs = event[1:]
+      elif event[0] == EVENT_LOG:
+        self.bytes_written, self.flushes, self.flush_seconds = event[1:]
+
+  def select(self, timeout=None):
+    '''
+    See `ModelBridgeServer.select()`
+    '''
+    self._handle(self._events())
+    # The child only rings the bell if it sees that we are asleep, which it
+    # can miss (see mivp_agent.shm), so the ring is checked again at least
+    # every SHM_MAX_SLEEP seconds.
+    deadline = None
+    if timeout is not None:
+      deadline = time.monotonic() + timeout
+    while len(self._accepted) == 0 and len(self._states) == 0 and len(self._hung_up) == 0:
+      woken = False
+      if not self._channel.wait():
+        sleep = SHM_MAX_SLEEP
+        if deadline is not None:
+          sleep = max(0, min(sleep, deadline - time.monotonic()))
+        for key, _ in self._selector.select(sleep):
+          self._drain(key.fileobj)
+          woken = woken or key.fileobj is self._wake_r
+      self._handle(self._events())
+      if woken or (deadline is not None and time.monotonic() >= deadline):
+        break
+    return len(self._accepted) != 0, list(self._states)
+
+  def _drain(self, sock):
+    try:
+      if sock.recv(shm.DEFAULT_SLOT_SIZE) == b'' and sock is self._bell:
+        raise RuntimeError('The bridge server process exited')
+      while sock.recv(shm.DEFAULT_SLOT_SIZE):
+        pass
+    except (BlockingIOError, InterruptedError):
+      pass
+    if sock is self._wake_r:
+      self._wake_pending = False
+
+  def wakeup(self):
+    '''
+    See `ModelBridgeServer.wakeup()`
+    '''
+    if self._wake_pending:
+      return
+    self._wake_pending = True
+    try:
+      self._wake_w.send(b'\x00')
+    except (BlockingIOError, OSError):
+      pass
+
+  def hand_off(self, sock):
+    '''
+    See `ModelBridgeServer.hand_off()`, the socket is passed to the child process
+    '''
+    try:
+      send_fds(self._handoff, [b'\x00'], [sock.fileno()])
+    finally:
+      sock.close()
+
+  def client_count(self):
+    '''
+    See `ModelBridgeServer.client_count()`, as last reported by the child
+    '''
+    return self._client_count
+
+  def accept_all(self):
+    addrs, self._accepted = self._accepted, []
+    return addrs
+
+  def listen_all(self, addr):
+    return self._states.pop(addr, [])
+
+  def hung_up_all(self):
+    addrs, self._hung_up = self._hung_up, []
+    return addrs
+
+  def send_instr(self, addr, instr):
+    self._channel.push((CMD_SEND, addr, instr))
+    return True
+
+  def record(self, vname, state, action, is_transition):
+    '''
+    Has the child log a transition, see `TransitionLog.record()`. The state is only sent when the child no longer has it.
+    '''
+    kept = self._kept.get(vname, ())
+    for n, (state_id, s) in enumerate(kept):
+      if s is state:
+        # Older states were not logged, the child drops them too
+        for _ in range(n + 1):
+          kept.popleft()
+        self._channel.push((CMD_LOG, vname, state_id, None, action, is_transition))
+        return
+    self._channel.push((CMD_LOG, vname, None, state, action, is_transition))
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    if self._process.is_alive():
+      try:
+        self._channel.push((CMD_CLOSE, ))
+      except ConnectionError:
+        pass
+      self._process.join(START_TIMEOUT)
+      if self._process.is_alive():
+        self._process.terminate()
+        self._process.join()
+    self._selector.close()
+    self._rings.close()
+    self._bell.close()
+    self._handoff.close()
+    self._wake_r.close()
+    self._wake_w.close()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
@@ -0,0 +1,170 @@
+import os
+import mmap
+import struct
+import platform
+import tempfile
+
+'''
+Single producer / single consumer rings of fixed size slots in memory shared by the two ends of a `shm://` bridge connection (see `mivp_agent.bridge.ShmConnection`).
+
+The memory is an anonymous file which the client creates and hands to the server over the control socket, so there is no name in `/dev/shm` which could leak when a vehicle is killed.
+
+Sequence numbers are stored as aligned 64 bit words and written after the slots they publish. This relies on stores becoming visible to the other process in program order, as they do on x86-64. Python has no way to issue a memory barrier, so on other CPUs such as ARM the rings could hand out frames before their bytes arrive and `SUPPORTED` is `False`.
+
+Wakeups are not as safe. A consumer going to sleep stores the waiting word and then loads the write word, while the producer stores the write word and then loads the waiting word. Even x86-64 lets a store be passed by a later load, so both can miss the other's store: the producer sees no one waiting and the consumer sees no frame. A sleeping consumer therefore has to check its ring again after a bounded time (see `mivp_agent.bridge.SHM_MAX_SLEEP`) rather than rely on being woken up.
+'''
+
+# Rings may only be shared between processes where stores are seen in program order
+SUPPORTED = platform.machine().lower() in ('x86_64', 'amd64')
+
+DEFAULT_SLOTS = 64
+DEFAULT_SLOT_SIZE = 1024
+
+# Header words, each on its own cache line
+WORD_WRITE = 0
+WORD_READ = 8
+WORD_WAITING = 16
+HEADER_SIZE = 192
+
+# Slot header holding the frame length and its codec tag
+FRAME_HEADER = struct.Struct('=IB')
+# Marks the rest of the ring as unused so frames never wrap around the end
+SKIP = 0xFFFFFFFF
+
+def ring_size(slots, slot_size):
+  return HEADER_SIZE + slots*slot_size
+
+def create_file(size):
+  '''
+  Returns:
+    int: A file descriptor for `size` bytes of memory with no name on the file system
+  '''
+  if hasattr(os, 'memfd_create'):
+    fd = os.memfd_create('mivp_agent', os.MFD_CLOEXEC)
+  else:
+    # Unlinked right away on platforms without memfd
+    fd, path = tempfile.mkstemp(prefix='mivp_agent')
+    os.unlink(path)
+  os.ftruncate(fd, size)
+  return fd
+
+class ShmRing:
+  '''
+  One direction of a connection. Frames larger than a slot take several consecutive slots.
+
+  Args:
+    buffer (memoryview): `ring_size(slots, slot_size)` bytes of shared memory
+  '''
+  def __init__(self, buffer, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+    assert len(buffer) == ring_size(slots, slot_size)
+    self.slots = slots
+    self.slot_size = slot_size
+    self._buffer = buffer
+    self._words = buffer[:HEADER_SIZE].cast('Q')
+
+  def max_frame(self):
+    return self.slots*self.slot_size - FRAME_HEADER.size
+
+  def push(self, tag, data):
+    '''
+    Copies a frame into the ring. A full ring raises `ConnectionError` right away rather than wait for the consumer to make room.
+
+    Returns:
+      bool: `True` if the consumer was waiting for a frame and has to be woken up. `False` can be wrong, see the module docstring.
+    '''
+    length = len(data) + 1
+    if length > self.max_frame():
+      raise ValueError(f'Frame of {length} bytes is larger than the ring ({self.max_frame()} bytes)')
+    needed = -(-(length + FRAME_HEADER.size - 1)//self.slot_size)
+
+    words = self._words
+    write = words[WORD_WRITE]
+    position = write % self.slots
+    skip = 0
+    if position + needed > self.slots:
+      skip = self.slots - position
+
+    if write + skip + needed - words[WORD_READ] > self.slots:
+      raise ConnectionError('Shared memory ring is full, the peer is not reading')
+
+    if skip:
+      FRAME_HEADER.pack_into(self._buffer, HEADER_SIZE + position*self.slot_size, SKIP, 0)
+      write += skip
+      position = 0
+
+    offset = HEADER_SIZE + position*self.slot_size
+    FRAME_HEADER.pack_into(self._buffer, offset, length, tag)
+    offset += FRAME_HEADER.size
+    self._buffer[offset:offset+length-1] = data
+
+    # Publish only once the frame is in place
+    words[WORD_WRITE] = write + needed
+    if words[WORD_WAITING]:
+      words[WORD_WAITING] = 0
+      return True
+    return False
+
+  def pop_all(self):
+    '''
+    Returns:
+      list: `(tag, body)` tuples for every frame in the ring, `body` is `bytes`
+    '''
+    words = self._words
+    write = words[WORD_WRITE]
+    read = words[WORD_READ]
+    if read == write:
+      return []
+
+    frames = []
+    while read < write:
+      position = read % self.slots
+      offset = HEADER_SIZE + position*self.slot_size
+      length, tag = FRAME_HEADER.unpack_from(self._buffer, offset)
+      if length == SKIP:
+        read += self.slots - position
+        continue
+
+      start = offset + FRAME_HEADER.size
+      frames.append((tag, bytes(self._buffer[start:start+length-1])))
+      read += -(-(length + FRAME_HEADER.size - 1)//self.slot_size)
+
+    # Hand the slots back to the producer
+    words[WORD_READ] = read
+    return frames
+
+  def wait(self):
+    '''
+    Asks the producer to wake us up after its next frame. It may not, see the module docstring.
+
+    Returns:
+      bool: `True` if frames are already waiting and there is no need to sleep
+    '''
+    words = self._words
+    words[WORD_WAITING] = 1
+    return words[WORD_WRITE] != words[WORD_READ]
+
+  def release(self):
+    self._words.release()
+    self._buffer.release()
+
+class ShmRings:
+  '''
+  The pair of rings for one connection, mapped from the file `fd`. The client pushes to the first ring and the server to the second.
+  '''
+  def __init__(self, fd, slots, slot_size, is_client):
+    size = ring_size(slots, slot_size)
+    self._mmap = mmap.mmap(fd, 2*size)
+    self._view = memoryview(self._mmap)
+
+    to_server = ShmRing(self._view[:size], slots, slot_size)
+    to_client = ShmRing(self._view[size:], slots, slot_size)
+    if is_client:
+      self.tx, self.rx = to_server, to_client
+    else:
+      self.tx, self.rx = to_client, to_server
+
+  def close(self):
+    self.tx.release()
+    self.rx.release()
+    self._view.release()
+    self._mmap.close()
@@ -1,40 +1,187 @@
+import sys
 import time
+import threading
+
+# Seconds between redraws of the dashboard
+DEFAULT_REFRESH = 1.0
+
+class _Vehicle:
+  '''
+  Running aggregates of one vehicle, each updated in constant time by `ModelConsole.tick()`.
+  '''
+  def __init__(self, moos_time, loop_time):
+    self.steps = 0
+    self.last_MOOS_time = moos_time
+    self.last_loop_time = loop_time
+    self.last_MOOS_delta = None
+    self.last_loop_delta = None
+    self.MOOS_delta_sum = 0.0
+    self.loop_delta_sum = 0.0
+    # Episode number last reported by pEpisodeManager and how many were seen
+    self.episode = None
+    self.episodes = 0
+
+  def mean_MOOS_delta(self):
+    if self.steps < 2:
+      return None
+    return self.MOOS_delta_sum/(self.steps - 1)
+
+  def mean_loop_delta(self):
+    if self.steps < 2:
+      return None
+    return self.loop_delta_sum/(self.steps - 1)
+
+def _fmt(value, scale=1.0, digits=2):
+  if value is None:
+    return 'n/a'
+  return f'{value*scale:.{digits}f}'
 
 class ModelConsole:
-  def __init__(self):
-    self.iteration = 0
-    self._last_loop_time = None
+  '''
+  A console dashboard of the vehicles a model is serving. `tick()` only updates running aggregates for the message's vehicle, the dashboard is drawn from a background thread every `refresh` seconds so printing costs the same however many messages arrive. It shows, for each vehicle, the steps per second, the last and mean `MOOS_TIME` and loop deltas and the episode it is on.
 
-    self.vehicles = {}
+  When `out` is not a terminal, for example when piped to a file, a single compact line is written each refresh instead, and nothing when no message arrived since the last one.
 
-    self.last_MOOS_delta = 0
+  Args:
+    refresh (float): Seconds between redraws
+    out (file): Where to draw, `sys.stdout` by default
+    compact (bool): Use the single line mode, by default when `out` is not a TTY
 
-    self._last_loop_time = None
+  Example:
+    ```
+    with ModelConsole() as console:
+      while True:
+        msg = mgr.get_message()
+        console.tick(msg)
+        ...
+    ```
+  '''
+  def __init__(self, refresh=DEFAULT_REFRESH, out=None, compact=None):
+    self.iteration = 0
+    self.vehicles = {}
+    self.last_MOOS_delta = 0
     self._last_MOOS_time = None
-  
+
+    self._refresh = refresh
+    self._out = out if out is not None else sys.stdout
+    if compact is None:
+      isatty = getattr(self._out, 'isatty', None)
+      compact = isatty is None or not isatty()
+    self._compact = compact
+
+    self._lock = threading.Lock()
+    self._thread = None
+    self._stop = threading.Event()
+    # Used by the drawing thread only
+    self._drawn_lines = 0
+    self._drawn_time = time.perf_counter()
+    self._drawn_iteration = 0
+    self._drawn_steps = {}
+
+  def __enter__(self):
+    return self
+
   def tick(self, msg):
-    if msg.vname not in self.vehicles:
-      self.vehicles[msg.vname] = {}
-      self.vehicles[msg.vname]['last_MOOS_delta'] = 'n/a'
-      self.vehicles[msg.vname]['last_loop_delta'] = 'n/a'
-      self.vehicles[msg.vname]['last_MOOS_time'] = msg.state['MOOS_TIME']
-      self.vehicles[msg.vname]['last_loop_time'] = time.perf_counter()
-    else:
-      self.vehicles[msg.vname]['last_MOOS_delta'] = msg.state['MOOS_TIME']-self.vehicles[msg.vname]['last_MOOS_time']
-      self.vehicles[msg.vname]['last_MOOS_time'] = msg.state['MOOS_TIME']
-      loop_time = time.perf_counter()
-      self.vehicles[msg.vname]['last_loop_delta'] = loop_time - self.vehicles[msg.vname]['last_loop_time']
-      self.vehicles[msg.vname]['last_loop_time'] = loop_time
-    
-
-    print('\n===========================================')
-    print(f' Iteration: {self.iteration}')
-    print(f' MOOS_TIME: {msg.state["MOOS_TIME"]}\n')
-    for v in self.vehicles:
-      print(f' Vehicle: {v}')
-      print(f'   MOOS delta: {self.vehicles[v]["last_MOOS_delta"]}')
-      print(f'   Loop delta: {self.vehicles[v]["last_loop_delta"]}')
-    print('===========================================')
-
-    # Updated needed vars 
-    self.iteration += 1
+    '''
+    Counts `msg` towards the dashboard, starting the drawing thread on the first call.
+    '''
+    now = time.perf_counter()
+    moos_time = msg.state['MOOS_TIME']
+    report = msg.episode_report
+    with self._lock:
+      v = self.vehicles.get(msg.vname)
+      if v is None:
+        v = self.vehicles[msg.vname] = _Vehicle(moos_time, now)
+      else:
+        v.last_MOOS_delta = moos_time - v.last_MOOS_time
+        v.last_loop_delta = now - v.last_loop_time
+        v.MOOS_delta_sum += v.last_MOOS_delta
+        v.loop_delta_sum += v.last_loop_delta
+        v.last_MOOS_time = moos_time
+        v.last_loop_time = now
+        self.last_MOOS_delta = v.last_MOOS_delta
+      v.steps += 1
+      if report is not None and report['NUM'] != v.episode:
+        v.episode = report['NUM']
+        v.episodes += 1
+      self._last_MOOS_time = moos_time
+      self.iteration += 1
+
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, name='mivp-console', daemon=True)
+      self._thread.start()
+
+  def _run(self):
+    while not self._stop.wait(self._refresh):
+      self.draw()
+
+  def render(self):
+    '''
+    Returns:
+      list: The lines of the dashboard as of now, a single line in compact mode
+    '''
+    now = time.perf_counter()
+    with self._lock:
+      iteration = self.iteration
+      moos_time = self._last_MOOS_time
+      rows = [
+        (vname, v.steps, v.last_MOOS_delta, v.mean_MOOS_delta(), v.last_loop_delta, v.mean_loop_delta(), v.episode, v.episodes)
+        for vname, v in self.vehicles.items()
+      ]
+
+    elapsed = now - self._drawn_time
+    rate = lambda steps, last: (steps - last)/elapsed if elapsed > 0 else 0.0
+    total_rate = rate(iteration, self._drawn_iteration)
+    rates = {vname: rate(steps, self._drawn_steps.get(vname, 0)) for vname, steps, *_ in rows}
+    self._drawn_time = now
+    self._drawn_iteration = iteration
+    self._drawn_steps = {vname: steps for vname, steps, *_ in rows}
+
+    if self._compact:
+      parts = [f'Iteration: {iteration}', f'Steps/s: {total_rate:.1f}']
+      for vname, steps, moos_delta, _, loop_delta, _, episode, _ in rows:
+        parts.append(f'{vname}: {rates[vname]:.1f}/s ep {episode} MOOS delta {_fmt(moos_delta)} loop delta {_fmt(loop_delta, 1e3, 1)} ms')
+      return [' | '.join(parts)]
+
+    lines = [
+      '===========================================',
+      f' Iteration: {iteration}   Steps/s: {total_rate:.1f}   MOOS_TIME: {_fmt(moos_time)}',
+      '',
+      f" {'Vehicle':<12} {'Steps/s':>8} {'MOOS delta (last/mean)':>24} {'Loop delta ms (last/mean)':>27} {'Episode (seen)':>15}",
+    ]
+    for vname, steps, moos_delta, moos_mean, loop_delta, loop_mean, episode, episodes in rows:
+      lines.append(
+        f' {vname:<12} {rates[vname]:>8.1f} {_fmt(moos_delta) + " / " + _fmt(moos_mean):>24}'
+        f' {_fmt(loop_delta, 1e3, 1) + " / " + _fmt(loop_mean, 1e3, 1):>27} {f"{episode} ({episodes})":>15}'
+      )
+    lines.append('===========================================')
+    return lines
+
+  def draw(self):
+    '''
+    Draws the dashboard now, over the last one on a terminal. Called by the drawing thread every `refresh` seconds.
+    '''
+    if self._compact and self.iteration == self._drawn_iteration:
+      # Nothing new to report
+      return
+    lines = self.render()
+    text = '\n'.join(lines) + '\n'
+    if not self._compact and self._drawn_lines != 0:
+      # Move back to the start of the last dashboard and clear it
+      text = f'\x1b[{self._drawn_lines}F\x1b[J' + text
+    self._drawn_lines = len(lines)
+    self._out.write(text)
+    self._out.flush()
+
+  def close(self):
+    '''
+    Stops the drawing thread after drawing the dashboard one last time.
+    '''
+    if self._thread is not None:
+      self._stop.set()
+      self._thread.join()
+      self._thread = None
+      self.draw()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
@@ -0,0 +1,86 @@
+import bisect
+from threading import Lock
+
+def exponential_bounds(start, factor, count):
+  '''
+  Returns:
+    list: `count` bucket bounds starting at `start`, each `factor` times the last
+  '''
+  bounds = [start]
+  for _ in range(count - 1):
+    bounds.append(bounds[-1]*factor)
+  return bounds
+
+# Seconds, from 100 us to about 1.6 s
+LATENCY_BOUNDS = exponential_bounds(1e-4, 2, 15)
+# Seconds, from 1 us to about 28 s in steps of 19%, fine enough to tell the tail of a latency distribution apart
+FINE_LATENCY_BOUNDS = exponential_bounds(1e-6, 2**0.25, 100)
+# From 1 to 1024
+SIZE_BOUNDS = exponential_bounds(1, 2, 11)
+
+class Histogram:
+  '''
+  Counts values into fixed buckets so distributions can be reported without keeping every value. Bucket `i` holds the values up to `bounds[i]` which are above `bounds[i-1]`, with one more bucket for values above the last bound. Safe to share between threads.
+
+  Args:
+    bounds (list): Increasing upper bounds of the buckets
+  '''
+  def __init__(self, bounds):
+    assert all(a < b for a, b in zip(bounds, bounds[1:])), 'Bounds must be increasing'
+    self.bounds = list(bounds)
+    self.counts = [0]*(len(self.bounds) + 1)
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+    self._lock = Lock()
+
+  def add(self, value):
+    with self._lock:
+      self.counts[bisect.bisect_left(self.bounds, value)] += 1
+      self.count += 1
+      self.total += value
+      if self.min is None or value < self.min:
+        self.min = value
+      if self.max is None or value > self.max:
+        self.max = value
+
+  def mean(self):
+    if self.count == 0:
+      return None
+    return self.total/self.count
+
+  def percentile(self, p):
+    '''
+    Returns:
+      float: The upper bound of the bucket holding the `p` (from 0 to 1) percentile, capped by the largest value seen. `None` if empty.
+    '''
+    with self._lock:
+      if self.count == 0:
+        return None
+      rank = p*self.count
+      seen = 0
+      for i, n in enumerate(self.counts):
+        seen += n
+        if seen >= rank and n != 0:
+          break
+      if i == len(self.bounds):
+        return self.max
+      return min(self.bounds[i], self.max)
+
+  def to_dict(self):
+    '''
+    Returns:
+      dict: The `count`, `mean`, `min`, `max`, `p50`, `p90` and `p99` along with the `bounds` and bucket `counts`
+    '''
+    return {
+      'count': self.count,
+      'mean': self.mean(),
+      'min': self.min,
+      'max': self.max,
+      'p50': self.percentile(0.5),
+      'p90': self.percentile(0.9),
+      'p99': self.percentile(0.99),
+      'bounds': list(self.bounds),
+      'counts': list(self.counts),
+    }
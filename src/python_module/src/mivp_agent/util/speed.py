@@ -0,0 +1,114 @@
+import sys
+import json
+
+# Share of the helm period spent waiting for the model above which the model is the bottleneck
+MODEL_BOUND_SHARE = 0.5
+# Helm periods to see before judging a vehicle, so a model warming up is not flagged
+MIN_PERIODS = 20
+# Weight of the newest period in the recent averages
+SMOOTHING = 0.05
+
+class _VehicleSpeed:
+  def __init__(self, moos_time, received):
+    self.first_MOOS_time = moos_time
+    self.first_received = received
+    self.last_MOOS_time = moos_time
+    self.last_received = received
+    self.periods = 0
+    self.period_total = 0.0
+    self.wait_total = 0.0
+    # Wait for the response to the last state, None until it is sent
+    self.wait = None
+    self.recent_warp = None
+    self.recent_share = None
+    self.model_bound = False
+
+class SpeedMonitor:
+  '''
+  Tracks the simulated `MOOS_TIME` of each vehicle against wall clock time to tell how fast the simulation really runs and what holds it back. Each state starts a helm period which ends when the vehicle's next state arrives, and the part of it between the state arriving and its response being sent is time the helm spent waiting for the model.
+
+  For each vehicle `stats()` reports:
+
+    - `warp`: Simulated seconds per wall clock second since its first state, the effective time warp
+    - `recent_warp`: The same over about the last `1/SMOOTHING` periods
+    - `helm_period`: Mean wall clock seconds between states
+    - `model_wait_share`: Share of the helm periods spent waiting for the model, from 0 to 1
+    - `recent_model_wait_share`: The same over about the last `1/SMOOTHING` periods
+    - `model_bound`: `True` when the recent share is over `model_bound_share`, the model rather than the simulation limits the warp and a lower time warp would lose nothing
+
+  `on_state()` and `on_response()` for a vehicle must be called from one thread at a time, as the `MissionManager` thread serving it does.
+
+  Args:
+    model_bound_share (float): Recent model wait share from which a vehicle is `model_bound`
+  '''
+  def __init__(self, model_bound_share=MODEL_BOUND_SHARE):
+    self._model_bound_share = model_bound_share
+    self._vehicles = {}
+
+  def on_state(self, vname, moos_time, received):
+    '''
+    Called with the `time.monotonic()` at which a state with `moos_time` was `received` from `vname`.
+    '''
+    v = self._vehicles.get(vname)
+    if v is None or moos_time < v.last_MOOS_time:
+      # New vehicle or its simulation was restarted
+      self._vehicles[vname] = _VehicleSpeed(moos_time, received)
+      return
+
+    period = received - v.last_received
+    if period > 0:
+      warp = (moos_time - v.last_MOOS_time)/period
+      share = min(1.0, (v.wait or 0.0)/period)
+      if v.recent_warp is None:
+        v.recent_warp, v.recent_share = warp, share
+      else:
+        v.recent_warp += SMOOTHING*(warp - v.recent_warp)
+        v.recent_share += SMOOTHING*(share - v.recent_share)
+      v.periods += 1
+      v.period_total += period
+      v.wait_total += min(period, v.wait or 0.0)
+
+      model_bound = v.periods >= MIN_PERIODS and v.recent_share > self._model_bound_share
+      if model_bound and not v.model_bound:
+        print(f'WARNING: The model is slowing down the simulation of {vname}, {100*v.recent_share:.0f}% of its helm period is spent waiting for responses', file=sys.stderr)
+      v.model_bound = model_bound
+
+    v.last_MOOS_time = moos_time
+    v.last_received = received
+    v.wait = None
+
+  def on_response(self, vname, sent):
+    '''
+    Called with the `time.monotonic()` at which the response to the last state of `vname` was `sent`.
+    '''
+    v = self._vehicles.get(vname)
+    if v is not None and v.wait is None:
+      v.wait = sent - v.last_received
+
+  def stats(self):
+    '''
+    Returns:
+      dict: The figures described above for each vehicle, `None` until a vehicle has sent two states
+    '''
+    stats = {}
+    for vname, v in list(self._vehicles.items()):
+      if v.periods == 0:
+        stats[vname] = None
+        continue
+      elapsed = v.last_received - v.first_received
+      stats[vname] = {
+        'warp': (v.last_MOOS_time - v.first_MOOS_time)/elapsed,
+        'recent_warp': v.recent_warp,
+        'helm_period': v.period_total/v.periods,
+        'model_wait_share': v.wait_total/v.period_total,
+        'recent_model_wait_share': v.recent_share,
+        'model_bound': v.model_bound,
+      }
+    return stats
+
+  def save(self, path):
+    '''
+    Writes `stats()` to `path` as JSON.
+    '''
+    with open(path, 'w') as f:
+      json.dump(self.stats(), f, indent=2)
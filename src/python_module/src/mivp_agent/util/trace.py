@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+DEFAULT_SIZE = 1 << 16
+
+# Categories of the events recorded by mivp_agent
+CAT_BRIDGE = 'bridge'
+CAT_MANAGER = 'manager'
+CAT_USER = 'user'
+CAT_LOG = 'log'
+
+# The ids the OS gives threads need Python 3.8, before that Python's own are used
+_get_tid = getattr(threading, 'get_native_id', threading.get_ident)
+
+def _tid(thread):
+  return getattr(thread, 'native_id', thread.ident)
+
+def now():
+  '''
+  Returns:
+    int: The start time to pass to `Tracer.complete()`
+  '''
+  return time.perf_counter_ns()
+
+class Tracer:
+  '''
+  Records spans of time into a ring holding the `size` most recent events and writes them out as Chrome Trace Event JSON, to open in `chrome://tracing` or https://ui.perfetto.dev. Recording appends to a `deque`, which takes no lock, so any thread can record without waiting on the others.
+
+  Example:
+    ```
+    start = trace.now()
+    ...
+    tracer.complete('decode', start, trace.CAT_BRIDGE, {'addr': str(addr)})
+    ```
+  '''
+  def __init__(self, size=DEFAULT_SIZE):
+    self._events = deque(maxlen=size)
+
+  def complete(self, name, start, cat, args=None):
+    '''
+    Records a span from `start` (see `now()`) until now on the calling thread.
+    '''
+    end = time.perf_counter_ns()
+    self._events.append((name, cat, start, end - start, _get_tid(), args))
+
+  def instant(self, name, cat, args=None):
+    self._events.append((name, cat, time.perf_counter_ns(), None, _get_tid(), args))
+
+  def __len__(self):
+    return len(self._events)
+
+  def events(self):
+    '''
+    Returns:
+      list: The recorded events as Chrome Trace Event dicts, preceded by the names of the threads which are still running
+    '''
+    pid = os.getpid()
+    out = [
+      {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': _tid(t), 'args': {'name': t.name}}
+      for t in threading.enumerate() if _tid(t) is not None
+    ]
+    for name, cat, start, dur, tid, args in list(self._events):
+      event = {'name': name, 'cat': cat, 'ts': start/1000, 'pid': pid, 'tid': tid}
+      if dur is None:
+        event['ph'] = 'i'
+        event['s'] = 't'
+      else:
+        event['ph'] = 'X'
+        event['dur'] = dur/1000
+      if args is not None:
+        event['args'] = args
+      out.append(event)
+    return out
+
+  def dump(self, path):
+    '''
+    Writes the recorded events to `path` as Chrome Trace Event JSON. Recording carries on.
+    '''
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
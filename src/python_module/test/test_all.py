@@ -6,16 +6,28 @@ currentdir = os.path.dirname(os.path.realpath(__file__))
 generated_dir = os.path.join(currentdir, '.generated')
 if not os.path.isdir(generated_dir):
   os.makedirs(generated_dir)
-assert os.listdir(generated_dir) == ['README.txt'], 'test/.generated directory corrupted'
+# Not when imported again by a spawned worker process while the tests run
+if __name__ == '__main__':
+  assert os.listdir(generated_dir) == ['README.txt'], 'test/.generated directory corrupted'
 
 os.chdir(generated_dir)
 
 import unittest
 import test_file_system
 import test_bridge
+import test_codec
+import test_shm
 import test_log
 import test_manager
+import test_inbox
+import test_env
+import test_policy_server
+import test_bench
 import test_data_structures
+import test_histogram
+import test_trace
+import test_display
+import test_speed
 import test_proto
 import test_consumer
 import test_packit
@@ -31,12 +43,25 @@ if __name__ == '__main__':
   suite.addTest(unittest.makeSuite(test_packit.TestPackitEncode))
   suite.addTest(unittest.makeSuite(test_packit.TestPackitDecode))
   suite.addTest(unittest.makeSuite(test_bridge.TestBridge))
+  suite.addTest(unittest.makeSuite(test_bridge.TestFrameReader))
+  suite.addTest(unittest.makeSuite(test_codec.TestCodec))
+  suite.addTest(unittest.makeSuite(test_shm.TestShmRing))
   suite.addTest(unittest.makeSuite(test_log.TestMetadata))
   suite.addTest(unittest.makeSuite(test_proto.TestProto))
   suite.addTest(unittest.makeSuite(test_consumer.TestConsumer))
+  suite.addTest(unittest.makeSuite(test_inbox.TestInbox))
   suite.addTest(unittest.makeSuite(test_manager.TestManagerCore))
   suite.addTest(unittest.makeSuite(test_manager.TestManagerLogger))
+  suite.addTest(unittest.makeSuite(test_manager.TestManagerProcess))
+  suite.addTest(unittest.makeSuite(test_manager.TestManagerShards))
+  suite.addTest(unittest.makeSuite(test_env.TestVecMissionEnv))
+  suite.addTest(unittest.makeSuite(test_policy_server.TestPolicyServer))
+  suite.addTest(unittest.makeSuite(test_bench.TestFleet))
   suite.addTest(unittest.makeSuite(test_data_structures.TestLimitedHistory))
+  suite.addTest(unittest.makeSuite(test_histogram.TestHistogram))
+  suite.addTest(unittest.makeSuite(test_trace.TestTracer))
+  suite.addTest(unittest.makeSuite(test_display.TestModelConsole))
+  suite.addTest(unittest.makeSuite(test_speed.TestSpeedMonitor))
   suite.addTest(unittest.makeSuite(test_proto.TestLogger))
   
   runner = unittest.TextTestRunner()
@@ -44,7 +69,7 @@ if __name__ == '__main__':
 
   # Clean any log files
   log_dir = os.path.join(generated_dir, DATA_DIRECTORY)
-  safe_clean(log_dir, patterns=['*.gz', '*.session'])
+  safe_clean(log_dir, patterns=['*.gz', '*.session', 'speed.json'])
   os.rmdir(log_dir)
 
   if len(result.failures) != 0 or len(result.errors) != 0:
@@ -0,0 +1,20 @@
+import unittest
+import timeout_decorator
+
+from mivp_agent.bench import fleet
+
+class TestFleet(unittest.TestCase):
+  @timeout_decorator.timeout(20)
+  def test_measure(self):
+    for threads in (False, True):
+      r = fleet.measure(n_vehicles=4, seconds=1.0, rate=20, workers=2, threads=threads, sample=0.05)
+      # Four vehicles at 20 Hz, allowing for a slow machine
+      self.assertGreater(r['states_per_sec'], 40)
+      self.assertLess(r['states_per_sec'], 100)
+      self.assertLess(r['p50_ms'], r['p99_ms'] + 1e-9)
+      self.assertEqual(len(r['fleet_cpu_percent']), 2)
+      self.assertGreater(len(r['queue_depth']), 5)
+      self.assertLessEqual(r['peak'], 4)
+
+if __name__ == '__main__':
+  unittest.main()
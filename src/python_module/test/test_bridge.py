@@ -1,10 +1,16 @@
+import os
 import unittest
+import tempfile
+from unittest import mock
 from threading import Thread
 import socket
+import struct
 import time
 
 
 from mivp_agent.bridge import ModelBridgeServer, ModelBridgeClient
+from mivp_agent.bridge import FrameReader, send_full, send_fds, recv_fds, parse_address, shard_address, MAX_BUFFER_SIZE, MAX_FRAME_SIZE
+from mivp_agent import shm
 from mivp_agent.const import KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE, KEY_ID
 
 DUMMY_INSTR = {
@@ -27,6 +33,13 @@ def dummy_connect_client(client):
   while not client.connect():
     time.sleep(0.2)
 
+def handshake(server, client, addr):
+  # Clients hold states until the server has answered their codec offer
+  time.sleep(0.1)
+  server.listen_all(addr)
+  time.sleep(0.1)
+  client.listen()
+
 class TestBridge(unittest.TestCase):
 
   def test_offline_state(self):
@@ -127,10 +140,319 @@ class TestBridge(unittest.TestCase):
         
         # Clean up our thread
         t.join()
+        handshake(server, client, addr)
 
         self.assertTrue(client.send_state(DUMMY_STATE))
         time.sleep(0.1)
         self.assertEqual(server.listen(addr), DUMMY_STATE)       
 
+  def test_state_burst(self):
+    with ModelBridgeServer() as server:
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        addr = None
+        while addr is None:
+          addr = server.accept()
+        handshake(server, client, addr)
+
+        # Many states sent back to back, with a large one in the middle
+        states = []
+        for i in range(20):
+          state = DUMMY_STATE.copy()
+          state['MOOS_TIME'] += i
+          if i == 10:
+            state['NODE_REPORTS'] = {f'drone_{j}': {'NAV_X': float(j)} for j in range(2000)}
+          states.append(state)
+          self.assertTrue(client.send_state(state))
+
+        received = []
+        while len(received) < len(states):
+          server.select(timeout=1)
+          received.extend(server.listen_all(addr))
+        self.assertEqual(received, states)
+
+        # listen() hands out one state at a time
+        client.send_state(states[0])
+        client.send_state(states[1])
+        time.sleep(0.1)
+        self.assertEqual(server.listen(addr), states[0])
+        self.assertEqual(server.listen(addr), states[1])
+        self.assertIsNone(server.listen(addr))
+
+  def test_select(self):
+    with ModelBridgeServer() as server:
+      # Nothing to do yet
+      self.assertEqual(server.select(timeout=0), (False, []))
+
+      clients = [ModelBridgeClient() for _ in range(3)]
+      for client in clients:
+        dummy_connect_client(client)
+
+      # All pending connections accepted in one pass
+      accept_ready, readable = server.select(timeout=1)
+      self.assertTrue(accept_ready)
+      self.assertEqual(readable, [])
+      addrs = server.accept_all()
+      self.assertEqual(len(addrs), 3)
+
+      # Complete the codec handshakes
+      time.sleep(0.1)
+      for addr in addrs:
+        self.assertEqual(server.listen_all(addr), [])
+      for client in clients:
+        self.assertFalse(client.listen())
+
+      # Only the client which sent a state is readable
+      self.assertTrue(clients[1].send_state(DUMMY_STATE))
+      accept_ready, readable = server.select(timeout=1)
+      self.assertFalse(accept_ready)
+      self.assertEqual(readable, [addrs[1]])
+      self.assertEqual(server.listen(addrs[1]), DUMMY_STATE)
+
+      # Another thread can interrupt a blocking select
+      t = Thread(target=lambda: (time.sleep(0.1), server.wakeup()))
+      t.start()
+      self.assertEqual(server.select(), (False, []))
+      t.join()
+
+      # Hang ups are cleaned up by listen
+      clients[0].close()
+      accept_ready, readable = server.select(timeout=1)
+      self.assertEqual(readable, [addrs[0]])
+      self.assertIsNone(server.listen(addrs[0]))
+      self.assertRaises(RuntimeError, server.listen, addrs[0])
+
+      for client in clients:
+        client.close()
+
+  def test_parse_address(self):
+    self.assertEqual(parse_address('tcp://localhost:1234'), (socket.AF_INET, ('localhost', 1234)))
+    self.assertEqual(parse_address('tcp://127.0.0.1'), (socket.AF_INET, ('127.0.0.1', 57721)))
+    self.assertEqual(parse_address('tcp://[::1]:1234'), (socket.AF_INET6, ('::1', 1234)))
+    self.assertEqual(parse_address('unix:///tmp/mivp.sock'), (socket.AF_UNIX, '/tmp/mivp.sock'))
+    self.assertEqual(parse_address('unix://mivp.sock'), (socket.AF_UNIX, 'mivp.sock'))
+    self.assertRaises(ValueError, parse_address, 'unix://')
+    self.assertRaises(ValueError, parse_address, 'udp://localhost:1234')
+
+    self.assertEqual(shard_address('tcp://localhost:1234', 2), 'tcp://localhost:1236')
+    self.assertEqual(shard_address('tcp://localhost:0', 2), 'tcp://localhost:0')
+    self.assertEqual(shard_address('unix:///tmp/mivp.sock', 1), 'unix:///tmp/mivp.sock.1')
+
+  def test_hand_off(self):
+    with ModelBridgeServer(port=57731) as front, ModelBridgeServer(port=57732) as a, ModelBridgeServer(port=57733) as b:
+      client = ModelBridgeClient(port=57731)
+      dummy_connect_client(client)
+      time.sleep(0.1)
+
+      # Accepted by the front server, taken on by a
+      socks = front.accept_sockets()
+      self.assertEqual(len(socks), 1)
+      a.hand_off(socks[0])
+      self.assertEqual(front.accept_all(), [])
+      self.assertTrue(a.select(timeout=1)[0])
+      addrs = a.accept_all()
+      self.assertEqual(len(addrs), 1)
+      addr = addrs[0]
+      self.assertTrue(a.send_instr(addr, DUMMY_INSTR))
+      self.assertEqual(client.listen(), DUMMY_INSTR)
+
+      # Moved to b along with a state it already read
+      self.assertTrue(client.send_state(DUMMY_STATE))
+      self.assertEqual(a.select(timeout=1), (False, [addr]))
+      states = a.listen_all(addr)
+      self.assertEqual(states, [DUMMY_STATE])
+      conn = a.detach(addr)
+      conn.backlog.extend(states)
+      b.adopt(addr, conn)
+      self.assertEqual(a.select(timeout=0.1), (False, []))
+      self.assertEqual(b.select(timeout=1), (False, [addr]))
+      self.assertEqual(b.listen_all(addr), [DUMMY_STATE])
+      self.assertTrue(b.send_instr(addr, DUMMY_INSTR))
+      time.sleep(0.1)
+      self.assertEqual(client.listen(), DUMMY_INSTR)
+      client.close()
+
+  def test_unix(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'mivp.sock')
+      address = f'unix://{path}'
+
+      with ModelBridgeClient(address=address) as client:
+        # Nothing to connect to yet
+        self.assertFalse(client.connect())
+
+      # Left over from a server which did not close
+      stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      stale.bind(path)
+      stale.close()
+
+      with ModelBridgeServer(address=address) as server:
+        clients = [ModelBridgeClient(address=address) for _ in range(2)]
+        for client in clients:
+          dummy_connect_client(client)
+        addrs = server.accept_all()
+        self.assertEqual(len(addrs), 2)
+        self.assertNotEqual(addrs[0], addrs[1])
+        handshake(server, clients[1], addrs[1])
+
+        self.assertTrue(clients[1].send_state(DUMMY_STATE))
+        time.sleep(0.1)
+        self.assertEqual(server.listen_all(addrs[0]), [])
+        self.assertEqual(server.listen_all(addrs[1]), [DUMMY_STATE])
+        self.assertTrue(server.send_instr(addrs[1], DUMMY_INSTR))
+        time.sleep(0.1)
+        self.assertEqual(clients[1].listen(), DUMMY_INSTR)
+
+        for client in clients:
+          client.close()
+      self.assertFalse(os.path.exists(path))
+
+  @unittest.skipUnless(shm.SUPPORTED, 'shm:// needs an x86-64 CPU')
+  def test_shm(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      address = f"shm://{os.path.join(tmp, 'mivp.sock')}"
+      with ModelBridgeServer(address=address) as server:
+        client = ModelBridgeClient(address=address)
+        dummy_connect_client(client)
+        addrs = server.accept_all()
+        self.assertEqual(len(addrs), 1)
+        addr = addrs[0]
+
+        # Sent before the server attached to the shared memory
+        self.assertTrue(server.send_instr(addr, DUMMY_INSTR))
+        self.assertEqual(server.listen_all(addr), [])
+        self.assertEqual(client.listen(), DUMMY_INSTR)
+
+        # A sleeping server is woken up by the client
+        large = DUMMY_STATE.copy()
+        large['LARGE'] = 'x'*10000
+        t = Thread(target=lambda: (time.sleep(0.1), client.send_state(large)))
+        t.start()
+        start = time.time()
+        self.assertEqual(server.select(timeout=2), (False, [addr]))
+        self.assertLess(time.time() - start, 1)
+        t.join()
+        self.assertEqual(server.listen_all(addr), [large])
+
+        # The hang up may follow a doorbell which is read first
+        client.close()
+        for _ in range(2):
+          if server.select(timeout=1) == (False, [addr]):
+            self.assertEqual(server.listen_all(addr), [])
+        self.assertRaises(RuntimeError, server.listen, addr)
+
+  @unittest.skipUnless(shm.SUPPORTED, 'shm:// needs an x86-64 CPU')
+  def test_shm_full(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      address = f"shm://{os.path.join(tmp, 'mivp.sock')}"
+      with ModelBridgeServer(address=address) as server:
+        client = ModelBridgeClient(address=address)
+        dummy_connect_client(client)
+        addr = server.accept_all()[0]
+        self.assertTrue(server.send_instr(addr, DUMMY_INSTR))
+        self.assertEqual(server.listen_all(addr), [])
+
+        # The client never reads, the server hangs up as soon as the ring is full
+        sent = 1
+        while server.send_instr(addr, DUMMY_INSTR):
+          sent += 1
+          self.assertLessEqual(sent, shm.DEFAULT_SLOTS)
+        for _ in range(2):
+          if server.select(timeout=1) == (False, [addr]):
+            self.assertEqual(server.listen_all(addr), [])
+        self.assertRaises(RuntimeError, server.listen, addr)
+        client.close()
+
+  def test_fds(self):
+    a, b = socket.socketpair(socket.AF_UNIX)
+    r, w = os.pipe()
+    try:
+      send_fds(a, [b'pipe'], [w])
+      msg, fds, _, _ = recv_fds(b, 16, 2)
+      self.assertEqual(msg, b'pipe')
+      self.assertEqual(len(fds), 1)
+      os.write(fds[0], b'through')
+      os.close(fds[0])
+      self.assertEqual(os.read(r, 16), b'through')
+    finally:
+      for fd in (r, w):
+        os.close(fd)
+      a.close()
+      b.close()
+
+  def test_shm_unsupported(self):
+    with mock.patch('mivp_agent.shm.SUPPORTED', False):
+      self.assertRaises(ValueError, parse_address, 'shm:///tmp/mivp.sock')
+
+class TestFrameReader(unittest.TestCase):
+  def setUp(self):
+    self.a, self.b = socket.socketpair()
+    self.b.setblocking(False)
+    self.reader = FrameReader()
+
+  def tearDown(self):
+    self.a.close()
+    self.b.close()
+
+  def test_empty(self):
+    self.assertEqual(self.reader.read(self.b), [])
+    self.assertFalse(self.reader.closed)
+
+  def test_burst(self):
+    frames = [str(i).encode()*(i+1) for i in range(100)]
+    for f in frames:
+      send_full(self.a, f)
+
+    self.assertEqual(self.reader.read(self.b), frames)
+    self.assertEqual(self.reader.read(self.b), [])
+
+  def test_partial(self):
+    self.a.sendall(b'\x00\x00')
+    self.assertEqual(self.reader.read(self.b), [])
+    self.a.sendall(b'\x00\x05abc')
+    self.assertEqual(self.reader.read(self.b), [])
+    # Rest of the frame followed by the start of another
+    self.a.sendall(b'de\x00\x00\x00\x01')
+    self.assertEqual(self.reader.read(self.b), [b'abcde'])
+    self.a.sendall(b'f')
+    self.assertEqual(self.reader.read(self.b), [b'f'])
+
+  def test_large(self):
+    large = bytes(range(256))*(MAX_BUFFER_SIZE//16)
+    t = Thread(target=send_full, args=(self.a, large))
+    t.start()
+
+    frames = []
+    while len(frames) == 0:
+      frames = self.reader.read(self.b)
+    t.join()
+
+    self.assertEqual(frames, [large])
+
+    # Buffer keeps working after growing
+    send_full(self.a, b'small')
+    self.assertEqual(self.reader.read(self.b), [b'small'])
+
+  def test_too_large(self):
+    # Only the header of a huge frame, which must not be allocated
+    self.a.sendall(struct.pack('>i', 0x7ffffff0))
+    self.assertEqual(self.reader.read(self.b), [])
+    self.assertTrue(self.reader.closed)
+    self.assertLess(len(self.reader._buffer), MAX_FRAME_SIZE)
+
+    reader = FrameReader(max_frame=4)
+    send_full(self.a, b'four')
+    send_full(self.a, b'fives')
+    self.assertEqual(reader.read(self.b), [b'four'])
+    self.assertTrue(reader.closed)
+
+  def test_closed(self):
+    send_full(self.a, b'last')
+    self.a.close()
+    self.assertEqual(self.reader.read(self.b), [b'last'])
+    # The hang up is seen by the following read
+    self.assertEqual(self.reader.read(self.b), [])
+    self.assertTrue(self.reader.closed)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,227 @@
+import os
+import unittest
+import time
+
+from mivp_agent.codec import CODECS, DEFAULT_CODECS, CodecError, BinaryCodec, SchemaCodec, DeltaCodec, negotiate
+from mivp_agent.bridge import ModelBridgeServer, ModelBridgeClient
+from mivp_agent.bench.states import make_state
+from mivp_agent.const import KEY_ID, KEY_EPISODE_MGR_REPORT
+
+DUMMY_INSTR = {
+  'speed': 2.0,
+  'course': 120.0,
+  'posts': {
+    'FAKE_VAR': 'fake_val',
+    'FLAG': True,
+    'NUMBER': 3.5
+  },
+  'ctrl_msg': 'SEND_STATE'
+}
+
+ODD_STATE = {
+  KEY_ID: 'félix',
+  'MOOS_TIME': 16923.012,
+  'NAV_X': 98.0,
+  'NAV_Y': 40.0,
+  'NAV_HEADING': 180.0,
+  KEY_EPISODE_MGR_REPORT: None,
+  'COUNT': -12,
+  'EMPTY': '',
+  'MIXED': {'a': 1.0, 'b': 'two', 'c': {'d': None}},
+  'RAGGED': {'x': {'a': 1.0}, 'y': {'b': 2.0}},
+  'LIST': [1, 'two', None],
+  'NODE_REPORTS': {},
+}
+
+def connect(server, client):
+  while not client.connect():
+    time.sleep(0.1)
+  addr = None
+  while addr is None:
+    addr = server.accept()
+  return addr
+
+def handshake(server, client, addr):
+  time.sleep(0.1)
+  server.listen_all(addr)
+  time.sleep(0.1)
+  client.listen()
+
+class TestCodec(unittest.TestCase):
+  def test_round_trip(self):
+    states = [make_state(step=i, n_vars=6, n_reports=3) for i in range(0, 700, 50)]
+    states.append(ODD_STATE)
+    for name in CODECS:
+      encoder = CODECS[name]()
+      decoder = CODECS[name]()
+      for state in states:
+        self.assertEqual(decoder.decode_state(encoder.encode_state(state)), state)
+      self.assertEqual(decoder.decode_instr(encoder.encode_instr(DUMMY_INSTR)), DUMMY_INSTR)
+
+  def test_binary_smaller(self):
+    state = make_state(n_vars=10, n_reports=5)
+    self.assertLess(len(CODECS['binary']().encode_state(state)), len(CODECS['pickle']().encode_state(state)))
+
+  def test_binary_errors(self):
+    codec = BinaryCodec()
+    state = ODD_STATE.copy()
+    state['BAD'] = 'nul\x00char'
+    self.assertRaises(CodecError, codec.encode_state, state)
+    state['BAD'] = object()
+    self.assertRaises(CodecError, codec.encode_state, state)
+
+    data = codec.encode_state(ODD_STATE)
+    self.assertRaises(CodecError, codec.decode_state, data + b'\x00')
+
+  def test_schema(self):
+    encoder = SchemaCodec()
+    decoder = SchemaCodec()
+    state = make_state(step=0, n_vars=10, n_reports=5)
+    first = encoder.encode_state(state)
+    self.assertEqual(decoder.decode_state(first), state)
+
+    # Only values once the schema is known
+    state = make_state(step=1, n_vars=10, n_reports=5)
+    values = encoder.encode_state(state)
+    self.assertLess(len(values), len(first)/2)
+    self.assertLess(len(values), len(CODECS['binary']().encode_state(state))/2)
+    self.assertEqual(decoder.decode_state(values), state)
+
+    # A new key or type gets a new schema revision
+    for change in ({'NEW_VAR': 1.0}, {'TAGGED': 1.0}, {'NAV_X': 2**70}):
+      changed = state.copy()
+      changed.update(change)
+      self.assertEqual(decoder.decode_state(encoder.encode_state(changed)), changed)
+    self.assertEqual(decoder.decode_state(encoder.encode_state(state)), state)
+
+    # Values for a schema the decoder never saw
+    self.assertRaises(CodecError, SchemaCodec().decode_state, values)
+
+  def test_delta(self):
+    encoder = DeltaCodec(keyframe_interval=5)
+    decoder = DeltaCodec()
+    states = [make_state(step=i, n_vars=10, n_reports=5) for i in range(10)]
+    kinds = []
+    for state in states:
+      data = encoder.encode_state(state)
+      kinds.append(data[0:1])
+      self.assertEqual(decoder.decode_state(data), state)
+    self.assertEqual(kinds, [b'S'] + [b'D']*5 + [b'V'] + [b'D']*3)
+
+    # Unchanged states are little more than the masks
+    self.assertLess(len(encoder.encode_state(states[-1])), 10)
+    changed = states[-1].copy()
+    changed['CUSTOM_VAR_1'] = 'new'
+    changed['TAGGED'] = True
+    data = encoder.encode_state(changed)
+    self.assertEqual(data[0:1], b'D')
+    self.assertEqual(decoder.decode_state(data), changed)
+    # Earlier states handed out are not modified
+    self.assertEqual(states[-1]['CUSTOM_VAR_1'], make_state(step=9, n_vars=10, n_reports=5)['CUSTOM_VAR_1'])
+
+    # A delta can not be applied without its keyframe
+    self.assertRaises(CodecError, DeltaCodec().decode_state, data)
+
+  def test_delta_reconnect(self):
+    with ModelBridgeServer() as server:
+      client = ModelBridgeClient(codecs=('delta', ))
+      for run in range(2):
+        addr = connect(server, client)
+        handshake(server, client, addr)
+        self.assertEqual(server.codec(addr), 'delta')
+
+        states = [make_state(step=i, n_vars=10, n_reports=5) for i in range(run*10, run*10+10)]
+        for state in states:
+          self.assertTrue(client.send_state(state))
+        time.sleep(0.1)
+        self.assertEqual(server.listen_all(addr), states)
+        client.close()
+
+  def test_env_codecs(self):
+    os.environ['MIVP_AGENT_CODECS'] = 'delta, binary'
+    try:
+      self.assertEqual(ModelBridgeClient()._codecs, ('delta', 'binary'))
+      os.environ['MIVP_AGENT_CODECS'] = 'made_up'
+      self.assertRaises(ValueError, ModelBridgeClient)
+    finally:
+      del os.environ['MIVP_AGENT_CODECS']
+
+  def test_negotiate(self):
+    self.assertEqual(negotiate(('binary', 'pickle'), ('binary', 'pickle')), 'binary')
+    self.assertEqual(negotiate(('pickle', 'binary'), ('binary', 'pickle')), 'pickle')
+    self.assertIsNone(negotiate(('pickle', ), ('binary', )))
+    # Pickle only with a peer which offers nothing else
+    self.assertEqual(negotiate(DEFAULT_CODECS, DEFAULT_CODECS), 'schema')
+    self.assertEqual(negotiate(DEFAULT_CODECS, ('pickle', )), 'pickle')
+    self.assertRaises(ValueError, ModelBridgeClient, codecs=('made_up', ))
+
+  def test_handshake(self):
+    with ModelBridgeServer() as server:
+      with ModelBridgeClient(codecs=('pickle', 'binary')) as client:
+        addr = connect(server, client)
+
+        # Server encodes with its first choice until the offer arrives
+        self.assertEqual(server.codec(addr), 'schema')
+        self.assertEqual(client.codec(), 'pickle')
+        handshake(server, client, addr)
+        self.assertEqual(server.codec(addr), 'pickle')
+        self.assertEqual(client.codec(), 'pickle')
+
+        self.assertTrue(client.send_state(ODD_STATE))
+        self.assertTrue(server.send_instr(addr, DUMMY_INSTR))
+        time.sleep(0.1)
+        self.assertEqual(server.listen(addr), ODD_STATE)
+        self.assertEqual(client.listen(), DUMMY_INSTR)
+
+  def test_instr_before_offer(self):
+    with ModelBridgeServer() as server:
+      # Can not decode the server's first choice
+      with ModelBridgeClient(codecs=('pickle', )) as client:
+        addr = connect(server, client)
+        self.assertTrue(server.send_instr(addr, DUMMY_INSTR))
+        self.assertTrue(client.send_state(ODD_STATE))
+        time.sleep(0.1)
+        self.assertEqual(server.listen_all(addr), [ODD_STATE])
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), DUMMY_INSTR)
+        self.assertEqual(client.codec(), 'pickle')
+
+  def test_state_before_choice(self):
+    # The server does not accept the client's first choice
+    for server_codecs, client_codecs, chosen in ((('binary', ), None, 'binary'), (('schema', 'binary'), ('delta', 'schema'), 'schema')):
+      with ModelBridgeServer(codecs=server_codecs) as server:
+        with ModelBridgeClient(codecs=client_codecs) as client:
+          addr = connect(server, client)
+          # Held until the server's choice arrives
+          self.assertTrue(client.send_state(ODD_STATE))
+          time.sleep(0.1)
+          self.assertEqual(server.listen_all(addr), [])
+          time.sleep(0.1)
+          self.assertFalse(client.listen())
+          self.assertEqual(client.codec(), chosen)
+          time.sleep(0.1)
+          self.assertEqual(server.listen_all(addr), [ODD_STATE])
+          self.assertTrue(client.send_state(ODD_STATE))
+          time.sleep(0.1)
+          self.assertEqual(server.listen_all(addr), [ODD_STATE])
+
+  def test_refuse_pickle(self):
+    with ModelBridgeServer(codecs=('binary', )) as server:
+      # No codec in common
+      with ModelBridgeClient(codecs=('pickle', )) as client:
+        addr = connect(server, client)
+        time.sleep(0.1)
+        self.assertEqual(server.listen_all(addr), [])
+        self.assertRaises(RuntimeError, server.listen, addr)
+
+      # Pickled frames are refused from a peer which does not wait for the handshake
+      with ModelBridgeClient(codecs=('pickle', 'binary')) as client:
+        addr = connect(server, client)
+        client._conn.held = None
+        self.assertTrue(client.send_state(ODD_STATE))
+        time.sleep(0.1)
+        self.assertEqual(server.listen_all(addr), [])
+        self.assertRaises(RuntimeError, server.listen, addr)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,54 @@
+import io
+import time
+import unittest
+
+from mivp_agent.util.display import ModelConsole
+from mivp_agent.messages import MissionMessage
+from mivp_agent.const import KEY_ID, KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE
+
+def make_msg(vname, moos_time, episode):
+  return MissionMessage(('127.0.0.1', 0), {
+    KEY_ID: vname,
+    'MOOS_TIME': moos_time,
+    KEY_EPISODE_MGR_REPORT: {'NUM': episode},
+    KEY_EPISODE_MGR_STATE: 'RUNNING',
+  })
+
+class TestModelConsole(unittest.TestCase):
+  def test_compact(self):
+    out = io.StringIO()
+    with ModelConsole(refresh=0.05, out=out) as console:
+      for i in range(4):
+        console.tick(make_msg('felix', 10.0 + 0.5*i, i//2))
+      console.tick(make_msg('evan', 3.0, 0))
+      # Nothing is printed by tick()
+      self.assertEqual(out.getvalue(), '')
+      time.sleep(0.2)
+
+    # One line per refresh with something new, none while idle
+    lines = out.getvalue().splitlines()
+    self.assertEqual(len(lines), 1)
+    self.assertIn('Iteration: 5', lines[0])
+    self.assertIn('felix: ', lines[0])
+    self.assertIn('MOOS delta 0.50', lines[0])
+
+    felix = console.vehicles['felix']
+    self.assertEqual(felix.steps, 4)
+    self.assertEqual(felix.mean_MOOS_delta(), 0.5)
+    self.assertEqual((felix.episode, felix.episodes), (1, 2))
+    self.assertIsNone(console.vehicles['evan'].last_MOOS_delta)
+
+  def test_terminal(self):
+    out = io.StringIO()
+    console = ModelConsole(out=out, compact=False)
+    console.tick(make_msg('felix', 10.0, 0))
+    console.draw()
+    first = out.getvalue()
+    self.assertIn('felix', first)
+    console.draw()
+    # Drawn over the last dashboard
+    self.assertTrue(out.getvalue()[len(first):].startswith(f'\x1b[{len(first.splitlines())}F\x1b[J'))
+    console.close()
+
+if __name__ == '__main__':
+  unittest.main()
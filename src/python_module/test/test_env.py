@@ -0,0 +1,138 @@
+import time
+import unittest
+import timeout_decorator
+from threading import Thread
+
+import numpy as np
+
+from mivp_agent.manager import MissionManager
+from mivp_agent.env import VecMissionEnv
+from mivp_agent.bridge import ModelBridgeClient
+from mivp_agent.const import KEY_ID, KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE
+
+class FakeVehicle(Thread):
+  '''
+  Answers every instruction with a new state, like BHV_Agent, and pretends to run pEpisodeManager with episodes `episode_len` states long which pause when they end.
+  '''
+  def __init__(self, vname, episode_len):
+    super().__init__(daemon=True)
+    self.vname = vname
+    self.episode_len = episode_len
+    self.instrs = []
+    self._halt = False
+
+    self._running = False
+    self._steps = 0
+    self._num = None
+
+  def run(self):
+    with ModelBridgeClient() as client:
+      while not client.connect():
+        time.sleep(0.1)
+      while not self._halt:
+        instr = client.listen()
+        if not instr:
+          time.sleep(0.001)
+          continue
+        self.instrs.append(instr)
+        if instr['posts'].get('EPISODE_MGR_CTRL') == 'type=start':
+          self._running = True
+        elif self._running:
+          self._steps += 1
+          if self._steps == self.episode_len:
+            self._running = False
+            self._steps = 0
+            self._num = 0 if self._num is None else self._num + 1
+        client.send_state(self.state())
+
+  def state(self):
+    report = None
+    if self._num is not None:
+      report = f'NUM={self._num},DURATION=1.0,SUCCESS=true,WILL_PAUSE=false'
+    return {
+      KEY_ID: self.vname,
+      'MOOS_TIME': 10.0,
+      'NAV_X': float(self._steps),
+      'NAV_Y': float(len(self.vname)),
+      'NAV_HEADING': 0.0,
+      KEY_EPISODE_MGR_REPORT: report,
+      KEY_EPISODE_MGR_STATE: 'RUNNING' if self._running else 'PAUSED'
+    }
+
+  def stop(self):
+    self._halt = True
+    self.join()
+
+class TestVecMissionEnv(unittest.TestCase):
+  @timeout_decorator.timeout(10)
+  def test_lockstep(self):
+    with MissionManager('test', log=False) as mgr:
+      vehicles = [FakeVehicle('felix', 3), FakeVehicle('alder', 5)]
+      for v in vehicles:
+        v.start()
+
+      env = VecMissionEnv(mgr, {'felix': 'evan', 'alder': 'cher'}, ['NAV_X', 'NAV_Y'], reward=lambda msg, done: 1.0 if done else 0.0, timeout=5)
+      self.assertEqual(env.num_envs, 2)
+
+      # Paused vehicles are started before the first observation
+      obs = env.reset()
+      self.assertEqual(obs.dtype, np.float32)
+      self.assertEqual(obs.tolist(), [[0.0, 5.0], [0.0, 5.0]])
+
+      ends = {'felix': [], 'alder': []}
+      for step in range(1, 11):
+        obs, rewards, dones, infos = env.step([[1.0, 90.0], [2.0, 180.0]])
+        self.assertEqual(obs.shape, (2, 2))
+        self.assertEqual([info['vname'] for info in infos], ['felix', 'alder'])
+        self.assertEqual(rewards.tolist(), [float(d) for d in dones])
+        for v, done, info, row in zip(vehicles, dones, infos, obs):
+          if done:
+            ends[v.vname].append(step)
+            self.assertEqual(info['episode_report']['NUM'], len(ends[v.vname]) - 1)
+            # Already the first state of the next episode
+            self.assertEqual(row[0], 0.0)
+          else:
+            self.assertNotIn('episode_report', info)
+      self.assertEqual(ends, {'felix': [3, 6, 9], 'alder': [5, 10]})
+
+      for v in vehicles:
+        v.stop()
+      speeds = [instr['speed'] for instr in vehicles[0].instrs if instr['posts'] == {}]
+      self.assertEqual(set(speeds[1:]), {1.0})
+
+  @timeout_decorator.timeout(10)
+  def test_foreign_vehicle(self):
+    with MissionManager('test', log=False) as mgr:
+      vehicles = [FakeVehicle('felix', 3), FakeVehicle('alder', 5)]
+      for v in vehicles:
+        v.start()
+
+      env = VecMissionEnv(mgr, ['felix'], ['NAV_X'], timeout=5)
+      env.reset()
+      for _ in range(5):
+        env.step([[1.0, 90.0]])
+
+      # alder is served by someone else and was left queued
+      msg = mgr.get_message(vname='alder')
+      self.assertEqual(msg.vname, 'alder')
+      msg.act({'speed': 0.0, 'course': 0.0})
+      msg = mgr.get_message(vname='alder')
+      self.assertEqual(msg.vname, 'alder')
+      msg.act({'speed': 0.0, 'course': 0.0})
+
+      for v in vehicles:
+        v.stop()
+
+  @timeout_decorator.timeout(5)
+  def test_timeout(self):
+    with MissionManager('test', log=False) as mgr:
+      vehicle = FakeVehicle('felix', 3)
+      vehicle.start()
+
+      # Never hears from alder
+      env = VecMissionEnv(mgr, ['felix', 'alder'], lambda msg: [msg.state['NAV_X']], timeout=0.5)
+      self.assertRaises(TimeoutError, env.reset)
+      vehicle.stop()
+
+if __name__ == '__main__':
+  unittest.main()
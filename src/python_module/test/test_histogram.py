@@ -0,0 +1,24 @@
+import unittest
+
+from mivp_agent.util.histogram import Histogram, exponential_bounds
+
+class TestHistogram(unittest.TestCase):
+  def test_buckets(self):
+    h = Histogram([1, 2, 4])
+    self.assertIsNone(h.percentile(0.5))
+    for value in [0.5, 1, 1.5, 3, 3, 10]:
+      h.add(value)
+    self.assertEqual(h.counts, [2, 1, 2, 1])
+    self.assertEqual(h.count, 6)
+    self.assertEqual(h.min, 0.5)
+    self.assertEqual(h.max, 10)
+    self.assertEqual(h.percentile(0.3), 1)
+    self.assertEqual(h.percentile(0.5), 2)
+    self.assertEqual(h.percentile(0.99), 10)
+    self.assertEqual(h.to_dict()['p90'], 10)
+
+  def test_exponential_bounds(self):
+    self.assertEqual(exponential_bounds(1, 2, 4), [1, 2, 4, 8])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,183 @@
+import time
+import unittest
+from threading import Thread
+
+from mivp_agent.inbox import Inbox
+
+class FakeMessage:
+  def __init__(self, vname, n):
+    self.vname = vname
+    self.n = n
+
+class TestInbox(unittest.TestCase):
+  def test_fifo(self):
+    inbox = Inbox()
+    msgs = [FakeMessage('felix', 0), FakeMessage('felix', 1), FakeMessage('evan', 0)]
+    for msg in msgs:
+      self.assertIsNone(inbox.put(msg))
+    self.assertEqual(len(inbox), 3)
+    self.assertEqual([inbox.get() for _ in msgs], msgs)
+    self.assertIsNone(inbox.get(block=False))
+    self.assertEqual(inbox.coalesced, 0)
+
+  def test_latest(self):
+    inbox = Inbox(delivery='latest')
+    first = FakeMessage('felix', 0)
+    inbox.put(first)
+    inbox.put(FakeMessage('evan', 0))
+    newer = FakeMessage('felix', 1)
+    self.assertIs(inbox.put(newer), first)
+    self.assertEqual(inbox.coalesced, 1)
+    self.assertEqual(len(inbox), 2)
+
+    # Felix keeps its place in line
+    self.assertIs(inbox.get(), newer)
+    self.assertEqual(inbox.get().vname, 'evan')
+    self.assertIsNone(inbox.get(timeout=0.01))
+
+    self.assertRaises(ValueError, Inbox, delivery='newest')
+
+  def test_get_many(self):
+    for delivery in ('fifo', 'latest'):
+      inbox = Inbox(delivery=delivery)
+      self.assertEqual(inbox.get_many(timeout=0), [])
+      self.assertEqual(inbox.get_many(timeout=0.01), [])
+
+      msgs = [FakeMessage(f'vehicle_{i}', 0) for i in range(5)]
+      for msg in msgs:
+        inbox.put(msg)
+      self.assertEqual(inbox.get_many(max_n=2), msgs[:2])
+      self.assertEqual(inbox.get_many(), msgs[2:])
+
+  def test_block(self):
+    inbox = Inbox()
+    msg = FakeMessage('felix', 0)
+    t = Thread(target=lambda: (time.sleep(0.1), inbox.put(msg)))
+    t.start()
+    self.assertIs(inbox.get(), msg)
+    t.join()
+
+  def test_overflow(self):
+    for overflow in ('drop_oldest', 'coalesce'):
+      inbox = Inbox(max_depth=3, overflow=overflow)
+      msgs = [FakeMessage('felix', 0), FakeMessage('evan', 0), FakeMessage('felix', 1)]
+      for msg in msgs:
+        self.assertIsNone(inbox.put(msg))
+
+      # Felix's oldest message makes room
+      newer = FakeMessage('felix', 2)
+      self.assertIs(inbox.put(newer), msgs[0])
+      if overflow == 'coalesce':
+        expected = [newer, msgs[1], msgs[2]]
+      else:
+        expected = [msgs[1], msgs[2], newer]
+
+      # Otherwise the oldest of all
+      other = FakeMessage('henry', 0)
+      self.assertIs(inbox.put(other), expected.pop(0))
+      expected.append(other)
+      self.assertEqual(inbox.get_many(), expected)
+      self.assertEqual((inbox.dropped, inbox.peak, inbox.blocked), (2, 3, 0))
+
+    inbox = Inbox(delivery='latest', max_depth=2, overflow='drop_oldest')
+    msgs = [FakeMessage('felix', 0), FakeMessage('evan', 0)]
+    for msg in msgs:
+      inbox.put(msg)
+    # Coalescing needs no room
+    self.assertIs(inbox.put(FakeMessage('evan', 1)), msgs[1])
+    self.assertIs(inbox.put(FakeMessage('henry', 0)), msgs[0])
+    self.assertEqual([m.vname for m in inbox.get_many()], ['evan', 'henry'])
+
+    self.assertRaises(ValueError, Inbox, overflow='made_up')
+    self.assertRaises(ValueError, Inbox, max_depth=0)
+
+  def test_overflow_block(self):
+    inbox = Inbox(max_depth=1)
+    first = FakeMessage('felix', 0)
+    inbox.put(first)
+    second = FakeMessage('felix', 1)
+    t = Thread(target=inbox.put, args=(second, ))
+    t.start()
+    time.sleep(0.1)
+    self.assertTrue(t.is_alive())
+    self.assertIs(inbox.get(), first)
+    t.join()
+    self.assertIs(inbox.get(), second)
+    self.assertEqual(inbox.blocked, 1)
+
+    # Closing wakes a blocked put and hands the message back
+    inbox.put(first)
+    results = []
+    t = Thread(target=lambda: results.append(inbox.put(second)))
+    t.start()
+    time.sleep(0.1)
+    inbox.close()
+    t.join()
+    self.assertEqual(results, [second])
+    self.assertEqual(len(inbox), 1)
+
+  def test_high_water(self):
+    depths = []
+    inbox = Inbox(max_depth=4, overflow='drop_oldest', high_water=2, on_high_water=depths.append)
+    for i in range(5):
+      inbox.put(FakeMessage(f'vehicle_{i}', 0))
+    self.assertEqual(depths, [2])
+
+    # Called again after falling below the mark
+    inbox.get_many(max_n=3)
+    inbox.put(FakeMessage('felix', 0))
+    self.assertEqual(depths, [2, 2])
+
+  def test_round_robin(self):
+    inbox = Inbox(schedule='round_robin')
+    for n in range(3):
+      inbox.put(FakeMessage('felix', n))
+    inbox.put(FakeMessage('evan', 0))
+    inbox.put(FakeMessage('henry', 0))
+    inbox.put(FakeMessage('evan', 1))
+
+    order = [(m.vname, m.n) for m in inbox.get_many()]
+    self.assertEqual(order, [('felix', 0), ('evan', 0), ('henry', 0), ('felix', 1), ('evan', 1), ('felix', 2)])
+    self.assertRaises(ValueError, Inbox, schedule='made_up')
+
+  def test_vnames(self):
+    for schedule in ('oldest', 'round_robin'):
+      inbox = Inbox(schedule=schedule)
+      msgs = [FakeMessage('felix', 0), FakeMessage('evan', 0), FakeMessage('henry', 0), FakeMessage('evan', 1)]
+      for msg in msgs:
+        inbox.put(msg)
+      self.assertIs(inbox.get(vnames=['evan']), msgs[1])
+      self.assertIsNone(inbox.get(block=False, vnames=['alder']))
+      self.assertEqual(inbox.get_many(vnames=['henry', 'evan']), [msgs[2], msgs[3]])
+      self.assertEqual(len(inbox), 1)
+
+      # Waiting for one vehicle is not woken up by another
+      got = []
+      t = Thread(target=lambda: got.append(inbox.get(vnames=['evan'], timeout=1)))
+      t.start()
+      time.sleep(0.05)
+      inbox.put(FakeMessage('henry', 1))
+      time.sleep(0.05)
+      self.assertEqual(got, [])
+      evan = FakeMessage('evan', 2)
+      inbox.put(evan)
+      t.join()
+      self.assertEqual(got, [evan])
+      self.assertEqual([m.vname for m in inbox.get_many()], ['felix', 'henry'])
+
+  def test_ages(self):
+    inbox = Inbox(delivery='latest')
+    inbox.put(FakeMessage('felix', 0))
+    time.sleep(0.1)
+    inbox.put(FakeMessage('evan', 0))
+    inbox.put(FakeMessage('felix', 1))
+    ages = inbox.ages()
+    self.assertEqual(sorted(ages), ['evan', 'felix'])
+    # Coalescing keeps the age of the replaced message
+    self.assertGreaterEqual(ages['felix'], 0.1)
+    self.assertLess(ages['evan'], 0.1)
+    inbox.get()
+    self.assertEqual(list(inbox.ages()), ['evan'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,13 +1,23 @@
 import unittest
 import os
 import time
+import zlib
+import json
+import tempfile
+import urllib.request
+import urllib.error
 import timeout_decorator
+from unittest import mock
+from threading import Thread
+import numpy as np
 
 from mivp_agent.manager import MissionManager
-from mivp_agent.messages import MissionMessage, INSTR_SEND_STATE
-from mivp_agent.bridge import ModelBridgeClient
+from mivp_agent.messages import MissionMessage, INSTR_SEND_STATE, INSTR_RESET_FAILURE
+from mivp_agent.bridge import ModelBridgeClient, shard_address, ENV_ADDRESS, ENV_ADDRESS_FILE
 from mivp_agent.const import KEY_ID, KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE
 
+from mivp_agent import shm
+from mivp_agent.server_process import _Channel
 from mivp_agent.util.parse import parse_report
 from mivp_agent.util.file_system import safe_clean
 from mivp_agent.proto.proto_logger import ProtoLogger
@@ -53,6 +63,22 @@ def dummy_connect_client(client):
   while not client.connect():
     time.sleep(0.2)
 
+def run_states(test, mgr, n):
+  # Has a client send n states for the user to answer
+  with ModelBridgeClient() as client:
+    dummy_connect_client(client)
+    time.sleep(0.1)
+    test.assertEqual(client.listen(), INSTR_SEND_STATE)
+    for i in range(n):
+      test.assertTrue(client.send_state(DUMMY_STATE))
+      mgr.get_message().act(DUMMY_ACTION)
+      time.sleep(0.1)
+      test.assertEqual(client.listen(), DUMMY_INSTR)
+
+def trace_names(path):
+  with open(path) as f:
+    return {e['name'] for e in json.load(f)['traceEvents'] if e['ph'] != 'M'}
+
 class TestManagerCore(unittest.TestCase):
   @timeout_decorator.timeout(5)
   def test_basic(self):
@@ -122,6 +148,702 @@ class TestManagerCore(unittest.TestCase):
         time.sleep(0.1)
         self.assertTrue(mgr.are_present(['evan', 'felix']))
 
+  @timeout_decorator.timeout(5)
+  def test_respond_out_of_order(self):
+    with MissionManager('test', log=False) as mgr:
+      clients = [ModelBridgeClient() for _ in range(3)]
+      for i, client in enumerate(clients):
+        dummy_connect_client(client)
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = f'vehicle_{i}'
+        self.assertTrue(client.send_state(state))
+
+      msgs = {}
+      for _ in clients:
+        msg = mgr.get_message()
+        msgs[msg.vname] = msg
+
+      # Each response goes out as soon as it is given
+      for i in (2, 0, 1):
+        msgs[f'vehicle_{i}'].act(DUMMY_ACTION)
+        time.sleep(0.1)
+        for j, client in enumerate(clients):
+          instr = client.listen()
+          while instr == INSTR_SEND_STATE:
+            instr = client.listen()
+          if j == i:
+            self.assertEqual(instr, DUMMY_INSTR)
+          else:
+            self.assertFalse(instr)
+
+      for client in clients:
+        client.close()
+
+  @timeout_decorator.timeout(5)
+  def test_latest(self):
+    for policy in ('request_new', 'repeat'):
+      with MissionManager('test', log=False, delivery='latest', superseded=policy) as mgr:
+        with ModelBridgeClient() as client:
+          dummy_connect_client(client)
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+          # Answer one state so there is an action to repeat
+          self.assertTrue(client.send_state(DUMMY_STATE))
+          mgr.get_message().act(DUMMY_ACTION)
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), DUMMY_INSTR)
+
+          # A client which does not wait for its responses
+          for i in range(3):
+            state = DUMMY_STATE.copy()
+            state['MOOS_TIME'] += i
+            self.assertTrue(client.send_state(state))
+          time.sleep(0.2)
+
+          stats = mgr.stats()
+          self.assertEqual((stats['queued'], stats['coalesced']), (1, 2))
+          msg = mgr.get_message(block=False)
+          self.assertEqual(msg.state['MOOS_TIME'], DUMMY_STATE['MOOS_TIME'] + 2)
+
+          expected = INSTR_SEND_STATE
+          if policy == 'repeat':
+            expected = DUMMY_INSTR.copy()
+            expected['posts'] = {}
+          self.assertEqual(client.listen(), expected)
+          self.assertEqual(client.listen(), expected)
+          self.assertFalse(client.listen())
+          msg.request_new()
+
+  @timeout_decorator.timeout(5)
+  def test_latest_repeat(self):
+    with MissionManager('test', log=False, delivery='latest', superseded='repeat', action_repeat=3) as mgr:
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+        self.assertTrue(client.send_state(DUMMY_STATE))
+        mgr.get_message().act(DUMMY_ACTION, repeat=1)
+
+        # Answers to superseded states are not repeated for the states after them
+        for i in range(3):
+          state = DUMMY_STATE.copy()
+          state['MOOS_TIME'] += i
+          self.assertTrue(client.send_state(state))
+          time.sleep(0.1)
+
+        stats = mgr.stats()
+        self.assertEqual((stats['coalesced'], stats['repeated']), (2, 0))
+        msg = mgr.get_message(block=False)
+        self.assertEqual(msg.state['MOOS_TIME'], DUMMY_STATE['MOOS_TIME'] + 2)
+        msg.request_new()
+
+  @timeout_decorator.timeout(5)
+  def test_batch(self):
+    with MissionManager('test', log=False) as mgr:
+      self.assertEqual(len(mgr.get_messages(timeout=0)), 0)
+
+      clients = [ModelBridgeClient() for _ in range(3)]
+      for i, client in enumerate(clients):
+        dummy_connect_client(client)
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = f'vehicle_{i}'
+        state['NAV_X'] = float(i)
+        state['TAGGED'] = i == 1
+        self.assertTrue(client.send_state(state))
+      time.sleep(0.2)
+
+      batch = mgr.get_messages(max_n=5, timeout=1)
+      self.assertEqual(sorted(batch.vnames), ['vehicle_0', 'vehicle_1', 'vehicle_2'])
+      obs = batch.stack(['NAV_X', 'NAV_Y', 'TAGGED'])
+      self.assertEqual(obs.shape, (3, 3))
+      self.assertEqual(obs.dtype, np.float32)
+      for row, msg in zip(obs, batch):
+        self.assertEqual(list(row), [msg.state['NAV_X'], 40.0, float(msg.vname == 'vehicle_1')])
+
+      batch.act(np.array([1.0, 2.0, 3.0]), 90, posts=[None, {'FAKE_VAR': 'fake_val'}, None])
+      time.sleep(0.1)
+      for j, client in enumerate(clients):
+        instr = client.listen()
+        while instr == INSTR_SEND_STATE:
+          instr = client.listen()
+        # Row in the batch of this client's message
+        i = batch.vnames.index(f'vehicle_{j}')
+        expected = {'speed': float(i+1), 'course': 90.0, 'posts': {}, 'ctrl_msg': 'SEND_STATE'}
+        if i == 1:
+          expected['posts'] = {'FAKE_VAR': 'fake_val'}
+        self.assertEqual(instr, expected)
+
+      for client in clients:
+        client.close()
+
+  @timeout_decorator.timeout(5)
+  def test_action_repeat(self):
+    for repeat, action_repeat in ((3, 1), (None, 3)):
+      with MissionManager('test', log=False, action_repeat=action_repeat) as mgr:
+        with ModelBridgeClient() as client:
+          dummy_connect_client(client)
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+          self.assertTrue(client.send_state(DUMMY_STATE))
+          mgr.get_message().act(DUMMY_ACTION, repeat=repeat)
+          # The next two states are answered without the user
+          for _ in range(3):
+            time.sleep(0.1)
+            self.assertEqual(client.listen(), DUMMY_INSTR)
+            self.assertIsNone(mgr.get_message(block=False))
+            self.assertTrue(client.send_state(DUMMY_STATE))
+          self.assertEqual(mgr.stats()['repeated'], 2)
+
+          msg = mgr.get_message()
+          self.assertFalse(client.listen())
+          msg.act(DUMMY_ACTION, repeat=2)
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), DUMMY_INSTR)
+
+          # Repeating stops when the episode changes
+          state = DUMMY_STATE.copy()
+          state[KEY_EPISODE_MGR_STATE] = 'RUNNING'
+          self.assertTrue(client.send_state(state))
+          self.assertEqual(mgr.get_message().episode_state, 'RUNNING')
+          self.assertEqual(mgr.stats()['repeated'], 2)
+
+    with MissionManager('test', log=False) as mgr:
+      self.assertRaises(AssertionError, MissionMessage(None, DUMMY_STATE).act, DUMMY_ACTION, repeat=0)
+    self.assertRaises(ValueError, MissionManager, 'test', log=False, action_repeat=0)
+
+  @timeout_decorator.timeout(5)
+  def test_deadline(self):
+    with MissionManager('test', log=False, response_deadline={'felix': 0.2}, fallback='zero_speed') as mgr:
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+        self.assertTrue(client.send_state(DUMMY_STATE))
+        msg = mgr.get_message()
+        time.sleep(0.1)
+        self.assertFalse(client.listen())
+        time.sleep(0.2)
+        self.assertEqual(client.listen(), {'speed': 0.0, 'course': 0.0, 'posts': {}, 'ctrl_msg': 'SEND_STATE'})
+        self.assertEqual(mgr.stats()['deadline_missed'], 1)
+
+        # Late responses are dropped
+        msg.mark_transition()
+        msg.act(DUMMY_ACTION)
+        self.assertRaises(AssertionError, msg.act, DUMMY_ACTION)
+        time.sleep(0.1)
+        self.assertFalse(client.listen())
+        self.assertEqual(mgr.stats()['late'], 1)
+
+        # No deadline for other vehicles
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = 'evan'
+        with ModelBridgeClient() as client2:
+          dummy_connect_client(client2)
+          self.assertTrue(client2.send_state(state))
+          mgr.get_message()
+          time.sleep(0.4)
+          self.assertEqual(client2.listen(), INSTR_SEND_STATE)
+          self.assertFalse(client2.listen())
+
+    with MissionManager('test', log=False, response_deadline=0.2, late_response='next') as mgr:
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        self.assertTrue(client.send_state(DUMMY_STATE))
+        mgr.get_message().act(DUMMY_ACTION)
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+        self.assertEqual(client.listen(), DUMMY_INSTR)
+
+        # The last action is repeated
+        self.assertTrue(client.send_state(DUMMY_STATE))
+        msg = mgr.get_message()
+        time.sleep(0.3)
+        self.assertEqual(client.listen(), {'speed': 2.0, 'course': 120.0, 'posts': {}, 'ctrl_msg': 'SEND_STATE'})
+
+        # A late response answers the next state
+        late = {'speed': 4.0, 'course': 10.0, 'posts': {}}
+        msg.act(late)
+        time.sleep(0.1)
+        self.assertTrue(client.send_state(DUMMY_STATE))
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), dict(late, ctrl_msg='SEND_STATE'))
+        self.assertIsNone(mgr.get_message(block=False))
+
+    with MissionManager('test', log=False, response_deadline=0.1, fallback=lambda msg: {'speed': msg.state['NAV_X'], 'course': 1.0}) as mgr:
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        self.assertTrue(client.send_state(DUMMY_STATE))
+        time.sleep(0.3)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+        self.assertEqual(client.listen(), {'speed': 98.0, 'course': 1.0, 'posts': {}, 'ctrl_msg': 'SEND_STATE'})
+
+    self.assertRaises(ValueError, MissionManager, 'test', log=False, fallback='made_up')
+    self.assertRaises(ValueError, MissionManager, 'test', log=False, late_response='made_up')
+
+  @timeout_decorator.timeout(5)
+  def test_max_queue(self):
+    depths = []
+    with MissionManager('test', log=False, max_queue=2, overflow='drop_oldest', on_high_water=depths.append) as mgr:
+      clients = [ModelBridgeClient() for _ in range(3)]
+      for i, client in enumerate(clients):
+        dummy_connect_client(client)
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = f'vehicle_{i}'
+        self.assertTrue(client.send_state(state))
+        time.sleep(0.1)
+
+      stats = mgr.stats()
+      self.assertEqual((stats['queued'], stats['peak'], stats['dropped']), (2, 2, 1))
+      self.assertEqual(depths, [2])
+      # The dropped message is answered so the vehicle sends a new state
+      self.assertEqual(clients[0].listen(), INSTR_SEND_STATE)
+      self.assertEqual([msg.vname for msg in mgr.get_messages()], ['vehicle_1', 'vehicle_2'])
+
+      for client in clients:
+        client.close()
+
+  @timeout_decorator.timeout(5)
+  def test_get_message_vname(self):
+    with MissionManager('test', log=False, schedule='round_robin') as mgr:
+      clients = [ModelBridgeClient() for _ in range(3)]
+      for i, client in enumerate(clients):
+        dummy_connect_client(client)
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = f'vehicle_{i}'
+        self.assertTrue(client.send_state(state))
+      time.sleep(0.2)
+
+      self.assertEqual(sorted(mgr.stats()['queue_ages']), ['vehicle_0', 'vehicle_1', 'vehicle_2'])
+      self.assertEqual(mgr.get_message(vname='vehicle_1').vname, 'vehicle_1')
+      self.assertIsNone(mgr.get_message(block=False, vname='vehicle_1'))
+      self.assertEqual(mgr.get_messages(vnames=['vehicle_2']).vnames, ['vehicle_2'])
+      self.assertEqual(mgr.get_message(vnames=['vehicle_0', 'vehicle_1']).vname, 'vehicle_0')
+      self.assertEqual(mgr.stats()['queue_ages'], {})
+
+      for client in clients:
+        client.close()
+
+  @timeout_decorator.timeout(10)
+  def test_hung_up(self):
+    with MissionManager('test', log=False) as mgr:
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = 'evan'
+        self.assertTrue(client.send_state(state))
+        msg = mgr.get_message()
+      while mgr.stats()['shards'][0]['connected_vehicles'] != 0:
+        time.sleep(0.05)
+
+      # Answering or resetting a vehicle which hung up leaves the others served
+      msg.act(DUMMY_ACTION)
+      mgr.reset_vehicle('evan')
+      run_states(self, mgr, 2)
+
+  @timeout_decorator.timeout(10)
+  def test_free_port(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'address')
+      with mock.patch.dict(os.environ, {ENV_ADDRESS_FILE: path}):
+        # Started before the managers
+        clients = [ModelBridgeClient() for _ in range(2)]
+        self.assertEqual(clients[0].address, 'tcp://localhost:57721')
+
+        with MissionManager('test', log=False, port=0, address_file=path) as a, MissionManager('test', log=False, port=0, export_address=True) as b:
+          self.assertEqual(a.address(), f'tcp://localhost:{a.address().split(":")[-1]}')
+          self.assertNotEqual(a.address(), b.address())
+          self.assertNotIn(a.address(), ('tcp://localhost:0', 'tcp://localhost:57721'))
+          self.assertEqual(os.environ[ENV_ADDRESS], b.address())
+
+          # Read from the environment variable ahead of the file
+          exported = ModelBridgeClient()
+          dummy_connect_client(exported)
+          self.assertEqual(exported.address, b.address())
+          # Read from the file written after the clients were made
+          dummy_connect_client(clients[0])
+          self.assertEqual(clients[0].address, a.address())
+          # Explicit arguments win
+          self.assertEqual(ModelBridgeClient(port=1234).address, 'tcp://localhost:1234')
+
+          time.sleep(0.1)
+          self.assertEqual(clients[0].listen(), INSTR_SEND_STATE)
+          self.assertTrue(clients[0].send_state(DUMMY_STATE))
+          msg = a.get_message()
+          self.assertEqual(msg.vname, 'felix')
+          msg.act(DUMMY_ACTION)
+          self.assertEqual(b.get_message(block=False), None)
+          clients[0].close()
+          exported.close()
+
+        # Cleaned up on close
+        self.assertFalse(os.path.exists(path))
+        self.assertNotIn(ENV_ADDRESS, os.environ)
+
+  @timeout_decorator.timeout(10)
+  def test_timing(self):
+    for timing in (True, False):
+      with MissionManager('test', log=False, timing=timing) as mgr:
+        with ModelBridgeClient() as client:
+          dummy_connect_client(client)
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+          for i in range(3):
+            self.assertTrue(client.send_state(DUMMY_STATE))
+            time.sleep(0.02)
+            msg = mgr.get_message()
+            time.sleep(0.05)
+            msg.act(DUMMY_ACTION)
+            time.sleep(0.05)
+            self.assertEqual(client.listen(), DUMMY_INSTR)
+
+          stats = mgr.stats()
+          self.assertEqual(stats['states'], 3)
+          self.assertGreater(stats['bytes_received'], 0)
+          self.assertGreater(stats['bytes_sent'], 0)
+          self.assertGreater(stats['states_per_sec'], 0)
+          # Nothing since the last call
+          self.assertEqual(mgr.stats()['states_per_sec'], 0)
+
+          if not timing:
+            self.assertIsNone(msg.timestamps)
+            self.assertIsNone(stats['timing'])
+            self.assertIsNone(stats['speed'])
+            continue
+
+          t = msg.timestamps
+          self.assertEqual(list(t), ['received', 'queued', 'dequeued', 'acted', 'sent'])
+          self.assertEqual(sorted(t.values()), list(t.values()))
+          timing = stats['timing']['felix']
+          for name in ('queue', 'think', 'round_trip'):
+            self.assertEqual(timing[name]['count'], 3)
+          self.assertGreater(timing['queue']['min'], 0.015)
+          self.assertGreater(timing['think']['min'], 0.045)
+          self.assertGreater(timing['round_trip']['min'], timing['think']['min'])
+          self.assertLess(timing['think']['p50'], 0.1)
+
+  @timeout_decorator.timeout(10)
+  def test_trace(self):
+    self.assertRaises(RuntimeError, MissionManager('test', log=False).dump_trace, 'trace.json')
+
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'trace.json')
+      with MissionManager('test', log=True, trace=path) as mgr:
+        log_path = mgr.log_output_dir()
+        run_states(self, mgr, 3)
+        mgr.dump_trace(os.path.join(tmp, 'now.json'))
+
+      self.assertIn('handle', trace_names(os.path.join(tmp, 'now.json')))
+      # Flushed to gzip on close
+      self.assertEqual(trace_names(path), {'accept', 'recv', 'decode', 'enqueue', 'handle', 'send', 'respond', 'log_buffer', 'log_flush'})
+    safe_clean(log_path, patterns=['*.gz', 'speed.json'])
+    os.rmdir(log_path)
+
+  @timeout_decorator.timeout(10)
+  def test_metrics(self):
+    self.assertIsNone(MissionManager('test', log=False).metrics_url())
+
+    with MissionManager('test', log=True, metrics_port=0) as mgr:
+      log_path = mgr.log_output_dir()
+      url = mgr.metrics_url()
+      def scrape():
+        with urllib.request.urlopen(url) as rsp:
+          self.assertTrue(rsp.headers['Content-Type'].startswith('text/plain'))
+          text = rsp.read().decode()
+        return text, dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        time.sleep(0.1)
+        client.listen()
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = 'evan'
+        self.assertTrue(client.send_state(state))
+        mgr.get_message().act(DUMMY_ACTION)
+        _, samples = scrape()
+        self.assertEqual(float(samples['mivp_agent_vehicles']), 1)
+        self.assertEqual(float(samples['mivp_agent_connections']), 1)
+      run_states(self, mgr, 2)
+      # Both hang ups were seen
+      time.sleep(0.1)
+
+      text, samples = scrape()
+      self.assertEqual(float(samples['mivp_agent_vehicles']), 0)
+      self.assertEqual(float(samples['mivp_agent_connections']), 0)
+      self.assertEqual(float(samples['mivp_agent_vehicles_total']), 2)
+      self.assertEqual(float(samples['mivp_agent_connections_total']), 2)
+      self.assertEqual(float(samples['mivp_agent_states_total']), 3)
+      self.assertGreater(float(samples['mivp_agent_states_per_second']), 0)
+      self.assertEqual(float(samples['mivp_agent_episode{vname="felix"}']), DUMMY_REPORT['NUM'])
+      self.assertEqual(float(samples['mivp_agent_round_trip_seconds_count{vname="felix"}']), 2)
+      self.assertIn('mivp_agent_round_trip_seconds{quantile="0.99",vname="felix"}', samples)
+      self.assertEqual(float(samples['mivp_agent_log_flushes_total']), 0)
+      self.assertIn('# TYPE mivp_agent_states_total counter', text)
+      # Scrapes keep their own rates
+      self.assertGreater(mgr.stats()['states_per_sec'], 0)
+
+      self.assertRaises(urllib.error.HTTPError, urllib.request.urlopen, url.replace('/metrics', '/other'))
+
+    # Flushed to gzip on close
+    self.assertEqual(mgr.stats()['log']['flushes'], 1)
+    self.assertGreater(mgr.stats()['log']['bytes_written'], 0)
+    self.assertRaises(urllib.error.URLError, urllib.request.urlopen, url)
+    safe_clean(log_path, patterns=['*.gz', 'speed.json'])
+    os.rmdir(log_path)
+
+    # Nothing measured, no timing or speed families
+    with MissionManager('test', log=False, timing=False, metrics_port=0) as mgr:
+      run_states(self, mgr, 1)
+      with urllib.request.urlopen(mgr.metrics_url()) as rsp:
+        text = rsp.read().decode()
+      self.assertIn('mivp_agent_states_total 1', text)
+      self.assertNotIn('mivp_agent_round_trip_seconds', text)
+      self.assertNotIn('mivp_agent_warp', text)
+
+  @timeout_decorator.timeout(10)
+  def test_speed(self):
+    with MissionManager('test', log=True) as mgr:
+      log_path = mgr.log_output_dir()
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+        state = DUMMY_STATE.copy()
+        for i in range(5):
+          self.assertTrue(client.send_state(state))
+          msg = mgr.get_message()
+          # A slow model
+          time.sleep(0.05)
+          msg.act(DUMMY_ACTION)
+          time.sleep(0.05)
+          self.assertEqual(client.listen(), DUMMY_INSTR)
+          state['MOOS_TIME'] += 0.5
+
+      speed = mgr.stats()['speed']['felix']
+      self.assertGreater(speed['warp'], 2)
+      self.assertLess(speed['warp'], 5)
+      self.assertGreater(speed['model_wait_share'], 0.3)
+      self.assertLess(speed['model_wait_share'], 0.7)
+
+    with open(os.path.join(log_path, 'speed.json')) as f:
+      self.assertAlmostEqual(json.load(f)['felix']['warp'], speed['warp'])
+    safe_clean(log_path, patterns=['*.gz', 'speed.json'])
+    os.rmdir(log_path)
+
+@unittest.skipUnless(shm.SUPPORTED, 'process_mode needs an x86-64 CPU')
+class TestManagerProcess(unittest.TestCase):
+  @timeout_decorator.timeout(10)
+  def test_basic(self):
+    path = None
+    states = [DUMMY_STATE.copy() for _ in range(5)]
+    for i, state in enumerate(states):
+      state['NAV_X'] = float(i)
+
+    with MissionManager('test', log=True, process_mode=True) as mgr:
+      path = mgr.log_output_dir()
+      with ModelBridgeClient() as client:
+        dummy_connect_client(client)
+        time.sleep(0.1)
+        self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+        for state in states:
+          self.assertTrue(client.send_state(state))
+          msg = mgr.get_message()
+          self.assertEqual(msg.state['NAV_X'], state['NAV_X'])
+          self.assertEqual(msg.episode_report, DUMMY_REPORT)
+          msg.act(DUMMY_ACTION)
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), DUMMY_INSTR)
+        # Counted by the child process
+        self.assertGreater(mgr.stats()['bytes_received'], 0)
+
+      # The port is taken
+      self.assertRaises(OSError, MissionManager('test', log=False, process_mode=True).start)
+
+    # Written by the child process
+    log = ProtoLogger(os.path.join(path, 'log_felix'), Transition, mode='r')
+    transitions = []
+    while log.has_more():
+      transitions.append(log.read(1)[0])
+    self.assertEqual([translate.state_to_dict(t.s1)['NAV_X'] for t in transitions], [0.0, 1.0, 2.0, 3.0])
+
+    safe_clean(path, patterns=['*.gz', 'speed.json'])
+    os.rmdir(path)
+
+  @timeout_decorator.timeout(10)
+  def test_full_rings(self):
+    # Both ends push more than their ring holds before popping anything
+    fd = shm.create_file(2*shm.ring_size(4, 256))
+    rings = [shm.ShmRings(fd, 4, 256, is_client=is_client) for is_client in (True, False)]
+    os.close(fd)
+    received = [[], []]
+    def run(i):
+      channel = _Channel(rings[i], None, lambda: True)
+      for n in range(10):
+        channel.push(n)
+      while len(received[i]) < 10:
+        received[i].extend(channel.pop_all())
+        time.sleep(0.001)
+
+    threads = [Thread(target=run, args=(i, )) for i in range(2)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(received, [list(range(10))]*2)
+    for r in rings:
+      r.close()
+
+  @timeout_decorator.timeout(10)
+  def test_missed_wakeup(self):
+    # Neither process is ever rung awake by the other, see mivp_agent.shm
+    push = shm.ShmRing.push
+    with mock.patch.object(shm.ShmRing, 'push', lambda *args: push(*args) and False):
+      with MissionManager('test', log=False, process_mode=True) as mgr:
+        run_states(self, mgr, 3)
+
+  @timeout_decorator.timeout(10)
+  def test_trace(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'trace.json')
+      with MissionManager('test', log=False, process_mode=True, trace=path) as mgr:
+        run_states(self, mgr, 3)
+
+      self.assertEqual(trace_names(path), {'enqueue', 'handle', 'respond'})
+      # Written by the child process
+      self.assertEqual(trace_names(path + '.shard0'), {'accept', 'recv', 'decode', 'send'})
+
+class TestManagerShards(unittest.TestCase):
+  def round_trips(self, mgr, clients, n, connect=True):
+    # Each client sends n states and checks the responses
+    if connect:
+      for client in clients.values():
+        dummy_connect_client(client)
+    time.sleep(0.2)
+    for client in clients.values():
+      self.assertEqual(client.listen(), INSTR_SEND_STATE)
+
+    for i in range(n):
+      for vname, client in clients.items():
+        state = DUMMY_STATE.copy()
+        state[KEY_ID] = vname
+        state['NAV_X'] = float(i)
+        self.assertTrue(client.send_state(state))
+
+      seen = {}
+      for _ in clients:
+        msg = mgr.get_message()
+        seen[msg.vname] = msg.state['NAV_X']
+        msg.act({'speed': float(i), 'course': 0.0})
+      self.assertEqual(seen, {vname: float(i) for vname in clients})
+
+      time.sleep(0.1)
+      for client in clients.values():
+        self.assertEqual(client.listen()['speed'], float(i))
+
+  @timeout_decorator.timeout(10)
+  def test_least_loaded(self):
+    with MissionManager('test', log=False, shards=2) as mgr:
+      clients = {f'agent_{i}': ModelBridgeClient() for i in range(4)}
+      for client in clients.values():
+        dummy_connect_client(client)
+      # Only once the router has passed on all four
+      while sum(s['connections'] for s in mgr.stats()['shards']) != 4:
+        time.sleep(0.05)
+      # Straight to the second shard
+      clients['direct'] = ModelBridgeClient(address=shard_address('tcp://localhost:57721', 2))
+      dummy_connect_client(clients['direct'])
+      self.round_trips(mgr, clients, 3, connect=False)
+
+      stats = mgr.stats()
+      self.assertEqual([s['address'] for s in stats['shards']], ['tcp://localhost:57722', 'tcp://localhost:57723'])
+      self.assertEqual([s['connections'] for s in stats['shards']], [2, 3])
+      self.assertEqual([s['vehicles'] for s in stats['shards']], [2, 3])
+      self.assertEqual([s['states'] for s in stats['shards']], [6, 9])
+      self.assertEqual(mgr.get_vehicle_count(), 5)
+      for client in clients.values():
+        client.close()
+
+  @timeout_decorator.timeout(10)
+  def test_least_loaded_hang_up(self):
+    with MissionManager('test', log=False, shards=2) as mgr:
+      clients = {f'agent_{i}': ModelBridgeClient() for i in range(3)}
+      self.round_trips(mgr, clients, 1)
+      self.assertEqual([s['vehicles'] for s in mgr.stats()['shards']], [2, 1])
+
+      # The first shard is left with no open connection
+      clients.pop('agent_0').close()
+      clients.pop('agent_2').close()
+      time.sleep(0.2)
+      clients['agent_3'] = ModelBridgeClient()
+      self.round_trips(mgr, {'agent_3': clients['agent_3']}, 1)
+      self.assertEqual([s['vehicles'] for s in mgr.stats()['shards']], [3, 1])
+      self.assertEqual([s['connected_vehicles'] for s in mgr.stats()['shards']], [1, 1])
+      self.assertEqual([s['open_connections'] for s in mgr.stats()['shards']], [1, 1])
+      for client in clients.values():
+        client.close()
+
+  @timeout_decorator.timeout(10)
+  def test_reconnect(self):
+    with MissionManager('test', log=False, shards=2) as mgr:
+      # felix comes back on new connections, served by either shard
+      for _ in range(3):
+        with ModelBridgeClient(codecs=('delta', )) as client:
+          self.round_trips(mgr, {'felix': client}, 3)
+          mgr.reset_vehicle('felix')
+          time.sleep(0.1)
+          self.assertEqual(client.listen(), INSTR_RESET_FAILURE)
+
+      self.assertEqual(mgr.get_vehicle_count(), 1)
+      self.assertEqual(sum(s['connections'] for s in mgr.stats()['shards']), 3)
+
+  @timeout_decorator.timeout(10)
+  def test_hash(self):
+    vnames = [f'agent_{i}' for i in range(6)]
+    homes = [zlib.crc32(vname.encode()) % 3 for vname in vnames]
+
+    with MissionManager('test', log=False, shards=3, shard_assign='hash') as mgr:
+      clients = {vname: ModelBridgeClient() for vname in vnames}
+      self.round_trips(mgr, clients, 3)
+
+      stats = mgr.stats()
+      self.assertEqual([s['vehicles'] for s in stats['shards']], [homes.count(i) for i in range(3)])
+      self.assertEqual([s['connections'] for s in stats['shards']], [homes.count(i) for i in range(3)])
+      self.assertEqual(sum(s['states'] for s in stats['shards']), 18)
+      for client in clients.values():
+        client.close()
+
+    self.assertRaises(ValueError, MissionManager, 'test', log=False, shard_assign='hash', process_mode=True)
+    self.assertRaises(ValueError, MissionManager, 'test', log=False, shards=0)
+    with mock.patch('mivp_agent.shm.SUPPORTED', False):
+      self.assertRaises(ValueError, MissionManager, 'test', log=False, process_mode=True)
+
+  @unittest.skipUnless(shm.SUPPORTED, 'process_mode needs an x86-64 CPU')
+  @timeout_decorator.timeout(20)
+  def test_process(self):
+    with MissionManager('test', log=False, shards=2, process_mode=True) as mgr:
+      clients = {f'agent_{i}': ModelBridgeClient() for i in range(2)}
+      self.round_trips(mgr, clients, 3)
+
+      stats = mgr.stats()
+      self.assertEqual([s['connections'] for s in stats['shards']], [1, 1])
+      self.assertEqual([s['vehicles'] for s in stats['shards']], [1, 1])
+      self.assertEqual([s['open_connections'] for s in stats['shards']], [1, 1])
+      for client in clients.values():
+        client.close()
+
+      # Reported by the child processes
+      time.sleep(0.2)
+      stats = mgr.stats()
+      self.assertEqual([s['open_connections'] for s in stats['shards']], [0, 0])
+      self.assertEqual([s['connected_vehicles'] for s in stats['shards']], [0, 0])
+
 class TestManagerLogger(unittest.TestCase):
   @classmethod
   def setUpClass(cls) -> None:
@@ -193,7 +915,42 @@ class TestManagerLogger(unittest.TestCase):
       self.assertEqual(s2, self.states_parsed[i+1])
 
     # Clean up
-    safe_clean(path, patterns=['*.gz'])
+    safe_clean(path, patterns=['*.gz', 'speed.json'])
+    os.rmdir(path)
+  
+  def test_action_repeat(self):
+    path = None
+    # Same episode report in every state so the action is repeated
+    states = [s.copy() for s in self.states]
+    for s in states:
+      s[KEY_EPISODE_MGR_REPORT] = self.states[0][KEY_EPISODE_MGR_REPORT]
+
+    with ModelBridgeClient() as client:
+      with MissionManager('test', log=True, action_repeat=3) as mgr:
+        path = mgr.log_output_dir()
+        while not client.connect():
+          time.sleep(0.1)
+
+        for i in range(9):
+          client.send_state(states[i])
+          if i % 3 == 0:
+            mgr.get_message().act(self.actions[i])
+          time.sleep(0.1)
+        self.assertIsNone(mgr.get_message(block=False))
+
+    log = ProtoLogger(os.path.join(path, 'log_felix'), Transition, mode='r')
+    transitions = []
+    while log.has_more():
+      transitions.append(log.read(1)[0])
+
+    # Repeated states are logged too
+    self.assertEqual(len(transitions), 8)
+    for i, t in enumerate(transitions):
+      self.assertEqual(translate.state_to_dict(t.s1)['NAV_X'], states[i]['NAV_X'])
+      self.assertEqual(translate.action_to_dict(t.a), self.actions[i - i % 3])
+
+    # Clean up
+    safe_clean(path, patterns=['*.gz', 'speed.json'])
     os.rmdir(path)
   
   def test_transition(self):
@@ -235,7 +992,7 @@ class TestManagerLogger(unittest.TestCase):
     self.assertEqual(s2, self.states_parsed[5])
 
     # Clean up
-    safe_clean(path, patterns=['*.gz'])
+    safe_clean(path, patterns=['*.gz', 'speed.json'])
     os.rmdir(path)
   
   def test_whitelist(self):
@@ -297,7 +1054,7 @@ class TestManagerLogger(unittest.TestCase):
 
         self.assertEqual(len(transitions), 1)
 
-    safe_clean(path, patterns=['*.gz'])
+    safe_clean(path, patterns=['*.gz', 'speed.json'])
     os.rmdir(path)
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,151 @@
+import time
+import unittest
+import timeout_decorator
+
+from mivp_agent.manager import MissionManager
+from mivp_agent.policy_server import PolicyServer
+from mivp_agent.messages import INSTR_SEND_STATE
+from mivp_agent.bridge import ModelBridgeClient
+from mivp_agent.const import KEY_ID, KEY_EPISODE_MGR_REPORT, KEY_EPISODE_MGR_STATE
+
+def make_state(vname, x):
+  return {
+    KEY_ID: vname,
+    'MOOS_TIME': 10.0,
+    'NAV_X': x,
+    'NAV_Y': 0.0,
+    'NAV_HEADING': 0.0,
+    KEY_EPISODE_MGR_REPORT: None,
+    KEY_EPISODE_MGR_STATE: 'RUNNING'
+  }
+
+def constant(speed):
+  # Builds a policy which answers every state with speed and the state's NAV_X as course
+  def make():
+    return lambda states: [{'speed': speed, 'course': state['NAV_X']} for state in states]
+  return make
+
+def broken():
+  def policy(states):
+    raise ValueError('broken policy')
+  return policy
+
+def no_course():
+  return lambda states: [{'speed': 1.0} for state in states]
+
+def make_stopped():
+  # Module level so a spawned worker can unpickle it
+  return lambda states: [{'speed': 0.0, 'course': 0.0} for state in states]
+
+def connect(vnames):
+  clients = {}
+  for vname in vnames:
+    clients[vname] = ModelBridgeClient()
+    while not clients[vname].connect():
+      time.sleep(0.1)
+  return clients
+
+def wait_instr(client):
+  instr = client.listen()
+  while not instr:
+    time.sleep(0.01)
+    instr = client.listen()
+  return instr
+
+class TestPolicyServer(unittest.TestCase):
+  @timeout_decorator.timeout(10)
+  def test_routing(self):
+    assign = {'felix': 'attack', 'evan': 'attack', 'cher': 'defend'}
+    policies = {'attack': constant(1.0), 'defend': constant(2.0)}
+    with MissionManager('test', log=False) as mgr:
+      clients = connect(['felix', 'evan', 'cher', 'other'])
+      with PolicyServer(mgr, policies, assign, window=0.2) as server:
+        for client in clients.values():
+          self.assertEqual(wait_instr(client), INSTR_SEND_STATE)
+
+        for step in range(3):
+          for vname, client in clients.items():
+            client.send_state(make_state(vname, float(step)))
+
+          # Not assigned a policy, left for the user
+          msg = mgr.get_message(vname='other')
+          msg.act({'speed': 3.0, 'course': 0.0})
+
+          for vname, client in clients.items():
+            instr = wait_instr(client)
+            self.assertEqual(instr['speed'], {'attack': 1.0, 'defend': 2.0}.get(assign.get(vname), 3.0))
+            self.assertEqual(instr['course'], float(step) if vname in assign else 0.0)
+
+        stats = server.stats()
+        self.assertEqual(stats['attack']['states'], 6)
+        self.assertEqual(stats['defend']['states'], 3)
+        # Both vehicles of a policy sent their state within the window
+        self.assertEqual(stats['attack']['batches'], 3)
+        self.assertEqual(stats['attack']['batch_size']['max'], 2)
+        self.assertGreater(stats['attack']['latency']['min'], 0.1)
+
+      for client in clients.values():
+        client.close()
+
+  @timeout_decorator.timeout(10)
+  def test_max_batch(self):
+    vnames = [f'agent_{i}' for i in range(4)]
+    with MissionManager('test', log=False) as mgr:
+      clients = connect(vnames)
+      with PolicyServer(mgr, {'only': constant(1.0)}, {vname: 'only' for vname in vnames}, window=5, max_batch=2) as server:
+        for client in clients.values():
+          self.assertEqual(wait_instr(client), INSTR_SEND_STATE)
+        for vname, client in clients.items():
+          client.send_state(make_state(vname, 0.0))
+        # Full batches do not wait for the window
+        for client in clients.values():
+          self.assertEqual(wait_instr(client)['speed'], 1.0)
+        self.assertEqual(server.stats()['only']['batch_size']['counts'][:3], [0, 2, 0])
+
+      for client in clients.values():
+        client.close()
+
+  @timeout_decorator.timeout(10)
+  def test_error(self):
+    self.assertRaises(ValueError, PolicyServer, None, {'a': broken}, {'felix': 'b'})
+
+    with MissionManager('test', log=False) as mgr:
+      clients = connect(['felix'])
+      server = PolicyServer(mgr, {'broken': broken}, {'felix': 'broken'}, window=0)
+      server.start()
+      self.assertEqual(wait_instr(clients['felix']), INSTR_SEND_STATE)
+      clients['felix'].send_state(make_state('felix', 0.0))
+      time.sleep(0.5)
+      with self.assertRaises(RuntimeError) as ctx:
+        server.close()
+      self.assertIn('broken policy', str(ctx.exception))
+      clients['felix'].close()
+
+  @timeout_decorator.timeout(10)
+  def test_invalid_action(self):
+    with MissionManager('test', log=False) as mgr:
+      clients = connect(['felix', 'evan'])
+      server = PolicyServer(mgr, {'no_course': no_course}, {'felix': 'no_course', 'evan': 'no_course'}, window=0.2)
+      server.start()
+      for vname, client in clients.items():
+        self.assertEqual(wait_instr(client), INSTR_SEND_STATE)
+        client.send_state(make_state(vname, 0.0))
+      time.sleep(0.5)
+      with self.assertRaises(RuntimeError) as ctx:
+        server.close()
+      self.assertIn("Action must have key 'course'", str(ctx.exception))
+      for client in clients.values():
+        client.close()
+
+  @timeout_decorator.timeout(20)
+  def test_spawn(self):
+    with MissionManager('test', log=False) as mgr:
+      clients = connect(['felix'])
+      with PolicyServer(mgr, {'stopped': make_stopped}, {'felix': 'stopped'}, window=0, start_method='spawn'):
+        self.assertEqual(wait_instr(clients['felix']), INSTR_SEND_STATE)
+        clients['felix'].send_state(make_state('felix', 0.0))
+        self.assertEqual(wait_instr(clients['felix'])['speed'], 0.0)
+      clients['felix'].close()
+
+if __name__ == '__main__':
+  unittest.main()
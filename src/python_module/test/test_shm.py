@@ -0,0 +1,52 @@
+import os
+import unittest
+
+from mivp_agent import shm
+from mivp_agent.shm import ShmRings
+
+class TestShmRing(unittest.TestCase):
+  def setUp(self):
+    fd = shm.create_file(2*shm.ring_size(4, 64))
+    self.client = ShmRings(fd, 4, 64, is_client=True)
+    self.server = ShmRings(fd, 4, 64, is_client=False)
+    os.close(fd)
+
+  def tearDown(self):
+    self.client.close()
+    self.server.close()
+
+  def test_directions(self):
+    self.assertEqual(self.server.rx.pop_all(), [])
+    self.client.tx.push(3, b'state')
+    self.server.tx.push(2, b'instr')
+    self.assertEqual(self.server.rx.pop_all(), [(3, b'state')])
+    self.assertEqual(self.client.rx.pop_all(), [(2, b'instr')])
+    self.assertEqual(self.server.rx.pop_all(), [])
+
+  def test_large(self):
+    ring = self.client.tx
+    # Frames larger than a slot take several, starting over at the front instead of wrapping
+    frames = [(1, bytes([i])*100) for i in range(10)]
+    for frame in frames:
+      ring.push(*frame)
+      self.assertEqual(self.server.rx.pop_all(), [frame])
+
+    self.assertRaises(ValueError, ring.push, 1, b'x'*ring.max_frame())
+
+  def test_full(self):
+    for i in range(4):
+      self.client.tx.push(1, bytes([i]))
+    self.assertRaises(ConnectionError, self.client.tx.push, 1, b'one too many')
+    self.assertEqual(self.server.rx.pop_all(), [(1, bytes([i])) for i in range(4)])
+
+  def test_wait(self):
+    # Producers only report a wake up when the consumer asked for one
+    self.assertFalse(self.client.tx.push(1, b'a'))
+    self.assertTrue(self.server.rx.wait())
+    self.server.rx.pop_all()
+    self.assertFalse(self.server.rx.wait())
+    self.assertTrue(self.client.tx.push(1, b'b'))
+    self.assertFalse(self.client.tx.push(1, b'c'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+import os
+import json
+import tempfile
+import unittest
+
+from mivp_agent.util.speed import SpeedMonitor
+
+def run(monitor, vname, n, period, wait, warp, start=0.0):
+  # A vehicle sending a state every period wall seconds, answered after wait
+  for i in range(n):
+    received = start + i*period
+    monitor.on_state(vname, 100.0 + warp*received, received)
+    monitor.on_response(vname, received + wait)
+  return start + n*period
+
+class TestSpeedMonitor(unittest.TestCase):
+  def test_sim_bound(self):
+    monitor = SpeedMonitor()
+    monitor.on_state('felix', 100.0, 0.0)
+    self.assertEqual(monitor.stats(), {'felix': None})
+
+    run(monitor, 'felix', 50, 0.1, 0.01, 4.0)
+    stats = monitor.stats()['felix']
+    self.assertAlmostEqual(stats['warp'], 4.0)
+    self.assertAlmostEqual(stats['recent_warp'], 4.0)
+    self.assertAlmostEqual(stats['helm_period'], 0.1)
+    self.assertAlmostEqual(stats['model_wait_share'], 0.1)
+    self.assertFalse(stats['model_bound'])
+
+  def test_model_bound(self):
+    monitor = SpeedMonitor()
+    end = run(monitor, 'felix', 10, 0.1, 0.01, 4.0)
+    # The model slows down, so does the simulation
+    run(monitor, 'felix', 200, 0.4, 0.31, 1.0, start=end)
+    stats = monitor.stats()['felix']
+    self.assertTrue(stats['model_bound'])
+    self.assertGreater(stats['recent_model_wait_share'], 0.7)
+    self.assertLess(stats['recent_warp'], 1.5)
+    self.assertLess(stats['model_wait_share'], stats['recent_model_wait_share'])
+
+  def test_restart(self):
+    monitor = SpeedMonitor()
+    run(monitor, 'felix', 5, 0.1, 0.01, 4.0)
+    # MOOS_TIME going back means the simulation was restarted
+    monitor.on_state('felix', 0.0, 10.0)
+    self.assertIsNone(monitor.stats()['felix'])
+
+  def test_save(self):
+    monitor = SpeedMonitor()
+    run(monitor, 'felix', 5, 0.1, 0.01, 4.0)
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'speed.json')
+      monitor.save(path)
+      with open(path) as f:
+        self.assertAlmostEqual(json.load(f)['felix']['warp'], 4.0)
+
+if __name__ == '__main__':
+  unittest.main()
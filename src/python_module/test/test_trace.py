@@ -0,0 +1,55 @@
+import os
+import json
+import tempfile
+import unittest
+import threading
+from unittest import mock
+
+from mivp_agent.util import trace
+from mivp_agent.util.trace import Tracer
+
+class TestTracer(unittest.TestCase):
+  def test_events(self):
+    tracer = Tracer(size=3)
+    start = trace.now()
+    tracer.complete('decode', start, trace.CAT_BRIDGE, {'bytes': 10})
+    tracer.instant('mark', trace.CAT_USER)
+    events = [e for e in tracer.events() if e['ph'] != 'M']
+    self.assertEqual([e['name'] for e in events], ['decode', 'mark'])
+    self.assertEqual(events[0]['ph'], 'X')
+    self.assertEqual(events[0]['args'], {'bytes': 10})
+    self.assertGreaterEqual(events[0]['dur'], 0)
+    self.assertEqual(events[0]['tid'], trace._get_tid())
+    self.assertEqual(events[1]['ph'], 'i')
+
+    # Only the most recent are kept
+    for i in range(5):
+      tracer.complete(f'span_{i}', trace.now(), trace.CAT_MANAGER)
+    self.assertEqual(len(tracer), 3)
+    self.assertEqual([e['name'] for e in tracer.events() if e['ph'] == 'X'], ['span_2', 'span_3', 'span_4'])
+
+    names = [e['args']['name'] for e in tracer.events() if e['ph'] == 'M']
+    self.assertIn(threading.current_thread().name, names)
+
+  def test_python_ids(self):
+    # Threads only have Python's own ids before Python 3.8
+    class OldThread:
+      ident = 12
+    self.assertEqual(trace._tid(OldThread()), 12)
+    with mock.patch.object(trace, '_get_tid', threading.get_ident):
+      tracer = Tracer()
+      tracer.instant('mark', trace.CAT_USER)
+      self.assertEqual(tracer.events()[-1]['tid'], threading.get_ident())
+
+  def test_dump(self):
+    tracer = Tracer()
+    tracer.complete('send', trace.now(), trace.CAT_BRIDGE)
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'trace.json')
+      tracer.dump(path)
+      with open(path) as f:
+        events = json.load(f)['traceEvents']
+    self.assertIn('send', [e['name'] for e in events])
+
+if __name__ == '__main__':
+  unittest.main()